@@ -1,15 +1,80 @@
 import os
 import json
 import multiprocessing as mp
-import random
 from enum import IntEnum
-from typing import List, Dict
+from functools import partial
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import tqdm
 
+from generators.build_cache import SEARCH_MODULES, BuildCache, file_fingerprint, source_fingerprint
 from generators.config import DATA_DIR
-from generators.generate import DataGenerator
+from generators.dataset import ColumnWriter, open_columns, write_metadata
+from generators.filters import FilterEvaluator, PayloadColumns, csr_normalize
+from generators.ground_truth import ExactSearch, ScoredQuery
+from generators.engines import open_engine, prepare_engine
+from generators.output import RecordWriter
+from generators.planner import QueryPlanner
+from generators.profiling import collect_stages, profiler
+
+
+# Fields of the prepared payload columns: `labels` holds all categories of a paper, `label` a random one of them
+PAYLOAD_FIELDS = ("update_date_ts", "label", "labels")
+
+
+def read_arxiv_payloads(payload_path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    `update_date_ts`, label offsets, label dictionary and label codes of the payload file.
+    Parsed by the multithreaded pyarrow JSON reader, other fields are skipped without being materialized.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.json as pa_json
+    except ImportError:
+        raise ImportError("Columnar arxiv payload preparation requires pyarrow: pip install pyarrow")
+
+    schema = pa.schema([("update_date_ts", pa.int64()), ("labels", pa.list_(pa.string()))])
+    table = pa_json.read_json(
+        payload_path,
+        parse_options=pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore"),
+    )
+    timestamps = table.column("update_date_ts").to_numpy()
+    labels = table.column("labels").combine_chunks()
+    offsets = labels.offsets.to_numpy().astype(np.int64)
+    encoded = labels.flatten().dictionary_encode()
+    dictionary = np.array(encoded.dictionary.to_pylist(), dtype=object)
+    return timestamps, offsets - offsets[0], dictionary, encoded.indices.to_numpy().astype(np.int64)
+
+
+def prepare_columns(
+        timestamps: np.ndarray,
+        offsets: np.ndarray,
+        dictionary: np.ndarray,
+        codes: np.ndarray,
+        seed: int = None,
+) -> Dict[str, Tuple[str, tuple]]:
+    """
+    Payload columns of the generator: `update_date_ts` numbers, `labels` as a CSR column
+    and `label`, one of the labels of each paper sampled with a seeded generator.
+    """
+    # Dictionaries of `PayloadColumns` are sorted
+    order = np.argsort(dictionary)
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    dictionary = dictionary[order]
+    offsets, codes = csr_normalize(offsets, ranks[codes], len(dictionary))
+
+    lengths = np.diff(offsets)
+    if np.any(lengths == 0):
+        raise ValueError(f"{np.count_nonzero(lengths == 0)} papers have no labels")
+    rng = np.random.default_rng(seed)
+    picked = offsets[:-1] + (rng.random(len(lengths)) * lengths).astype(np.int64)
+    return {
+        "update_date_ts": ("number", (np.asarray(timestamps, dtype=np.int64),)),
+        "label": ("keyword", (dictionary, codes[picked])),
+        "labels": ("multi_keyword", (dictionary, offsets, codes)),
+    }
 
 
 class ConditionType(IntEnum):
@@ -20,17 +85,21 @@ class ConditionType(IntEnum):
 
 class ArxivGenerator:
     vectors: np.ndarray
-    payloads: List[dict] = []
+    payloads: Union[List[dict], PayloadColumns] = []
     filters: Dict[str, list] = {}
-    generator: DataGenerator
+    engine: ExactSearch
+    filter_evaluator: FilterEvaluator
+    planner: QueryPlanner
 
     @classmethod
-    def _init_generator(cls, vectors_path, payload_path, filters_path):
+    def _init_generator(cls, vectors_path, payload_path, filters_path, engine="exact"):
         print("init process")
         cls.vectors = cls._read_vectors(vectors_path)
         cls.payloads = cls._read_payload(payload_path)
         cls.filters = cls._read_filters(filters_path)
-        cls.generator = DataGenerator()
+        cls.engine = open_engine(vectors_path, cls.vectors, engine)
+        cls.filter_evaluator = FilterEvaluator(cls.payloads)
+        cls.planner = QueryPlanner(cls.engine, cls.filter_evaluator)
 
     @classmethod
     def _read_vectors(cls, vectors_path):
@@ -41,9 +110,16 @@ class ArxivGenerator:
 
     @classmethod
     def _read_payload(cls, payload_path):
+        """
+        A column store directory is memory-mapped, so workers share it without parsing anything,
+        a JSON lines file is parsed into records.
+        """
         print("loading payload")
-        with open(payload_path, "r") as fd:
-            payload = [json.loads(line) for line in fd]
+        if os.path.isdir(payload_path):
+            payload = open_columns(payload_path)
+        else:
+            with open(payload_path, "r") as fd:
+                payload = [json.loads(line) for line in fd]
         print(f"payload loaded, len: {len(payload)}")
         return payload
 
@@ -56,54 +132,59 @@ class ArxivGenerator:
         return filters
 
     @staticmethod
-    def generate_condition(filters: dict):
+    def generate_condition(filters: dict, rng: np.random.Generator):
 
-        if (case := random.randint(0, 1)) == ConditionType.date:
+        if (case := int(rng.integers(0, 1, endpoint=True))) == ConditionType.date:
             ts_range = filters["timestamp_range"]
             q25 = ts_range["q25"]
             q75 = ts_range["q75"]
             middle = (q25 + q75) // 2
 
-            start = random.randint(q25, middle)
-            end = random.randint(middle, q75)
+            start = int(rng.integers(q25, middle, endpoint=True))
+            end = int(rng.integers(middle, q75, endpoint=True))
 
             condition = {
                 "and": [{"update_date_ts": {"range": {"gt": start, "lt": end}}}]
             }
 
         elif case == ConditionType.category:
-            value = random.choice(filters["labels"])
-            condition = {"and": [{"label": {"match": {"value": value}}}]}
+            # Papers are listed in several categories, match the ones listed in any of one or two categories
+            num_labels = int(rng.integers(1, 2, endpoint=True))
+            values = [str(value) for value in rng.choice(filters["labels"], size=num_labels, replace=False)]
+            match = {"value": values[0]} if num_labels == 1 else {"any": values}
+            condition = {"and": [{"labels": {"match": match}}]}
         else:
             raise ValueError(f"Unrecognized option: <{case}>.")
 
         return condition
 
     @classmethod
-    def search_one(cls, top):
-        condition = dict()
-        best_scores = list()
-        closest_ids = list()
-
-        query_vector = cls.vectors[random.randint(0, len(cls.vectors))]
-        while len(closest_ids) < top:
-            condition = cls.generate_condition(cls.filters)
-            closest_ids, best_scores = cls.generator.search(
-                vectors=cls.vectors,
-                payloads=cls.payloads,
-                query=query_vector,
-                conditions=condition,
-                top=top,
-            )
+    def search_one(cls, seed_sequence: np.random.SeedSequence, top: int, tests_per_vector: int = 1) -> List[dict]:
+        # Each query has its own random stream, so results do not depend on which worker runs it
+        rng = np.random.default_rng(seed_sequence)
+        query_vector = np.array(cls.vectors[rng.integers(len(cls.vectors))])
+        # Several tests of the same vector share a single scan of the vectors
+        scored = ScoredQuery(cls.engine, query_vector) if tests_per_vector > 1 else None
 
-        return json.dumps(
-            {
-                "query": query_vector.tolist(),
-                "conditions": condition,
-                "closest_ids": closest_ids,
-                "closest_scores": best_scores,
-            }
-        )
+        records = []
+        for _ in range(tests_per_vector):
+            closest_ids = list()
+            while len(closest_ids) < top:
+                condition = cls.generate_condition(cls.filters, rng)
+                if scored is None:
+                    closest_ids, best_scores = cls.planner.search(query_vector, condition, top=top)
+                else:
+                    closest_ids, best_scores = scored.top(condition, cls.filter_evaluator, top)
+
+            records.append(
+                {
+                    "query": query_vector,
+                    "conditions": condition,
+                    "closest_ids": closest_ids,
+                    "closest_scores": best_scores,
+                }
+            )
+        return records
 
     @classmethod
     def generate(
@@ -115,60 +196,101 @@ class ArxivGenerator:
         top=10,
         parallel=1,
         output_path="out.jsonl",
+        seed=None,
+        engine="exact",
+        tests_per_vector=1,
+        precision=None,
+        compression=None,
     ):
-        with open(output_path, "w") as f:
+        """
+        `engine` - one of `ENGINES`: "int8" / "float16" scan a quantized copy of the vectors,
+        "clusters" prunes k-means partitions. All of them produce the same results as "exact".
+        `tests_per_vector` - number of conditions generated for each query vector, `num_queries` is rounded up
+        to a multiple of it.
+        `precision`, `compression` - see `RecordWriter`, tests are encoded and written in the background.
+        `payload_path` - prepared payload columns directory, see `prepare_columns`, or a JSON lines file.
+        """
+        # Build engine sidecars once, workers only map them
+        prepare_engine(vectors_path, engine)
+
+        query_seeds = np.random.SeedSequence(seed).spawn(-(-num_queries // tests_per_vector))
+        search = partial(cls.search_one, top=top, tests_per_vector=tests_per_vector)
+        with RecordWriter(output_path, precision=precision, compression=compression) as writer:
             if parallel == 1:
-                cls._init_generator(vectors_path, payload_path, filters_path)
-                for _ in tqdm.trange(num_queries):
-                    f.write(cls.search_one(top) + "\n")
+                cls._init_generator(vectors_path, payload_path, filters_path, engine)
+                for query_seed in tqdm.tqdm(query_seeds):
+                    for record in search(query_seed):
+                        writer.write(record)
             else:
                 with mp.Pool(
                     processes=parallel,
                     initializer=cls._init_generator,
-                    initargs=(vectors_path, payload_path, filters_path),
+                    initargs=(vectors_path, payload_path, filters_path, engine),
                 ) as pool:
-                    with tqdm.tqdm(total=num_queries) as p_bar:
-                        for json_result in pool.imap(
-                            cls.search_one, (top for _ in range(num_queries))
-                        ):
-                            f.write(json_result + "\n")
+                    with tqdm.tqdm(total=len(query_seeds)) as p_bar:
+                        # Stages profiled by workers are merged into the parent's report
+                        for records, stages in pool.imap(partial(collect_stages, search), query_seeds):
+                            profiler().merge(stages)
+                            for record in records:
+                                writer.write(record)
                             p_bar.update(1)
 
 
 if __name__ == "__main__":
     VECTORS_PATH = os.path.join(DATA_DIR, "arxiv", "vectors.npy")
     PAYLOAD_PATH = os.path.join(DATA_DIR, "arxiv", "payloads.jsonl")
-    PREPARED_PAYLOAD_PATH = os.path.join(DATA_DIR, "arxiv", "prepared_payload.jsonl")
     FILTER_PATH = os.path.join(DATA_DIR, "arxiv", "filters.json")
     OUTPUT_PATH = os.path.join(DATA_DIR, "arxiv", "tests.jsonl")
     NUM_QUERIES = 100
     TOP = 10
     PARALLEL = 8
+    SEED = 42
+
+    cache = BuildCache()
 
-    if not os.path.exists(PREPARED_PAYLOAD_PATH):
-        with open(PAYLOAD_PATH, "r") as src:
-            with open(PREPARED_PAYLOAD_PATH, "w") as dest:
-                for json_line in src:
-                    line = json.loads(json_line)
-                    line["label"] = random.choice(line["labels"])
-                    dest.write(
-                        json.dumps(
-                            {
-                                k: v
-                                for k, v in line.items()
-                                if k in {"update_date_ts", "label"}
-                            }
-                        )
-                        + "\n"
-                    )
-
-    arxiv_generator = ArxivGenerator
-    arxiv_generator.generate(
-        VECTORS_PATH,
-        PREPARED_PAYLOAD_PATH,
-        FILTER_PATH,
-        NUM_QUERIES,
-        TOP,
-        PARALLEL,
-        OUTPUT_PATH,
+    payload_stage = cache.stage(
+        "arxiv_columns",
+        source=file_fingerprint(PAYLOAD_PATH),
+        fields=list(PAYLOAD_FIELDS),
+        seed=SEED,
+        code=source_fingerprint(read_arxiv_payloads, prepare_columns, ColumnWriter),
     )
+    if not payload_stage.done:
+        with payload_stage.build() as work_dir, profiler().stage("prepare_payload") as stage:
+            columns = prepare_columns(*read_arxiv_payloads(PAYLOAD_PATH), seed=SEED)
+            size = len(columns["update_date_ts"][1][0])
+            stage.rows = size
+            with ColumnWriter(os.path.join(work_dir, "columns"), size) as writer:
+                writer.write(0, columns)
+
+    tests_stage = cache.stage(
+        "arxiv_tests",
+        vectors=file_fingerprint(VECTORS_PATH),
+        payloads=payload_stage.digest,
+        filters=file_fingerprint(FILTER_PATH),
+        num_queries=NUM_QUERIES,
+        top=TOP,
+        seed=SEED,
+        code=source_fingerprint(
+            ArxivGenerator,
+            "generators.engines",
+            "generators.quantized_search",
+            "generators.cluster_search",
+            *SEARCH_MODULES,
+        ),
+    )
+    if not tests_stage.done:
+        with tests_stage.build() as work_dir:
+            arxiv_generator = ArxivGenerator
+            arxiv_generator.generate(
+                VECTORS_PATH,
+                payload_stage.file("columns"),
+                FILTER_PATH,
+                NUM_QUERIES,
+                TOP,
+                PARALLEL,
+                os.path.join(work_dir, "tests.jsonl"),
+                SEED,
+            )
+    tests_stage.link("tests.jsonl", OUTPUT_PATH)
+    write_metadata(os.path.dirname(OUTPUT_PATH), metric="cosine", top=TOP)
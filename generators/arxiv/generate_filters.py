@@ -1,56 +1,67 @@
+"""
+Prepare arxiv payloads and filters in a single streaming pass over the raw metadata:
+`update_date` is converted into the `update_date_ts` timestamp, `categories` are split into `labels`.
+Enriched payloads are written to `--payloads`, statistics of all fields to `--stats`,
+and `filters.json`, used by the query generator, is derived from them.
+Value frequencies are tracked only for the fields filters are derived from.
+"""
+import argparse
 import json
-import math
-from collections import defaultdict
+import os
+from typing import List
 
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
 
+from generators.config import DATA_DIR
+from generators.stats import PayloadStats, build_stats, save_stats
 
-chunk_size = 10_000
-all_df = pd.read_json("payloads.jsonl", orient="records", lines=True, chunksize=chunk_size)
+# Submitters with more papers are listed in `top_submitters`
+MIN_SUBMITTER_PAPERS = 25
+# Fields whose value frequencies filters are derived from
+FREQUENCY_FIELDS = ["submitter", "labels"]
+# Submitters have a long tail, a sketch would undercount most of those above `MIN_SUBMITTER_PAPERS`.
+# Exact counts of a few hundred thousand names are small
+EXACT_FIELDS = ["submitter"]
 
-timestamps = []
-unique_labels = set()
-submitters = defaultdict(int)
 
-for df in tqdm(all_df):
-    df['update_date_ts'] = pd.to_datetime(df.update_date, format="%Y-%m-%d").view(
-        'int64') // 10 ** 9
-    timestamps.extend(df.update_date_ts.to_list())
-    df['labels'] = df.categories.apply(str.split)
+def enrich(records: List[dict]) -> List[dict]:
+    timestamps = np.array([record["update_date"] for record in records], dtype="datetime64[s]").astype(np.int64)
+    for record, timestamp in zip(records, timestamps.tolist()):
+        record["update_date_ts"] = timestamp
+        record["labels"] = record["categories"].split()
+    return records
 
-    for label_list in df.labels.values:
-        for label in label_list:
-            unique_labels.add(label)
 
-    for submitter, count in df.submitter.value_counts().iteritems():
-        submitters[submitter] += count
+def make_filters(stats: PayloadStats) -> dict:
+    timestamps = stats.fields["update_date_ts"].numbers
+    q25, q75 = timestamps.quantiles((0.25, 0.75))
+    submitters = stats.fields["submitter"].frequencies.top()
+    labels = stats.fields["labels"].frequencies.top()
+    return {
+        "timestamp_range": {"q25": int(q25), "q75": int(q75)},
+        "top_submitters": [submitter for submitter, count in submitters if count > MIN_SUBMITTER_PAPERS],
+        "labels": sorted(label for label, _ in labels),
+    }
 
-    with open("payloads.jsonl", "a") as fp:
-        df.to_json(fp, orient="records", lines=True)
 
-for df in tqdm(all_df):
-    timestamps.extend(df.update_date_ts.to_list())
-    all_labels = df.labels
-    for label_list in all_labels.values:
-        for label in label_list:
-            unique_labels.add(label)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare arxiv payloads, statistics and filters")
+    parser.add_argument("--source", default=os.path.join(DATA_DIR, "arxiv", "metadata.jsonl"),
+                        help="raw arxiv metadata with update_date, categories and submitter")
+    parser.add_argument("--payloads", default=os.path.join(DATA_DIR, "arxiv", "payloads.jsonl"))
+    parser.add_argument("--stats", default=os.path.join(DATA_DIR, "arxiv", "stats.json"))
+    parser.add_argument("--filters", default=os.path.join(DATA_DIR, "arxiv", "filters.json"))
+    parser.add_argument("--parallel", type=int, default=os.cpu_count())
+    args = parser.parse_args()
 
-    for submitter, count in df.submitter.value_counts().iteritems():
-        submitters[submitter] += count
-
-np_timestamps = np.array(timestamps)
-submitters = pd.Series(submitters)
-
-q25 = np.quantile(np_timestamps, 0.25)
-q75 = np.quantile(np_timestamps, 0.75)
-
-final = {
-    "timestamp_range": {"q25": int(q25), "q75": int(q75)},
-    "top_submitters": submitters[submitters > 25].index.to_list(),
-    "labels": list(unique_labels),
-}
-
-with open("filters.json", "w") as fp:
-    json.dump(final, fp, indent=2)
+    stats = build_stats(
+        args.source,
+        parallel=args.parallel,
+        frequency_fields=FREQUENCY_FIELDS,
+        exact_fields=EXACT_FIELDS,
+        transform=enrich,
+        output=args.payloads,
+    )
+    save_stats(stats, args.stats, top=1000)
+    with open(args.filters, "w") as fp:
+        json.dump(make_filters(stats), fp, indent=2)
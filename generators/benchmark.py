@@ -0,0 +1,301 @@
+"""
+Benchmarks of the generation hot paths on synthetic data, built in process, no network or data files needed.
+
+    python -m generators.benchmark run --output baseline.json
+    python -m generators.benchmark run --output current.json --sizes 10000 100000 --dims 100
+    python -m generators.benchmark compare baseline.json current.json --threshold 0.2
+
+`compare` exits with a non-zero code if any benchmark is slower than the baseline by more than `threshold`.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from generators.filters import FilterEvaluator, MaskCache
+from generators.generate import DataGenerator, generate_samples
+from generators.ground_truth import ExactSearch, top_k
+from generators.output import encode_records
+from generators.random_data.generate_random_datasets import VARIANTS
+
+SIZES = (10_000, 100_000, 1_000_000)
+DIMS = (100, 384, 2048)
+# Shapes with more float32 elements are skipped, 1M x 2048 does not fit a typical CPU box
+MAX_ELEMENTS = 512 * 1024 * 1024
+# Single condition, two conditions on different fields joined by `and`, two conditions on one field joined by `or`,
+# a nested tree: `a and (b or not a)`
+COMPOSITIONS = ("single", "and", "or", "nested")
+
+SEED = 42
+NUM_CONDITIONS = 20
+NUM_QUERIES = 100
+CHECK_ROWS = 20_000
+REGRESSION_THRESHOLD = 0.2
+
+
+class Fixture:
+    """
+    Synthetic dataset of one variant and shape, with a fixed set of conditions and queries.
+    """
+
+    def __init__(self, variant: str, size: int, dim: int, seed: int = SEED):
+        self.variant = variant
+        self.size = size
+        self.dim = dim
+        self.generator = DataGenerator(seed=seed)
+        payload_gen, self.condition_gen = VARIANTS[variant](self.generator)
+        self.vectors = self.generator.random_vectors(size, dim)
+        self.payloads = [payload_gen() for _ in range(size)]
+        self.queries = self.generator.random_vectors(NUM_QUERIES, dim)
+        self.evaluator = FilterEvaluator(self.payloads)
+        self.search = ExactSearch(self.vectors)
+
+    def conditions(self, composition: str) -> List[dict]:
+        conditions = []
+        for _ in range(NUM_CONDITIONS):
+            if composition == "single":
+                conditions.append({"and": [{"a": self.condition_gen()}]})
+            elif composition == "and":
+                conditions.append({"and": [{"a": self.condition_gen()}, {"b": self.condition_gen()}]})
+            elif composition == "or":
+                conditions.append({"or": [{"a": self.condition_gen()}, {"a": self.condition_gen()}]})
+            else:
+                conditions.append({"and": [
+                    {"a": self.condition_gen()},
+                    {"or": [{"b": self.condition_gen()}, {"not": [{"a": self.condition_gen()}]}]},
+                ]})
+        return conditions
+
+
+def measure(function: Callable[[], None], repeats: int) -> float:
+    """
+    Median wall time of `repeats` runs, after one warm-up run.
+    """
+    function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def bench_check_conditions(fixture: Fixture, conditions: List[dict]):
+    payloads = fixture.payloads[:CHECK_ROWS]
+
+    def run():
+        for condition in conditions[:2]:
+            for payload in payloads:
+                fixture.generator.check_conditions(payload, condition)
+
+    return run, 2 * len(payloads)
+
+
+def bench_filter(fixture: Fixture, conditions: List[dict]):
+    def run():
+        # Cold cache, every condition is evaluated over the columns
+        fixture.evaluator.cache = MaskCache()
+        for condition in conditions:
+            fixture.evaluator.bitset(condition)
+
+    return run, len(conditions)
+
+
+def bench_search(fixture: Fixture, conditions: List[dict]):
+    bitsets = [fixture.evaluator.bitset(condition) for condition in conditions]
+
+    def run():
+        # Conditions are cycled, so every query is searched
+        for i, query in enumerate(fixture.queries):
+            fixture.generator.search(fixture.vectors, fixture.payloads, query, top=25, mask=bitsets[i % len(bitsets)])
+
+    return run, len(fixture.queries)
+
+
+def bench_search_grouped(fixture: Fixture, conditions: List[dict]):
+    query_conditions = [conditions[i % len(conditions)] for i in range(len(fixture.queries))]
+
+    def run():
+        fixture.search.search_grouped(fixture.queries, query_conditions, fixture.evaluator, top=25)
+
+    return run, len(query_conditions)
+
+
+def bench_top_k(fixture: Fixture):
+    scores = np.random.default_rng(SEED).random(fixture.size, dtype=np.float32)
+
+    def run():
+        for _ in range(10):
+            top_k(scores, 25)
+
+    return run, 10
+
+
+def bench_encode(fixture: Fixture):
+    records = [
+        {
+            "query": query,
+            "conditions": {"and": [{"a": fixture.condition_gen()}]},
+            "closest_ids": list(range(25)),
+            "closest_scores": [0.5] * 25,
+        }
+        for query in fixture.queries
+    ]
+
+    def run():
+        encode_records(records)
+
+    return run, len(records)
+
+
+def bench_generate_samples(fixture: Fixture):
+    def run():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            generate_samples(
+                generator=DataGenerator(seed=SEED),
+                num_queries=NUM_QUERIES,
+                dim=fixture.dim,
+                vectors=fixture.vectors,
+                payloads=fixture.payloads,
+                path=os.path.join(tmp_dir, "tests.jsonl"),
+                condition_generator=fixture.condition_gen,
+                batch_size=NUM_QUERIES,
+                # A fixed digest keeps fingerprinting of the inputs out of the measurement
+                inputs_digest="benchmark",
+                # Progress bars and plan summaries would be measured and clutter the output
+                verbose=False,
+            )
+
+    return run, NUM_QUERIES
+
+
+# Benchmarks depending on the filter, run for every composition of conditions
+CONDITION_BENCHMARKS = {
+    "check_conditions": bench_check_conditions,
+    "filter": bench_filter,
+    "search": bench_search,
+    "search_grouped": bench_search_grouped,
+}
+# Benchmarks run once per variant and shape, `generate_samples` is the end-to-end one
+FIXTURE_BENCHMARKS = {
+    "top_k": bench_top_k,
+    "encode": bench_encode,
+    "generate_samples": bench_generate_samples,
+}
+
+
+def run_benchmarks(
+        sizes=SIZES,
+        dims=DIMS,
+        variants=tuple(VARIANTS),
+        names: Optional[List[str]] = None,
+        repeats: int = 3,
+) -> dict:
+    results = {}
+    for size in sizes:
+        for dim in dims:
+            if size * dim > MAX_ELEMENTS:
+                print(f"Skipping {size}x{dim}, more than {MAX_ELEMENTS} elements", file=sys.stderr)
+                continue
+            for variant in variants:
+                fixture = Fixture(variant, size, dim)
+                cases = []
+                for composition in COMPOSITIONS:
+                    conditions = fixture.conditions(composition)
+                    for name, benchmark in CONDITION_BENCHMARKS.items():
+                        cases.append((f"{name}/{variant}/{composition}", benchmark, (fixture, conditions)))
+                for name, benchmark in FIXTURE_BENCHMARKS.items():
+                    cases.append((f"{name}/{variant}", benchmark, (fixture,)))
+
+                for case_name, benchmark, args in cases:
+                    if names and case_name.split("/")[0] not in names:
+                        continue
+                    key = f"{case_name}/size={size}/dim={dim}"
+                    function, ops = benchmark(*args)
+                    seconds = measure(function, repeats)
+                    results[key] = {"seconds": seconds, "ops": ops, "ops_per_second": ops / seconds}
+                    print(f"{key}: {seconds * 1000:.2f} ms, {ops / seconds:.1f} ops/s", file=sys.stderr)
+    return {
+        "machine": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """
+    Print the relative change of every benchmark present in both reports, return keys of regressions:
+    benchmarks whose time grew by more than `threshold`.
+    """
+    if baseline["machine"] != current["machine"]:
+        print("Warning: reports come from different machines or environments", file=sys.stderr)
+
+    regressions = []
+    for key in sorted(baseline["results"]):
+        if key not in current["results"]:
+            continue
+        before = baseline["results"][key]["seconds"]
+        after = current["results"][key]["seconds"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(key)
+        elif change < -threshold:
+            flag = "improved"
+        print(f"{key:70s} {before * 1000:10.2f} ms {after * 1000:10.2f} ms {change:+8.1%} {flag}")
+
+    missing = sorted(set(baseline["results"]) - set(current["results"]))
+    if missing:
+        print(f"{len(missing)} benchmarks of the baseline were not run", file=sys.stderr)
+    return regressions
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the dataset generation hot paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks and write a JSON report")
+    run_parser.add_argument("--output", required=True)
+    run_parser.add_argument("--sizes", nargs="+", type=int, default=list(SIZES))
+    run_parser.add_argument("--dims", nargs="+", type=int, default=list(DIMS))
+    run_parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=list(VARIANTS))
+    run_parser.add_argument("--benchmarks", nargs="+", choices=[*CONDITION_BENCHMARKS, *FIXTURE_BENCHMARKS])
+    run_parser.add_argument("--repeats", type=int, default=3)
+
+    compare_parser = commands.add_parser("compare", help="compare a report to a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        report = run_benchmarks(args.sizes, args.dims, args.variants, args.benchmarks, args.repeats)
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.baseline) as fd:
+        baseline = json.load(fd)
+    with open(args.current) as fd:
+        current = json.load(fd)
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions above {args.threshold:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+from typing import Iterator
+
+import numpy as np
+
+WORD_BITS = 64
+
+# Per-byte popcount, used when numpy does not provide `bitwise_count` (numpy < 2.0)
+_BYTE_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def _popcount(words: np.ndarray) -> int:
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+    return int(_BYTE_POPCOUNT[words.view(np.uint8)].sum(dtype=np.int64))
+
+
+class Bitset:
+    """
+    Set of row ids packed into 64-bit words, one bit per row.
+    Row `i` is bit `i % 64` of word `i // 64`. Bits beyond `size` are always zero.
+    """
+
+    __slots__ = ("words", "size")
+
+    def __init__(self, words: np.ndarray, size: int):
+        self.words = words
+        self.size = size
+
+    @staticmethod
+    def _num_words(size: int) -> int:
+        return (size + WORD_BITS - 1) // WORD_BITS
+
+    @classmethod
+    def zeros(cls, size: int) -> "Bitset":
+        return cls(np.zeros(cls._num_words(size), dtype=np.uint64), size)
+
+    @classmethod
+    def ones(cls, size: int) -> "Bitset":
+        bitset = cls(np.full(cls._num_words(size), np.iinfo(np.uint64).max, dtype=np.uint64), size)
+        bitset._clear_tail()
+        return bitset
+
+    @classmethod
+    def from_mask(cls, mask: np.ndarray) -> "Bitset":
+        size = len(mask)
+        packed = np.packbits(mask, bitorder="little")
+        padded = np.zeros(cls._num_words(size) * 8, dtype=np.uint8)
+        padded[:len(packed)] = packed
+        return cls(padded.view(np.uint64), size)
+
+    @classmethod
+    def from_indices(cls, indices: np.ndarray, size: int) -> "Bitset":
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) * WORD_BITS > size:
+            # Scattered updates are slow, packing a mask is cheaper unless the set is very sparse
+            mask = np.zeros(size, dtype=bool)
+            mask[indices] = True
+            return cls.from_mask(mask)
+        packed = np.zeros(cls._num_words(size) * 8, dtype=np.uint8)
+        np.bitwise_or.at(packed, indices >> 3, (1 << (indices & 7)).astype(np.uint8))
+        return cls(packed.view(np.uint64), size)
+
+    def to_mask(self) -> np.ndarray:
+        return np.unpackbits(self.words.view(np.uint8), count=self.size, bitorder="little").view(bool)
+
+    def to_indices(self) -> np.ndarray:
+        """
+        Sorted ids of set rows. Only non-empty words are unpacked, so sparse sets are cheap.
+        """
+        non_empty = np.flatnonzero(self.words)
+        if len(non_empty) * 8 > len(self.words):
+            # Most words are set, scanning an unpacked mask is faster than locating bits word by word
+            return np.flatnonzero(self.to_mask())
+        bits = np.unpackbits(self.words[non_empty].view(np.uint8), bitorder="little").reshape(-1, WORD_BITS)
+        word_ids, bit_ids = np.nonzero(bits)
+        return non_empty[word_ids] * WORD_BITS + bit_ids
+
+    def contains(self, ids: np.ndarray) -> np.ndarray:
+        """
+        Membership of each of `ids`, without unpacking the whole set.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        return ((self.words[ids >> 6] >> (ids & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+    def count(self) -> int:
+        return _popcount(self.words)
+
+    def any(self) -> bool:
+        return bool(self.words.any())
+
+    @property
+    def nbytes(self) -> int:
+        return self.words.nbytes
+
+    def _clear_tail(self):
+        tail = self.size % WORD_BITS
+        if tail:
+            self.words[-1] &= np.uint64((1 << tail) - 1)
+
+    def _check_size(self, other: "Bitset"):
+        if self.size != other.size:
+            raise ValueError(f"Bitset sizes differ: {self.size} != {other.size}")
+
+    def __and__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        return Bitset(self.words & other.words, self.size)
+
+    def __or__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        return Bitset(self.words | other.words, self.size)
+
+    def __xor__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        return Bitset(self.words ^ other.words, self.size)
+
+    def __sub__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        return Bitset(self.words & ~other.words, self.size)
+
+    def __invert__(self) -> "Bitset":
+        result = Bitset(~self.words, self.size)
+        result._clear_tail()
+        return result
+
+    def __iand__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        np.bitwise_and(self.words, other.words, out=self.words)
+        return self
+
+    def __ior__(self, other: "Bitset") -> "Bitset":
+        self._check_size(other)
+        np.bitwise_or(self.words, other.words, out=self.words)
+        return self
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitset) and self.size == other.size and np.array_equal(self.words, other.words)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.to_indices().tolist())
+
+    def __repr__(self) -> str:
+        return f"Bitset(size={self.size}, count={self.count()})"
@@ -0,0 +1,139 @@
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import shutil
+import types
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Iterator
+
+from generators.config import BUILD_CACHE_DIR
+
+# Modules whose code determines the ground truth of generated tests
+SEARCH_MODULES = (
+    "generators.bitset",
+    "generators.filters",
+    "generators.ground_truth",
+    "generators.metrics",
+    "generators.planner",
+)
+
+
+def describe_callable(fn: Callable) -> Any:
+    """
+    JSON-serializable description of a payload or condition generator, stable across runs.
+    Lambdas, functions and methods are described by their code, other callables by their repr and the source
+    of their class, so editing them invalidates the cache.
+    """
+    if isinstance(fn, partial):
+        return {
+            "partial": describe_callable(fn.func),
+            "args": [repr(arg) for arg in fn.args],
+            "keywords": {key: repr(value) for key, value in sorted(fn.keywords.items())},
+        }
+    if isinstance(fn, types.MethodType):
+        return {
+            "method": f"{type(fn.__self__).__module__}.{fn.__qualname__}",
+            # Methods usually call others of the same object, so the whole class is described
+            "code": source_fingerprint(type(fn.__self__)),
+        }
+    if isinstance(fn, types.FunctionType):
+        return {"function": f"{fn.__module__}.{fn.__qualname__}", "code": _describe_code(fn.__code__)}
+    return {"callable": repr(fn), "code": source_fingerprint(type(fn))}
+
+
+def _describe_code(code: types.CodeType) -> str:
+    hasher = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        hasher.update(_describe_code(const).encode() if isinstance(const, types.CodeType) else repr(const).encode())
+    hasher.update(repr(code.co_names).encode())
+    return hasher.hexdigest()
+
+
+def source_fingerprint(*objects: Any) -> str:
+    """
+    Hash of the source code of modules (or their names), classes and functions which a stage runs,
+    stored in stage keys so that editing the code rebuilds the stage instead of reusing stale artifacts.
+    """
+    hasher = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, str):
+            obj = importlib.import_module(obj)
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            # Builtins and objects defined interactively have no source file
+            source = repr(obj)
+        hasher.update(f"{getattr(obj, '__qualname__', getattr(obj, '__name__', ''))}\n{source}".encode())
+    return hasher.hexdigest()[:32]
+
+
+def file_fingerprint(path: str) -> dict:
+    """
+    Cheap fingerprint of an input file which is not produced by the build cache itself.
+    """
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def fingerprint(key: dict) -> str:
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:32]
+
+
+class Stage:
+    """
+    Artifacts of a single build step, stored under `<cache>/<name>/<fingerprint of key>`.
+    The directory only appears once the step has finished, so a stale or interrupted build is never reused.
+    """
+
+    def __init__(self, root: str, name: str, key: dict):
+        self.name = name
+        self.key = key
+        self.digest = fingerprint(key)
+        self.path = os.path.join(root, name, self.digest)
+
+    @property
+    def done(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def build(self) -> Iterator[str]:
+        """
+        Yields a working directory for the stage artifacts.
+        The working directory is stable, so a step which checkpoints its progress can resume after a crash.
+        """
+        work_dir = f"{self.path}.partial"
+        os.makedirs(work_dir, exist_ok=True)
+        yield work_dir
+        with open(os.path.join(work_dir, "key.json"), "w") as out:
+            json.dump(self.key, out, indent=2, sort_keys=True, default=str)
+        os.replace(work_dir, self.path)
+
+    def link(self, name: str, target: str):
+        """
+        Expose the artifact at `target`, sharing the data with the cache whenever the filesystem allows it.
+        """
+        if os.path.exists(target) and os.path.samefile(self.file(name), target):
+            return
+        tmp_target = f"{target}.tmp"
+        if os.path.lexists(tmp_target):
+            os.remove(tmp_target)
+        try:
+            os.link(self.file(name), tmp_target)
+        except OSError:
+            shutil.copyfile(self.file(name), tmp_target)
+        os.replace(tmp_target, target)
+
+
+class BuildCache:
+
+    def __init__(self, root: str = BUILD_CACHE_DIR):
+        self.root = root
+
+    def stage(self, name: str, **key) -> Stage:
+        return Stage(self.root, name, key)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+from typing import Any, Iterable, List, Optional
+
+import numpy as np
+
+from generators.build_cache import file_fingerprint
+from generators.dataset import JsonLines
+from generators.filters import PayloadColumns
+
+# Rows of arrays and lists which identify them in input fingerprints
+DIGEST_SAMPLE_ROWS = 1024
+
+
+def atomic_write(path: str, data: bytes):
+    """
+    Write `data` to `path` so that readers observe either the old file or the complete new one.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(data)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+
+
+class BatchCheckpoint:
+    """
+    Directory of numbered output batches, each committed together with the RNG state
+    that was current after the batch was produced.
+
+    Layout:
+        <dir>/manifest.json          - parameters of the run, parts are discarded if they change
+        <dir>/batch_000000.jsonl     - output lines of the batch
+        <dir>/batch_000000.state     - pickled RNG state, written last and marks the batch as complete
+    """
+
+    def __init__(self, directory: str, manifest: dict):
+        self.directory = directory
+        self.manifest = manifest
+
+    def _lines_path(self, batch_id: int) -> str:
+        return os.path.join(self.directory, f"batch_{batch_id:06d}.jsonl")
+
+    def _state_path(self, batch_id: int) -> str:
+        return os.path.join(self.directory, f"batch_{batch_id:06d}.state")
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.directory, "manifest.json")
+
+    def open(self) -> int:
+        """
+        Prepare the checkpoint directory for a run.
+
+        Returns:
+            Number of leading batches which are already complete
+        """
+        manifest_path = self._manifest_path()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fd:
+                if json.load(fd) != self.manifest:
+                    print(f"Checkpoint {self.directory} was created with different parameters, starting over")
+                    shutil.rmtree(self.directory)
+
+        os.makedirs(self.directory, exist_ok=True)
+        atomic_write(manifest_path, json.dumps(self.manifest, sort_keys=True).encode())
+
+        completed = 0
+        while os.path.exists(self._state_path(completed)):
+            completed += 1
+        return completed
+
+    def load_state(self, batch_id: int) -> Any:
+        """
+        RNG state committed with a complete batch.
+        """
+        with open(self._state_path(batch_id), "rb") as fd:
+            return pickle.load(fd)
+
+    def commit(self, batch_id: int, lines: Iterable[str], state: Any):
+        atomic_write(self._lines_path(batch_id), "".join(lines).encode())
+        # State file is the completion marker, so it goes last
+        atomic_write(self._state_path(batch_id), pickle.dumps(state))
+
+    def merge(self, num_batches: int, path: str):
+        """
+        Concatenate all batches into `path` and remove the checkpoint directory.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as out:
+            for batch_id in range(num_batches):
+                with open(self._lines_path(batch_id), "rb") as part:
+                    shutil.copyfileobj(part, out)
+        os.replace(tmp_path, path)
+        shutil.rmtree(self.directory)
+
+
+def batch_ranges(total: int, batch_size: int) -> List[range]:
+    return [range(start, min(start + batch_size, total)) for start in range(0, total, batch_size)]
+
+
+def digest_inputs(*items: Optional[Any]) -> str:
+    """
+    Cheap fingerprint of generation inputs, which does not read them in full: arrays and lists are identified
+    by their shape and type and a sample of evenly strided rows, `PayloadColumns` by their column arrays,
+    `JsonLines` by the path, size and modification time of the file and the lines they cover,
+    anything else by its JSON representation.
+    Changes outside the sampled rows are not detected, pass an explicit digest for inputs edited in place.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for item in items:
+        _digest_item(hasher, item)
+    return hasher.hexdigest()
+
+
+def _sample_positions(size: int) -> np.ndarray:
+    return np.unique(np.linspace(0, size - 1, num=min(size, DIGEST_SAMPLE_ROWS), dtype=np.int64))
+
+
+def _digest_item(hasher, item: Any):
+    if isinstance(item, PayloadColumns):
+        if item.payloads is not None:
+            # Columns are extracted lazily, the payloads they come from are fingerprinted instead
+            _digest_item(hasher, item.payloads)
+            return
+        hasher.update(str(len(item)).encode())
+        for field, (kind, column) in sorted(item.columns.items()):
+            hasher.update(f"{field}:{kind}".encode())
+            for values in column:
+                _digest_item(hasher, values)
+    elif isinstance(item, JsonLines):
+        hasher.update(json.dumps(file_fingerprint(item.path), sort_keys=True).encode())
+        if item._starts is not None:
+            # A slice of the file
+            _digest_item(hasher, item._starts)
+    elif isinstance(item, np.ndarray):
+        hasher.update(str((item.shape, item.dtype.str)).encode())
+        sample = item[_sample_positions(len(item))] if item.ndim > 0 and len(item) > 0 else item
+        if sample.dtype == object:
+            hasher.update(json.dumps(sample.tolist(), sort_keys=True, default=str).encode())
+        else:
+            hasher.update(memoryview(np.ascontiguousarray(sample)).cast("B"))
+    elif isinstance(item, list) and len(item) > DIGEST_SAMPLE_ROWS:
+        hasher.update(f"list:{len(item)}".encode())
+        sample = [item[position] for position in _sample_positions(len(item))]
+        hasher.update(json.dumps(sample, sort_keys=True).encode())
+    else:
+        hasher.update(json.dumps(item, sort_keys=True).encode())
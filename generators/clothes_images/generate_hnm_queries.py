@@ -1,19 +1,19 @@
-import json
-import os
-import random
 from typing import List, Dict
 
 import numpy as np
 from tqdm import tqdm
 
-from generators.config import DATA_DIR
+from generators.dataset import Dataset, write_metadata
+from generators.filters import FilterEvaluator
 from generators.generate import DataGenerator
+from generators.ground_truth import ExactSearch, ScoredQuery
+from generators.output import RecordWriter
 
 
-def generate_query(filters: Dict[str, list]):
+def generate_query(filters: Dict[str, list], rng: np.random.Generator):
     fields = list(filters.keys())
-    field = random.choice(fields)
-    value = random.choice(filters[field])
+    field = fields[rng.integers(len(fields))]
+    value = filters[field][rng.integers(len(filters[field]))]
     return {
         "and": [
             {
@@ -32,58 +32,66 @@ def generate_hnm_queries(
         payloads: List[dict],
         filters: Dict[str, list],
         num_queries: int,
-        path
+        path,
+        seed=None,
+        tests_per_vector=1,
+        precision=None,
+        compression=None,
 ):
-    generator = DataGenerator()
-    with open(path, "w") as out:
-        for _ in tqdm(range(num_queries)):
-            ref_id = random.randint(0, len(vectors))
-            query_vector = vectors[ref_id]
-            query_filter = generate_query(filters=filters)
-
-            closest_ids, best_scores = generator.search(
-                vectors=vectors,
-                payloads=payloads,
-                query=query_vector,
-                conditions=query_filter,
-            )
-
-            out.write(json.dumps(
+    """
+    With `tests_per_vector` > 1 each reference vector is used for that many filters and scored only once.
+    `precision`, `compression` - see `RecordWriter`.
+    """
+    generator = DataGenerator(seed=seed)
+    rng = generator.rng
+
+    query_ids = []
+    query_filters = []
+    for i in range(num_queries):
+        if i % tests_per_vector == 0:
+            ref_id = rng.integers(len(vectors))
+        query_ids.append(ref_id)
+        query_filters.append(generate_query(filters=filters, rng=rng))
+
+    search = ExactSearch(vectors)
+    evaluator = FilterEvaluator(payloads)
+    if tests_per_vector == 1:
+        # Many queries share the same filter, each distinct filter is evaluated and gathered once
+        results = search.search_grouped(
+            queries=vectors[query_ids],
+            conditions=query_filters,
+            evaluator=evaluator,
+            top=25,
+        )
+    else:
+        results = []
+        for start in range(0, num_queries, tests_per_vector):
+            scored = ScoredQuery(search, vectors[query_ids[start]])
+            for query_filter in query_filters[start:start + tests_per_vector]:
+                results.append(scored.top(query_filter, evaluator, top=25))
+
+    with RecordWriter(path, precision=precision, compression=compression) as writer:
+        for ref_id, query_filter, (closest_ids, best_scores) in tqdm(zip(query_ids, query_filters, results),
+                                                                     total=num_queries):
+            writer.write(
                 {
-                    "query": query_vector.tolist(),
+                    "query": vectors[ref_id],
                     "conditions": query_filter,
                     "closest_ids": closest_ids,
                     "closest_scores": best_scores
                 }
-            ))
-
-            out.write("\n")
-
-
-def convert_filters(filters):
-    res = {}
-    for field in filters:
-        res[field['name']] = field['values']
-    return res
+            )
 
 
 if __name__ == '__main__':
-    vectors_path = os.path.join(DATA_DIR, "hnm", "vectors.npy")
-    vectors = np.load(vectors_path, allow_pickle=False)
-
-    payloads_path = os.path.join(DATA_DIR, "hnm", "payloads.jsonl")
-    payloads = []
-    with open(payloads_path) as fd:
-        for line in fd:
-            payloads.append(json.loads(line))
-
-    filters_path = os.path.join(DATA_DIR, "hnm", "filters.json")
-    filters = convert_filters(json.load(open(filters_path)))
+    dataset = Dataset.open("hnm")
 
     generate_hnm_queries(
-        vectors=vectors,
-        payloads=payloads,
-        filters=filters,
+        vectors=dataset.vectors,
+        payloads=dataset.payloads,
+        filters=dataset.filters,
         num_queries=10_000,
-        path=os.path.join(DATA_DIR, "hnm", "tests.jsonl")
+        path=dataset.file("tests.jsonl"),
+        seed=42,
     )
+    write_metadata(dataset.path, metric="cosine", top=25)
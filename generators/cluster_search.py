@@ -0,0 +1,162 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from generators.ground_truth import ExactSearch, candidate_band, rerank
+from generators.metrics import cosine_scores, score_error_bound
+
+# Slack added to cluster bounds, covers float64 rounding of the bound and float32 rounding of reported scores
+BOUND_SLACK = 1e-6
+
+
+def _unit_rows(chunk: np.ndarray) -> np.ndarray:
+    chunk = np.asarray(chunk, dtype=np.float64)
+    norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+    return chunk / np.where(norms == 0, 1, norms)
+
+
+class ClusterIndex:
+    """
+    IVF-style partitioning of unit-normalized vectors.
+
+    `order[offsets[c]:offsets[c + 1]]` are the sorted ids of cluster `c`, `radii[c]` is the largest
+    distance from a member to the centroid. For a unit query `q` every member `u` of the cluster
+    satisfies `u . q <= centroid . q + radius`, which bounds the cosine of the whole cluster.
+    """
+
+    def __init__(self, centroids: np.ndarray, radii: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.radii = radii
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(
+            cls,
+            vectors: np.ndarray,
+            num_clusters: int = None,
+            iterations: int = 10,
+            sample_size: int = 100_000,
+            seed: int = 0,
+            chunk_size: int = 100_000,
+    ) -> "ClusterIndex":
+        rng = np.random.default_rng(seed)
+        num_clusters = num_clusters or max(1, int(np.sqrt(len(vectors))))
+
+        # Lloyd's k-means on a sample, the bounds are valid for any centroids, good ones just prune more
+        sample_ids = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+        sample = _unit_rows(vectors[sample_ids])
+        centroids = sample[rng.choice(len(sample), size=min(num_clusters, len(sample)), replace=False)]
+        for _ in range(iterations):
+            assignment = cls._assign(sample, centroids)
+            counts = np.bincount(assignment, minlength=len(centroids))
+            non_empty = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+            sums = np.add.reduceat(sample[np.argsort(assignment, kind="stable")], starts, axis=0)
+            centroids[non_empty] = sums / counts[non_empty, None]
+
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        radii = np.zeros(len(centroids), dtype=np.float64)
+        for start in range(0, len(vectors), chunk_size):
+            chunk = _unit_rows(vectors[start:start + chunk_size])
+            chunk_assignment = cls._assign(chunk, centroids)
+            distances = np.linalg.norm(chunk - centroids[chunk_assignment], axis=1)
+            np.maximum.at(radii, chunk_assignment, distances)
+            assignment[start:start + chunk_size] = chunk_assignment
+
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=len(centroids)), out=offsets[1:])
+        return cls(centroids, radii, order, offsets)
+
+    @staticmethod
+    def _assign(rows: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        # argmin |u - c|^2 == argmax (2 u.c - |c|^2), float32 is enough to pick a close centroid
+        centroids = centroids.astype(np.float32)
+        scores = rows.astype(np.float32) @ centroids.T
+        scores *= 2
+        scores -= np.einsum("ij,ij->i", centroids, centroids)
+        return np.argmax(scores, axis=1)
+
+    def members(self, cluster: int) -> np.ndarray:
+        return self.order[self.offsets[cluster]:self.offsets[cluster + 1]]
+
+    def save(self, path: str):
+        np.savez(path, centroids=self.centroids, radii=self.radii, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path: str) -> "ClusterIndex":
+        data = np.load(path)
+        return cls(data["centroids"], data["radii"], data["order"], data["offsets"])
+
+    @classmethod
+    def open(cls, vectors_path: str) -> "ClusterIndex":
+        """
+        Cluster index sidecar of a `vectors.npy` file, built on first use.
+        """
+        path = f"{os.path.splitext(vectors_path)[0]}.clusters.npz"
+        if not os.path.exists(path):
+            cls.build(np.load(vectors_path, mmap_mode="r")).save(path)
+        return cls.load(path)
+
+
+class ClusterSearch(ExactSearch):
+    """
+    Exact search which visits clusters in order of their score bound and stops as soon as
+    no unvisited cluster can beat the current `top`-th score. The filter is applied to the members
+    of visited clusters only. Results are identical to `ExactSearch`.
+    """
+
+    def __init__(self, vectors: np.ndarray, index: ClusterIndex = None):
+        super().__init__(vectors)
+        self.index = index if index is not None else ClusterIndex.build(vectors)
+        self.visited_rows = 0
+
+    def search_one(self, query: np.ndarray, allowed: Optional[np.ndarray], top: int) -> Tuple[List[int], List[float]]:
+        query64 = np.asarray(query, dtype=np.float64)
+        query_unit = query64 / (np.linalg.norm(query64) or 1.0)
+        bounds = self.index.centroids @ query_unit + self.index.radii + BOUND_SLACK
+        radius = score_error_bound(self.vectors.shape[1])
+
+        visited_ids = []
+        visited_scores = []
+        best_lower = np.empty(0, dtype=np.float32)
+        for cluster in np.argsort(-bounds):
+            if len(best_lower) == top and bounds[cluster] < best_lower.min():
+                break
+            members = self.index.members(cluster)
+            if allowed is not None:
+                members = members[allowed[members]]
+            if len(members) == 0:
+                continue
+
+            scores = cosine_scores(query, self.vectors[members], self.norms[members])
+            visited_ids.append(members)
+            visited_scores.append(scores)
+
+            best_lower = np.concatenate([best_lower, scores - radius])
+            if len(best_lower) > top:
+                best_lower = np.partition(best_lower, len(best_lower) - top)[-top:]
+
+        if not visited_ids:
+            return [], []
+
+        ids = np.concatenate(visited_ids)
+        scores = np.concatenate(visited_scores)
+        self.visited_rows += len(ids)
+        # Rerank expects sorted candidates, so ties resolve to the lower id as in the brute force
+        candidates = np.sort(ids[candidate_band(scores, radius, top)])
+        return rerank(query, candidates, self.vectors, self.norms, top)
+
+    def search_many(
+            self,
+            queries: np.ndarray,
+            ids: Optional[np.ndarray] = None,
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        allowed = None
+        if ids is not None:
+            allowed = np.zeros(len(self.vectors), dtype=bool)
+            allowed[ids] = True
+        return [self.search_one(query, allowed, top) for query in np.asarray(queries)]
@@ -3,3 +3,4 @@ import os
 CODE_DIR = os.path.dirname(__file__)
 ROOT_DIR = os.path.dirname(CODE_DIR)
 DATA_DIR = os.path.join(ROOT_DIR, 'data')
+BUILD_CACHE_DIR = os.path.join(DATA_DIR, '.cache')
@@ -0,0 +1,363 @@
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from generators.config import DATA_DIR
+from generators.filters import FilterEvaluator, PayloadColumns
+
+VECTORS_FILE = "vectors.npy"
+PAYLOADS_FILE = "payloads.jsonl"
+TESTS_FILE = "tests.jsonl"
+FILTERS_FILE = "filters.json"
+METADATA_FILE = "metadata.json"
+STATS_FILE = "stats.json"
+COLUMNS_DIR = "columns"
+COLUMNS_MANIFEST = "manifest.json"
+
+SCAN_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def write_metadata(path: str, **fields):
+    """
+    Write `metadata.json` of the dataset directory `path`, e.g. the metric of its ground truth.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, METADATA_FILE), "w") as out:
+        json.dump(fields, out, indent=2, sort_keys=True)
+
+
+class ColumnWriter:
+    """
+    Writes `PayloadColumns` columns of `size` rows into a column store directory chunk by chunk.
+    Every array is a memory-mapped `.npy` file, so neither the writer nor the readers hold whole columns in memory.
+    Chunks must be written in order, keyword dictionaries must be the same in every chunk,
+    object columns can not be stored.
+    """
+
+    def __init__(self, path: str, size: int):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.size = size
+        self.fields: Dict[str, dict] = {}
+        self.arrays: Dict[str, list] = {}
+
+    def _open(self, field: str, kind: str, column: tuple) -> list:
+        if kind == "object":
+            raise ValueError(f"Object column {field} can not be stored, only numbers, keywords and geo points")
+        files = [f"column_{len(self.fields)}_{i}.npy" for i in range(len(column))]
+        self.fields[field] = {"kind": kind, "files": files}
+        paths = [os.path.join(self.path, file_name) for file_name in files]
+        if kind == "keyword":
+            # Dictionary is small and shared by all chunks
+            np.save(paths[0], np.asarray(column[0], dtype=str))
+            return [np.asarray(column[0]), self._open_memmap(paths[1], column[1].dtype, (self.size,))]
+        if kind == "multi_keyword":
+            np.save(paths[0], np.asarray(column[0], dtype=str))
+            offsets = self._open_memmap(paths[1], np.int64, (self.size + 1,))
+            offsets[0] = 0
+            # The number of codes is known only at the end, they are appended raw and given a header on close
+            return [np.asarray(column[0]), offsets, open(f"{paths[2]}.partial", "wb")]
+        return [
+            self._open_memmap(file_path, values.dtype, (self.size,) + values.shape[1:])
+            for file_path, values in zip(paths, column)
+        ]
+
+    @staticmethod
+    def _open_memmap(path: str, dtype, shape: tuple) -> np.memmap:
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def write(self, start: int, columns: Dict[str, Tuple[str, tuple]]):
+        for field, (kind, column) in columns.items():
+            if field not in self.arrays:
+                self.arrays[field] = self._open(field, kind, column)
+            arrays = self.arrays[field]
+            if kind in ("keyword", "multi_keyword") and not np.array_equal(arrays[0], column[0]):
+                raise ValueError(f"Keyword dictionary of {field} changed between chunks")
+            if kind == "keyword":
+                codes = column[1]
+                arrays[1][start:start + len(codes)] = codes
+            elif kind == "multi_keyword":
+                _, offsets, codes = column
+                arrays[1][start + 1:start + len(offsets)] = offsets[1:] + arrays[1][start]
+                arrays[2].write(np.ascontiguousarray(codes, dtype=np.int32).tobytes())
+            else:
+                for target, values in zip(arrays, column):
+                    target[start:start + len(values)] = values
+
+    def close(self):
+        for field, arrays in self.arrays.items():
+            for array in arrays:
+                if isinstance(array, np.memmap):
+                    array.flush()
+            if self.fields[field]["kind"] == "multi_keyword":
+                self._finish_codes(arrays[2], os.path.join(self.path, self.fields[field]["files"][2]))
+        self.arrays = {}
+        with open(os.path.join(self.path, COLUMNS_MANIFEST), "w") as out:
+            json.dump({"size": self.size, "fields": self.fields}, out, indent=2)
+
+    @staticmethod
+    def _finish_codes(partial_file, path: str):
+        partial_file.close()
+        count = os.path.getsize(partial_file.name) // np.dtype(np.int32).itemsize
+        with open(path, "wb") as out, open(partial_file.name, "rb") as codes:
+            np.lib.format.write_array_header_1_0(out, {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(np.int32)),
+                "fortran_order": False,
+                "shape": (count,),
+            })
+            shutil.copyfileobj(codes, out, SCAN_CHUNK_BYTES)
+        os.remove(partial_file.name)
+
+    def __enter__(self) -> "ColumnWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+def open_columns(path: str) -> PayloadColumns:
+    """
+    Columns of a store written by `ColumnWriter`, memory-mapped.
+    """
+    with open(os.path.join(path, COLUMNS_MANIFEST)) as fd:
+        manifest = json.load(fd)
+    columns = {}
+    for field, description in manifest["fields"].items():
+        arrays = tuple(
+            np.load(os.path.join(path, file_name), mmap_mode="r", allow_pickle=False)
+            for file_name in description["files"]
+        )
+        if description["kind"] in ("keyword", "multi_keyword"):
+            arrays = (np.asarray(arrays[0]),) + arrays[1:]
+        columns[field] = (description["kind"], arrays)
+    return PayloadColumns.from_columns(columns, manifest["size"])
+
+
+class JsonLines:
+    """
+    Read-only sequence over a JSON lines file. The file is memory-mapped and line offsets are found
+    with a vectorized scan on first access, so only the lines which are actually indexed get decoded.
+    Slicing returns a view over the same file.
+    """
+
+    def __init__(self, path: str, starts: np.ndarray = None, ends: np.ndarray = None):
+        self.path = path
+        self._starts = starts
+        self._ends = ends
+        self._data: Optional[np.ndarray] = None
+
+    @property
+    def data(self) -> np.ndarray:
+        if self._data is None:
+            if os.path.getsize(self.path) == 0:
+                self._data = np.empty(0, dtype=np.uint8)
+            else:
+                self._data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return self._data
+
+    def _offsets(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._starts is None:
+            # Scan in chunks, a comparison over the whole file would allocate a byte per byte of it
+            newlines = np.concatenate([np.empty(0, dtype=np.int64)] + [
+                np.flatnonzero(self.data[start:start + SCAN_CHUNK_BYTES] == ord("\n")) + start
+                for start in range(0, len(self.data), SCAN_CHUNK_BYTES)
+            ])
+            starts = np.concatenate([[0], newlines + 1])
+            ends = np.concatenate([newlines, [len(self.data)]])
+            # Drop the empty tail after the last newline
+            non_empty = ends > starts
+            self._starts, self._ends = starts[non_empty], ends[non_empty]
+        return self._starts, self._ends
+
+    def __len__(self) -> int:
+        return len(self._offsets()[0])
+
+    def raw(self, index: int) -> bytes:
+        starts, ends = self._offsets()
+        return self.data[starts[index]:ends[index]].tobytes()
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]):
+        if isinstance(index, (int, np.integer)):
+            return json.loads(self.raw(index))
+        starts, ends = self._offsets()
+        view = type(self)(self.path, starts[index], ends[index])
+        view._data = self._data
+        return view
+
+    def __iter__(self) -> Iterator[dict]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def batches(self, batch_size: int) -> Iterator[List[dict]]:
+        for start in range(0, len(self), batch_size):
+            yield list(self[start:start + batch_size])
+
+
+class Tests(JsonLines):
+    """
+    Tests of a dataset, decoded lazily as records or into arrays.
+    """
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """
+        All tests as arrays: `query` (n x dim float32), `closest_ids` (n x top int64, padded with -1),
+        `closest_scores` (n x top float32, padded with NaN). Conditions stay records, see `conditions`.
+        """
+        records = list(self)
+        top = max((len(record["closest_ids"]) for record in records), default=0)
+        closest_ids = np.full((len(records), top), -1, dtype=np.int64)
+        closest_scores = np.full((len(records), top), np.nan, dtype=np.float32)
+        for i, record in enumerate(records):
+            closest_ids[i, :len(record["closest_ids"])] = record["closest_ids"]
+            closest_scores[i, :len(record["closest_scores"])] = record["closest_scores"]
+        return {
+            "query": np.array([record["query"] for record in records], dtype=np.float32),
+            "closest_ids": closest_ids,
+            "closest_scores": closest_scores,
+        }
+
+    def conditions(self) -> List[Optional[dict]]:
+        return [record["conditions"] for record in self]
+
+
+class Dataset:
+    """
+    Lazily opened dataset directory: `vectors.npy`, `payloads.jsonl`, `tests.jsonl`, optional `filters.json`
+    and `metadata.json`.
+    Opening does not read anything, vectors are memory-mapped, payloads and tests are decoded on access.
+
+        dataset = Dataset.open("arxiv")
+        dataset.vectors[:10]
+        dataset.column("label")
+        for vectors, payloads in dataset.batches(10_000): ...
+    """
+
+    def __init__(self, path: str):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Dataset directory not found: {path}")
+        self.path = path
+        self._vectors: Optional[np.ndarray] = None
+        self._payloads: Optional[JsonLines] = None
+        self._columns: Optional[PayloadColumns] = None
+        self._tests: Optional[Tests] = None
+        self._filters: Optional[dict] = None
+        self._metadata: Optional[dict] = None
+
+    @classmethod
+    def open(cls, name: str) -> "Dataset":
+        """
+        Open a dataset by path, or by name relative to `DATA_DIR`, e.g. `hnm` or `laion/small`.
+        """
+        if os.path.isdir(name):
+            return cls(name)
+        return cls(os.path.join(DATA_DIR, name))
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            self._vectors = np.load(self.file(VECTORS_FILE), mmap_mode="r", allow_pickle=False)
+        return self._vectors
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @property
+    def payloads(self) -> JsonLines:
+        if self._payloads is None:
+            self._payloads = JsonLines(self.file(PAYLOADS_FILE))
+        return self._payloads
+
+    @property
+    def columns(self) -> PayloadColumns:
+        """
+        Columnar payloads, memory-mapped from the `columns` store if the dataset has one,
+        otherwise each column is extracted from payloads on first use.
+        """
+        if self._columns is None:
+            if os.path.exists(self.file(os.path.join(COLUMNS_DIR, COLUMNS_MANIFEST))):
+                self._columns = open_columns(self.file(COLUMNS_DIR))
+            else:
+                self._columns = PayloadColumns(self.payloads)
+        return self._columns
+
+    def column(self, field: str) -> Tuple[str, tuple]:
+        return self.columns.column(field)
+
+    def evaluator(self) -> FilterEvaluator:
+        return FilterEvaluator(self.columns)
+
+    @property
+    def tests(self) -> Tests:
+        if self._tests is None:
+            self._tests = Tests(self.file(TESTS_FILE))
+        return self._tests
+
+    @property
+    def filters(self) -> dict:
+        """
+        Filters metadata. A list of `{"name": ..., "values": [...]}` is converted to a `{name: values}` dict.
+        """
+        if self._filters is None:
+            path = self.file(FILTERS_FILE)
+            filters = {}
+            if os.path.exists(path):
+                with open(path) as fd:
+                    filters = json.load(fd)
+            if isinstance(filters, list):
+                filters = {field["name"]: field["values"] for field in filters}
+            self._filters = filters
+        return self._filters
+
+    @property
+    def metadata(self) -> dict:
+        if self._metadata is None:
+            path = self.file(METADATA_FILE)
+            self._metadata = {}
+            if os.path.exists(path):
+                with open(path) as fd:
+                    self._metadata = json.load(fd)
+        return self._metadata
+
+    @property
+    def stats(self) -> Optional[dict]:
+        """
+        Payload statistics written by `generators.stats`, None if the dataset has none.
+        """
+        path = self.file(STATS_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fd:
+            return json.load(fd)
+
+    @property
+    def metric(self) -> str:
+        """
+        Metric of the ground truth, datasets without metadata are cosine.
+        """
+        return self.metadata.get("metric", "cosine")
+
+    def batches(self, batch_size: int, start: int = 0, stop: int = None) -> Iterator[Tuple[np.ndarray, List[dict]]]:
+        """
+        Rows `start:stop` as (vectors, payloads) batches, only the rows of the current batch are read.
+        Payloads are empty lists if the dataset has no payloads file.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        has_payloads = os.path.exists(self.file(PAYLOADS_FILE))
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(batch_start + batch_size, stop)
+            payloads = list(self.payloads[batch_start:batch_stop]) if has_payloads else []
+            yield np.asarray(self.vectors[batch_start:batch_stop]), payloads
+
+    def __repr__(self) -> str:
+        return f"Dataset({self.path!r})"
@@ -0,0 +1,298 @@
+"""
+Shape of a dataset, to interpret benchmark results on it:
+
+* payload fields - value types, distinct values and skew of the most frequent ones
+* tests - condition types, selectivity of conditions, sizes of results and gaps between neighbour scores
+* vectors - spread of norms and the norm of the mean direction
+* neighbourhoods - hubness and local intrinsic dimensionality, estimated on a sample of rows
+
+    python -m generators.dataset_report arxiv --output arxiv_report.json --html arxiv_report.html
+
+Vectors are read in chunks and every condition is evaluated once over payload columns, the quadratic parts only
+see `--sample` rows, so the 2M arxiv set takes minutes.
+"""
+import argparse
+import html
+import json
+import os
+from collections import Counter
+from typing import Dict, Optional
+
+import numpy as np
+
+from generators.dataset import PAYLOADS_FILE, Dataset
+from generators.ground_truth import canonical_conditions
+from generators.metrics import row_norms
+from generators.profiling import profiler
+from generators.stats import QUANTILES, build_stats
+from generators.workload import condition_type
+
+SAMPLE_SIZE = 10_000
+NEIGHBOURS = 10
+# Rows of the sample compared to all others at once
+SAMPLE_BLOCK = 1024
+VECTOR_CHUNK = 100_000
+# Upper edges of the selectivity histogram buckets
+SELECTIVITY_EDGES = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+
+def quantiles(values: np.ndarray) -> Dict[str, float]:
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {}
+    return dict(zip(map(str, QUANTILES), np.quantile(values, QUANTILES).tolist()))
+
+
+def summary(values: np.ndarray) -> dict:
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "min": float(values.min()),
+        "max": float(values.max()),
+        "mean": float(values.mean()),
+        "std": float(values.std()),
+        "quantiles": quantiles(values),
+    }
+
+
+def field_skew(stats: dict) -> Dict[str, dict]:
+    """
+    Per field: types, distinct values and the share of rows holding the most frequent values,
+    if their frequencies were tracked.
+    """
+    fields = {}
+    for field, field_stats in stats["fields"].items():
+        report = {
+            "types": field_stats["types"],
+            "distinct": field_stats["distinct"],
+        }
+        if "frequencies" in field_stats:
+            counts = [count for _, count in field_stats["frequencies"]]
+            report["top1_share"] = counts[0] / field_stats["count"] if counts else 0.0
+            report["top10_share"] = sum(counts[:10]) / field_stats["count"] if counts else 0.0
+            report["top_values"] = field_stats["frequencies"][:10]
+        if "quantiles" in field_stats:
+            report["quantiles"] = field_stats["quantiles"]
+        fields[field] = report
+    return fields
+
+
+def tests_report(dataset: Dataset) -> dict:
+    """
+    Condition types, selectivity of every distinct condition over all rows, result sizes and score gaps.
+    Gaps are absolute, so they are comparable for similarities and distances.
+    """
+    tests = list(dataset.tests)
+    if not tests:
+        return {"count": 0}
+    evaluator = dataset.evaluator()
+    selectivities = {}
+    test_selectivity = np.empty(len(tests))
+    with profiler().stage("selectivity", queries=len(tests)):
+        for test_id, test in enumerate(tests):
+            key = canonical_conditions(test["conditions"])
+            if key not in selectivities:
+                conditions = test["conditions"]
+                selectivities[key] = evaluator.bitset(conditions).count() / len(evaluator) if conditions else 1.0
+            test_selectivity[test_id] = selectivities[key]
+
+    histogram = np.bincount(np.searchsorted(SELECTIVITY_EDGES, test_selectivity), minlength=len(SELECTIVITY_EDGES))
+    sizes = np.array([len(test["closest_ids"]) for test in tests])
+    top = int(sizes.max())
+    gaps = {}
+    for rank in sorted({2, 10, top}):
+        scores = [test["closest_scores"] for test in tests if len(test["closest_scores"]) >= rank]
+        if rank > 1 and scores:
+            gaps[f"top1_top{rank}"] = summary(np.abs([s[0] - s[rank - 1] for s in scores]))
+    return {
+        "count": len(tests),
+        "distinct_conditions": len(selectivities),
+        "types": dict(Counter(condition_type(test["conditions"]) for test in tests).most_common()),
+        "selectivity": summary(test_selectivity),
+        "selectivity_histogram": {
+            f"<={edge:g}": int(count) for edge, count in zip(SELECTIVITY_EDGES, histogram[:len(SELECTIVITY_EDGES)])
+        },
+        "empty_results": int((sizes == 0).sum()),
+        "partial_results": int(((sizes > 0) & (sizes < top)).sum()),
+        "score_gaps": gaps,
+    }
+
+
+def vectors_report(vectors: np.ndarray) -> dict:
+    """
+    Norm spread and the norm of the mean unit vector: near 0 for isotropic data, near 1 if vectors share a direction.
+    """
+    with profiler().stage("norms", rows=len(vectors)):
+        norms = row_norms(vectors, VECTOR_CHUNK, replace_zeros=False)
+        direction = np.zeros(vectors.shape[1])
+        for start in range(0, len(vectors), VECTOR_CHUNK):
+            chunk = np.asarray(vectors[start:start + VECTOR_CHUNK], dtype=np.float64)
+            chunk_norms = norms[start:start + VECTOR_CHUNK]
+            direction += (chunk[chunk_norms > 0] / chunk_norms[chunk_norms > 0, None]).sum(axis=0)
+    nonzero = int((norms > 0).sum())
+    return {
+        "rows": len(vectors),
+        "dim": int(vectors.shape[1]),
+        "zero_vectors": len(vectors) - nonzero,
+        "norms": summary(norms),
+        "mean_direction_norm": float(np.linalg.norm(direction) / nonzero) if nonzero else 0.0,
+    }
+
+
+def sample_neighbours(sample: np.ndarray, k: int) -> tuple:
+    """
+    Euclidean distances and ids of the `k` nearest other rows of every sample row, within the sample.
+    """
+    sample = np.asarray(sample, dtype=np.float32)
+    squares = np.einsum("ij,ij->i", sample, sample)
+    distances = np.empty((len(sample), k), dtype=np.float64)
+    ids = np.empty((len(sample), k), dtype=np.int64)
+    for start in range(0, len(sample), SAMPLE_BLOCK):
+        block = sample[start:start + SAMPLE_BLOCK]
+        block_distances = squares[start:start + len(block), None] + squares[None] - 2 * block @ sample.T
+        block_distances[np.arange(len(block)), np.arange(start, start + len(block))] = np.inf
+        nearest = np.argpartition(block_distances, k, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(block_distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1)
+        ids[start:start + len(block)] = np.take_along_axis(nearest, order, axis=1)
+        distances[start:start + len(block)] = np.sqrt(np.maximum(np.take_along_axis(nearest_distances, order, axis=1), 0))
+    return distances, ids
+
+
+def neighbourhoods_report(vectors: np.ndarray, metric: str, sample_size: int, k: int, seed: int) -> dict:
+    """
+    Hubness: skewness of k-occurrences (how often a row is among the k nearest neighbours of others) in the sample,
+    large positive values mean a few hubs are neighbours of many rows. LID: maximum likelihood estimate
+    of Levina and Bickel from distances to k nearest neighbours. Both are on a uniform sample of rows, LID
+    estimates are scale invariant, so subsampling keeps them comparable. Cosine datasets are normalized first,
+    dot datasets use Euclidean neighbourhoods.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))
+    if len(rows) <= k:
+        return {"sample": len(rows), "k": k}
+    sample = np.asarray(vectors[rows], dtype=np.float32)
+    if metric == "cosine":
+        norms = np.linalg.norm(sample, axis=1, keepdims=True)
+        sample = sample / np.where(norms == 0, 1, norms)
+    with profiler().stage("neighbours", rows=len(rows) * len(rows), queries=len(rows)):
+        distances, ids = sample_neighbours(sample, k)
+
+    occurrences = np.bincount(ids.ravel(), minlength=len(rows)).astype(np.float64)
+    deviation = occurrences - occurrences.mean()
+    skewness = float((deviation ** 3).mean() / max(occurrences.std() ** 3, 1e-12))
+
+    # Duplicates at distance 0 give no estimate
+    valid = distances[:, 0] > 0
+    ratios = np.log(distances[valid, -1:] / distances[valid, :-1])
+    lid = (k - 1) / ratios.sum(axis=1)
+    return {
+        "sample": len(rows),
+        "k": k,
+        "hubness": {
+            "skewness": skewness,
+            "antihubs": float((occurrences == 0).mean()),
+            "hubs": float((occurrences > 2 * k).mean()),
+            "max_occurrence": int(occurrences.max()),
+        },
+        "lid": summary(lid[np.isfinite(lid)]),
+        "nearest_distance": summary(distances[:, 0]),
+    }
+
+
+def build_report(
+        dataset: Dataset,
+        sample_size: int = SAMPLE_SIZE,
+        k: int = NEIGHBOURS,
+        parallel: int = 1,
+        seed: int = 0,
+) -> dict:
+    """
+    Full report, payload statistics are read from `stats.json` of the dataset if it has one.
+    """
+    report = {"dataset": dataset.path, "metric": dataset.metric}
+    stats = dataset.stats
+    if stats is None and os.path.exists(dataset.file(PAYLOADS_FILE)):
+        stats = build_stats(dataset.file(PAYLOADS_FILE), parallel=parallel).report(top=10)
+    if stats is not None:
+        report["fields"] = field_skew(stats)
+    report["tests"] = tests_report(dataset)
+    report["vectors"] = vectors_report(dataset.vectors)
+    report["neighbourhoods"] = neighbourhoods_report(dataset.vectors, dataset.metric, sample_size, k, seed)
+    return report
+
+
+def _html_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    if isinstance(value, dict):
+        return _html_table(value)
+    if isinstance(value, list):
+        return html.escape(json.dumps(value))
+    return html.escape(str(value))
+
+
+def _html_table(values: dict) -> str:
+    rows = "".join(
+        f"<tr><th>{html.escape(str(key))}</th><td>{_html_value(value)}</td></tr>" for key, value in values.items()
+    )
+    return f"<table>{rows}</table>"
+
+
+def _html_bars(counts: Dict[str, int]) -> str:
+    # Horizontal bars, scaled to the largest count
+    largest = max(max(counts.values(), default=0), 1)
+    bars = "".join(
+        f'<text x="0" y="{18 * i + 13}">{html.escape(label)}</text>'
+        f'<rect x="90" y="{18 * i + 2}" width="{300 * count / largest:.1f}" height="14" fill="#4a7fb5"/>'
+        f'<text x="{95 + 300 * count / largest:.1f}" y="{18 * i + 13}">{count}</text>'
+        for i, (label, count) in enumerate(counts.items())
+    )
+    return f'<svg width="460" height="{18 * len(counts) + 4}" font-size="12">{bars}</svg>'
+
+
+def render_html(report: dict) -> str:
+    sections = []
+    for section in ("fields", "tests", "vectors", "neighbourhoods"):
+        if section not in report:
+            continue
+        body = _html_table(report[section])
+        if section == "tests" and "selectivity_histogram" in report[section]:
+            body = _html_bars(report[section]["selectivity_histogram"]) + body
+        sections.append(f"<h2>{section}</h2>{body}")
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>"
+        f"<title>{html.escape(report['dataset'])}</title>"
+        "<style>body{font-family:sans-serif} table{border-collapse:collapse} "
+        "th,td{border:1px solid #ccc;padding:2px 6px;text-align:left;vertical-align:top}</style></head><body>"
+        f"<h1>{html.escape(report['dataset'])}</h1><p>metric: {html.escape(report['metric'])}</p>"
+        + "".join(sections) + "</body></html>"
+    )
+
+
+def save_report(report: dict, path: Optional[str] = None, html_path: Optional[str] = None):
+    if path is not None:
+        with open(path, "w") as out:
+            json.dump(report, out, indent=2)
+    if html_path is not None:
+        with open(html_path, "w") as out:
+            out.write(render_html(report))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the payloads, tests and vectors of a dataset")
+    parser.add_argument("dataset", help="dataset path or name relative to DATA_DIR")
+    parser.add_argument("--output", default=None, help="JSON report path, printed if neither output is given")
+    parser.add_argument("--html", default=None, help="HTML report path")
+    parser.add_argument("--sample", type=int, default=SAMPLE_SIZE, help="rows sampled for hubness and LID")
+    parser.add_argument("--neighbours", type=int, default=NEIGHBOURS, help="k of hubness and LID")
+    parser.add_argument("--parallel", type=int, default=os.cpu_count(), help="processes of payload statistics")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset_report = build_report(Dataset.open(args.dataset), args.sample, args.neighbours, args.parallel, args.seed)
+    if args.output is None and args.html is None:
+        print(json.dumps(dataset_report, indent=2))
+    save_report(dataset_report, args.output, args.html)
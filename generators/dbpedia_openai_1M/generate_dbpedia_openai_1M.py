@@ -1,4 +1,3 @@
-import json
 import os
 
 import numpy as np
@@ -7,18 +6,24 @@ import tqdm
 from pathlib import Path
 from datasets import load_dataset
 from generators.config import DATA_DIR
+from generators.dataset import write_metadata
+from generators.output import RecordWriter
+from generators.profiling import profiler
 from generators.search_generator.qdrant_generator import index_qdrant, search_qdrant
 
 SAMPLE_SIZE = 975_000 # The dataset has 1 million embeddings in total
 N = 5_000
+SEED = 42
 
 
 def main():
     print("Loading DBpedia OpenAI embeddings dataset")
-    data = load_dataset("KShivendu/dbpedia-entities-openai-1M", split="train")
+    with profiler().stage("load_dataset") as stage:
+        data = load_dataset("KShivendu/dbpedia-entities-openai-1M", split="train")
 
-    embeddings = data.to_pandas()['openai'].to_numpy()
-    embeddings = np.vstack(embeddings).reshape((-1, 1536))
+        embeddings = data.to_pandas()['openai'].to_numpy()
+        embeddings = np.vstack(embeddings).reshape((-1, 1536))
+        stage.rows, stage.bytes = len(embeddings), embeddings.nbytes
 
     index_embeddings = embeddings[:SAMPLE_SIZE]
     other_embeddings = embeddings[SAMPLE_SIZE:]
@@ -34,19 +39,22 @@ def main():
 
     tests_path = os.path.join(path, "tests.jsonl")
 
-    with open(tests_path, "w") as f:
+    # Results are encoded and written in the background while the next searches run
+    with RecordWriter(tests_path) as writer:
         for query in tqdm.tqdm(search_qdrant(
                 sample_embeddings=other_embeddings,
-                filter_generator=lambda: ({}, {}),
+                filter_generator=lambda rng: ({}, {}),
                 n=N,
-                top=10
+                top=10,
+                seed=SEED,
         )):
-            f.write(f"{json.dumps(query)}\n")
+            writer.write(query)
 
     # save embeddings
 
     os.makedirs(path, exist_ok=True)
     np.save(os.path.join(path, "vectors.npy"), index_embeddings)
+    write_metadata(path, metric="cosine", top=10)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+import numpy as np
+
+from generators.cluster_search import ClusterIndex, ClusterSearch
+from generators.ground_truth import ExactSearch
+from generators.metrics import get_metric
+from generators.quantized_search import QUANTIZED_DTYPES, QuantizedSearch, QuantizedVectors
+
+# Ground truth engines, all of them return results identical to the brute force
+ENGINES = ("exact",) + QUANTIZED_DTYPES + ("clusters",)
+
+
+def check_metric(kind: str, metric: str):
+    # Error bounds of the quantized copies and cluster radii are derived for cosine scores
+    if kind != "exact" and get_metric(metric).name != "cosine":
+        raise ValueError(f"Engine {kind} only supports cosine, use the exact engine for {metric}")
+
+
+def prepare_engine(vectors_path: str, kind: str = "exact", metric: str = "cosine"):
+    """
+    Build the sidecar files of the engine next to `vectors.npy`, so worker processes only map them.
+    """
+    check_metric(kind, metric)
+    if kind in QUANTIZED_DTYPES:
+        QuantizedVectors.open(vectors_path, kind)
+    elif kind == "clusters":
+        ClusterIndex.open(vectors_path)
+    elif kind != "exact":
+        raise ValueError(f"Unknown engine: {kind}, expected one of {ENGINES}")
+
+
+def open_engine(vectors_path: str, vectors: np.ndarray, kind: str = "exact", metric: str = "cosine") -> ExactSearch:
+    check_metric(kind, metric)
+    if kind == "exact":
+        return ExactSearch(vectors, metric)
+    if kind in QUANTIZED_DTYPES:
+        return QuantizedSearch(vectors, QuantizedVectors.open(vectors_path, kind))
+    if kind == "clusters":
+        return ClusterSearch(vectors, ClusterIndex.open(vectors_path))
+    raise ValueError(f"Unknown engine: {kind}, expected one of {ENGINES}")
@@ -0,0 +1,429 @@
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from haversine import haversine_vector
+
+from generators.bitset import Bitset
+
+# Relative per-row cost of evaluating an atomic predicate, in units of one multiply-add of vector scoring
+PREDICATE_COSTS = {
+    "match": 4,
+    "range": 8,
+    "geo": 120,
+}
+# Checking a cached bitset costs a word operation per 64 rows
+CACHED_PREDICATE_COST = 4 / 64
+# Random access to candidate rows is slower than a sequential column scan
+RANDOM_ACCESS_PENALTY = 4
+# Listing candidate rows of a bitset and packing the result back, per row of the bitset
+CANDIDATE_OVERHEAD = 30
+# Operators of condition trees, `not` matches rows matching none of its clauses
+OPERATORS = ("and", "or", "not")
+
+
+class PayloadColumns:
+    """
+    Columnar view of a list of payloads. Columns are extracted on first use:
+
+    * numbers - numpy array
+    * strings - dictionary encoded: sorted unique values and int32 codes
+    * lists of strings (labels, tags) - CSR encoded: sorted unique values, int64 row offsets and int32 codes,
+      values of row `i` are `codes[offsets[i]:offsets[i + 1]]`, without duplicates
+    * geo points - float64 array of (lat, lon)
+    * anything else (lists of other values, mixed types) - object array
+    """
+
+    def __init__(self, payloads: Optional[List[dict]]):
+        self.payloads = payloads
+        self.columns: Dict[str, Tuple[str, tuple]] = {}
+        self.size: Optional[int] = None
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Tuple[str, tuple]], size: int) -> "PayloadColumns":
+        """
+        Columns built beforehand, e.g. drawn directly or memory-mapped from a column store, without payloads.
+        """
+        payload_columns = cls(None)
+        payload_columns.columns = dict(columns)
+        payload_columns.size = size
+        return payload_columns
+
+    def __len__(self):
+        return self.size if self.payloads is None else len(self.payloads)
+
+    def column(self, field: str) -> Tuple[str, tuple]:
+        if field not in self.columns:
+            if self.payloads is None:
+                raise KeyError(f"Unknown payload field: {field}")
+            self.columns[field] = self._extract(field)
+        return self.columns[field]
+
+    @staticmethod
+    def subset(kind: str, column: tuple, ids: np.ndarray) -> tuple:
+        """
+        Column restricted to rows `ids`, the dictionary of keyword columns is kept as is.
+        """
+        if kind == "keyword":
+            dictionary, codes = column
+            return dictionary, codes[ids]
+        if kind == "multi_keyword":
+            dictionary, offsets, codes = column
+            starts = offsets[ids]
+            lengths = offsets[ids + 1] - starts
+            subset_offsets = np.concatenate([[0], np.cumsum(lengths)])
+            positions = np.arange(subset_offsets[-1]) + np.repeat(starts - subset_offsets[:-1], lengths)
+            return dictionary, subset_offsets, codes[positions]
+        return tuple(values[ids] for values in column)
+
+    def _extract(self, field: str) -> Tuple[str, tuple]:
+        values = [payload[field] for payload in self.payloads]
+        kinds = {type(value) for value in values}
+
+        if kinds <= {int, float} and kinds:
+            return "number", (np.array(values),)
+        if kinds == {str}:
+            dictionary, codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+            return "keyword", (dictionary, codes.astype(np.int32))
+        if kinds == {dict} and all("lat" in value and "lon" in value for value in values):
+            return "geo", (np.array([(value["lat"], value["lon"]) for value in values], dtype=np.float64),)
+        if kinds == {list} and all(isinstance(item, str) for value in values for item in value):
+            return "multi_keyword", csr_encode(values)
+
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return "object", (column,)
+
+
+def csr_encode(rows: List[List[str]], dictionary: np.ndarray = None) -> tuple:
+    """
+    CSR column of string lists: (dictionary, offsets, codes), duplicates within a row are dropped.
+    Values missing from a given `dictionary` are dropped too.
+    """
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    items = [item for row in rows for item in row]
+    if dictionary is None:
+        dictionary = np.array(sorted(set(items)), dtype=object)
+    # A hash lookup per value is much faster than sorting an object array
+    index = {value: code for code, value in enumerate(dictionary.tolist())}
+    codes = np.fromiter((index.get(item, -1) for item in items), dtype=np.int64, count=len(items))
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return (dictionary,) + csr_normalize(offsets, codes, len(dictionary))
+
+
+def csr_normalize(offsets: np.ndarray, codes: np.ndarray, num_values: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Offsets and int32 codes with duplicates within a row and negative (unknown) codes dropped, sorted within rows.
+    """
+    lengths = np.diff(offsets)
+    known = codes >= 0
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)[known]
+    # Unique (row, code) pairs, sorted by row. Pairs are already grouped by row, which a stable sort exploits
+    pairs = np.sort(row_ids * num_values + codes[known], kind="stable")
+    pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])] if len(pairs) else pairs
+    row_ids, codes = np.divmod(pairs, max(num_values, 1))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_ids, minlength=len(lengths)), out=offsets[1:])
+    return offsets, codes.astype(np.int32)
+
+
+def dictionary_positions(dictionary: np.ndarray, values: list) -> np.ndarray:
+    """
+    Positions of `values` in a sorted dictionary of strings, values which are not in it are skipped.
+    """
+    values = [value for value in values if isinstance(value, str)]
+    if not values or len(dictionary) == 0:
+        return np.empty(0, dtype=np.int64)
+    positions = np.searchsorted(dictionary, values)
+    found = positions < len(dictionary)
+    found[found] = dictionary[positions[found]] == np.array(values, dtype=object)[found]
+    return np.unique(positions[found])
+
+
+def match_values(condition: dict) -> list:
+    """
+    Values accepted by a `match` condition: `{"value": x}` or any of `{"any": [x, y, ...]}`.
+    """
+    return list(condition['any']) if 'any' in condition else [condition['value']]
+
+
+def tree_operator(conditions: dict) -> Tuple[str, list]:
+    """
+    Operator of a condition tree and its clauses.
+    """
+    for operator in OPERATORS:
+        if operator in conditions:
+            return operator, conditions[operator]
+    raise ValueError(f"Unknown conditions: {conditions}")
+
+
+def clause_nodes(clauses: list) -> list:
+    """
+    Children of a tree node: nested trees `{operator: [...]}` and `(field, condition)` predicates.
+    A clause with several fields contributes a predicate per field.
+    """
+    nodes = []
+    for clause in clauses:
+        for key, value in clause.items():
+            nodes.append({key: value} if key in OPERATORS and isinstance(value, list) else (key, value))
+    return nodes
+
+
+def predicates(conditions: Optional[dict]) -> List[Tuple[str, dict]]:
+    """
+    All `(field, condition)` predicates of a condition tree, at any depth.
+    """
+    if not conditions:
+        return []
+    _, clauses = tree_operator(conditions)
+    result = []
+    for node in clause_nodes(clauses):
+        result.extend(predicates(node) if isinstance(node, dict) else [node])
+    return result
+
+
+class MaskCache:
+    """
+    LRU cache of row bitsets, bounded by the total size of cached bitsets in bytes.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.masks: "OrderedDict[tuple, Bitset]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.masks
+
+    def get(self, key: tuple) -> Optional[Bitset]:
+        mask = self.masks.get(key)
+        if mask is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.masks.move_to_end(key)
+        return mask
+
+    def put(self, key: tuple, mask: Bitset):
+        if mask.nbytes > self.max_bytes or key in self.masks:
+            return
+        # Cached masks are shared between queries
+        mask.words.flags.writeable = False
+        self.masks[key] = mask
+        self.used_bytes += mask.nbytes
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self.masks.popitem(last=False)
+            self.used_bytes -= evicted.nbytes
+
+
+class FilterEvaluator:
+    """
+    Vectorized evaluation of filtering conditions over all payloads at once.
+
+    Semantics are the same as `DataGenerator.check_conditions`: `and`, `or` and `not` trees of any depth.
+    Results are packed bitsets, masks of atomic `match` predicates are cached, so with a warm cache a condition
+    costs a few bitwise operations over words.
+
+    Clauses are evaluated cheapest and most decisive first: cached bitsets, then matches, ranges and geo
+    predicates, weighted by the selectivity from `estimator` if one is set (see `planner.SelectivityEstimator`).
+    Once few candidate rows remain, later clauses are evaluated only on them.
+    """
+
+    def __init__(self, payloads: List[dict], cache: MaskCache = None, estimator=None):
+        self.columns = payloads if isinstance(payloads, PayloadColumns) else PayloadColumns(payloads)
+        self.cache = cache if cache is not None else MaskCache()
+        self.estimator = estimator
+
+    def __len__(self):
+        return len(self.columns)
+
+    def mask(self, conditions: dict) -> np.ndarray:
+        return self.bitset(conditions).to_mask()
+
+    def node_cost(self, node, check_cache: bool = True) -> float:
+        """
+        Per-row cost of a predicate or a whole subtree. Without `check_cache` only the kinds of predicates count,
+        which saves building cache keys when only the order of matches, ranges and geo predicates matters.
+        """
+        if isinstance(node, dict):
+            return sum(self.node_cost(child, check_cache) for child in clause_nodes(tree_operator(node)[1]))
+        field, condition = node
+        if check_cache and self.is_cached(field, condition):
+            return CACHED_PREDICATE_COST
+        return PREDICATE_COSTS.get(next(iter(condition)), PREDICATE_COSTS["geo"])
+
+    def node_selectivity(self, node) -> float:
+        if self.estimator is None:
+            return 0.5
+        if isinstance(node, dict):
+            return self.estimator.estimate(node)
+        return self.estimator.clause(*node)
+
+    def ordered_nodes(self, conditions: dict) -> Tuple[str, list]:
+        """
+        Operator and children in evaluation order. Under `and` the rank of a child is its cost per rejected row,
+        under `or` and `not` its cost per accepted row, the lowest first.
+        """
+        operator, clauses = tree_operator(conditions)
+        nodes = clause_nodes(clauses)
+        if len(nodes) < 2:
+            return operator, nodes
+
+        def rank(node) -> float:
+            selectivity = self.node_selectivity(node)
+            decisive = 1 - selectivity if operator == "and" else selectivity
+            return self.node_cost(node, check_cache=False) / max(decisive, 1e-6)
+
+        return operator, sorted(nodes, key=rank)
+
+    def bitset(self, conditions: dict) -> Bitset:
+        operator, nodes = self.ordered_nodes(conditions)
+        keep = operator == "and"
+        result = None
+        for node in nodes:
+            if result is None:
+                result = self._node_bitset(node)
+            else:
+                result = self._narrow(result, node, keep)
+            # No later clause can add rows to an empty intersection
+            if keep and not result.any():
+                break
+        if result is None:
+            result = Bitset.ones(len(self)) if keep else Bitset.zeros(len(self))
+        return ~result if operator == "not" else result
+
+    def _node_bitset(self, node) -> Bitset:
+        return self.bitset(node) if isinstance(node, dict) else self.condition_bitset(*node)
+
+    def _narrow(self, result: Bitset, node, keep: bool) -> Bitset:
+        """
+        `result & node` if `keep`, else `result | node`. Matches are evaluated over all rows and cached,
+        other nodes only on the rows they can change, if this is cheaper than a scan of all rows.
+        """
+        if isinstance(node, dict) or 'match' not in node[1]:
+            # Only matches are cached, other predicates are costed by kind
+            cost = self.node_cost(node, check_cache=False)
+            open_rows = result.count() if keep else len(self) - result.count()
+            if open_rows * cost * RANDOM_ACCESS_PENALTY + len(self) * CANDIDATE_OVERHEAD < len(self) * cost:
+                ids = (result if keep else ~result).to_indices()
+                matched = Bitset.from_indices(ids[self._node_rows(node, ids)], len(self))
+                return matched if keep else result | matched
+        node_bitset = self._node_bitset(node)
+        return result & node_bitset if keep else result | node_bitset
+
+    def rows_mask(self, conditions: dict, ids: np.ndarray) -> np.ndarray:
+        """
+        Evaluate conditions only for rows `ids`, e.g. to check a few candidates of a post-filtered search.
+        Each clause is checked only on rows it can still change.
+        """
+        operator, nodes = self.ordered_nodes(conditions)
+        result = np.full(len(ids), operator == "and")
+        for node in nodes:
+            open_positions = np.flatnonzero(result == (operator == "and"))
+            if len(open_positions) == 0:
+                break
+            result[open_positions] = self._node_rows(node, ids[open_positions])
+        return ~result if operator == "not" else result
+
+    def _node_rows(self, node, ids: np.ndarray) -> np.ndarray:
+        if isinstance(node, dict):
+            return self.rows_mask(node, ids)
+        return self.condition_rows(*node, ids)
+
+    @staticmethod
+    def _cache_key(field: str, condition: dict) -> tuple:
+        return field, json.dumps(condition, sort_keys=True)
+
+    def is_cached(self, field: str, condition: dict) -> bool:
+        return self._cache_key(field, condition) in self.cache
+
+    def condition_bitset(self, field: str, condition: dict) -> Bitset:
+        # Only matches come from a small set of values and are worth caching,
+        # random ranges and geo circles practically never repeat
+        if 'match' not in condition:
+            return Bitset.from_mask(self._evaluate(field, condition))
+
+        key = self._cache_key(field, condition)
+        bitset = self.cache.get(key)
+        if bitset is None:
+            bitset = Bitset.from_mask(self._evaluate(field, condition))
+            self.cache.put(key, bitset)
+        return bitset
+
+    def condition_rows(self, field: str, condition: dict, ids: np.ndarray) -> np.ndarray:
+        if self.is_cached(field, condition):
+            return self.cache.get(self._cache_key(field, condition)).contains(ids)
+        return self._evaluate(field, condition, ids)
+
+    def _evaluate(self, field: str, condition: dict, ids: np.ndarray = None) -> np.ndarray:
+        kind, column = self.columns.column(field)
+        if ids is not None:
+            column = self.columns.subset(kind, column, ids)
+        if 'match' in condition:
+            return self._match(kind, column, condition['match'])
+        if 'range' in condition:
+            return self._range(kind, column, condition['range'])
+        if 'geo' in condition:
+            return self._geo(kind, column, condition['geo'])
+        raise ValueError(f"Unknown condition: {condition}")
+
+    @staticmethod
+    def _match(kind: str, column: tuple, condition: dict) -> np.ndarray:
+        values = match_values(condition)
+        if kind == "keyword":
+            dictionary, codes = column
+            positions = dictionary_positions(dictionary, values)
+            if len(positions) == 1:
+                return codes == positions[0]
+            return np.isin(codes, positions)
+        if kind == "multi_keyword":
+            dictionary, offsets, codes = column
+            positions = dictionary_positions(dictionary, values)
+            hits = codes == positions[0] if len(positions) == 1 else np.isin(codes, positions)
+            # Rows owning the hit values, found through the offsets instead of scanning rows
+            result = np.zeros(len(offsets) - 1, dtype=bool)
+            result[np.searchsorted(offsets, np.flatnonzero(hits), side="right") - 1] = True
+            return result
+        if kind == "number":
+            if len(values) == 1:
+                return column[0] == values[0]
+            return np.isin(column[0], values)
+        return np.fromiter(
+            (
+                any(value in row for value in values) if isinstance(row, list) else row in values
+                for row in column[0]
+            ),
+            dtype=bool,
+            count=len(column[0]),
+        )
+
+    @staticmethod
+    def _range(kind: str, column: tuple, condition: dict) -> np.ndarray:
+        if kind != "number":
+            raise ValueError(f"Range condition on non-numeric column: {condition}")
+        values = column[0]
+        result = np.ones(len(values), dtype=bool)
+        if 'gt' in condition:
+            result &= values > condition['gt']
+        if 'gte' in condition:
+            result &= values >= condition['gte']
+        if 'lt' in condition:
+            result &= values < condition['lt']
+        if 'lte' in condition:
+            result &= values <= condition['lte']
+        return result
+
+    @staticmethod
+    def _geo(kind: str, column: tuple, condition: dict) -> np.ndarray:
+        if kind != "geo":
+            raise ValueError(f"Geo condition on non-geo column: {condition}")
+        points = column[0]
+        if len(points) == 0:
+            # `haversine_vector` rejects empty inputs, e.g. when no candidate row is left open
+            return np.zeros(0, dtype=bool)
+        center = np.broadcast_to(np.array([condition['lat'], condition['lon']]), points.shape)
+        return haversine_vector(points, center) * 1000 < condition['radius']
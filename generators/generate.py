@@ -1,45 +1,83 @@
-import json
 import os
-import random
 import string
-from typing import List
+import zlib
+from functools import partial
+from typing import Dict, Iterator, List, Tuple, Union
 
 import numpy as np
 import tqdm
 from haversine import haversine
-from sklearn.metrics.pairwise import cosine_similarity
+
+from generators.bitset import Bitset
+from generators.build_cache import SEARCH_MODULES, BuildCache, Stage, describe_callable, source_fingerprint
+from generators.checkpoint import BatchCheckpoint, batch_ranges, digest_inputs
+from generators.filters import OPERATORS, FilterEvaluator, PayloadColumns, tree_operator
+from generators.dataset import COLUMNS_DIR, COLUMNS_MANIFEST, ColumnWriter, JsonLines, open_columns, write_metadata
+from generators.ground_truth import (
+    ExactSearch,
+    ScoredQuery,
+    candidate_band,
+    rerank,
+)
+from generators.metrics import Metric, get_metric
+from generators.output import RecordWriter
+from generators.planner import QueryPlanner
+from generators.profiling import profiler
+
+# Rows of vectors and payloads drawn, encoded and written at once by random dataset builds
+PAYLOAD_CHUNK_SIZE = 100_000
 
 
 class DataGenerator:
 
-    def __init__(self, vocab_size=1000):
+    def __init__(self, vocab_size=1000, seed=None):
+        # All randomness is derived from this sequence. Independent streams for stages, batches or workers
+        # are spawned from it, so the output does not depend on how the work is scheduled.
+        self.seed_sequence = np.random.SeedSequence(seed)
+        self.use_stream(self.stream_seeds("vocab", 1)[0])
         self.vocab = [self.random_keyword() for _ in range(vocab_size)]
+        self.use_stream(self.stream_seeds("default", 1)[0])
+
+    @property
+    def seed(self) -> int:
+        return self.seed_sequence.entropy
+
+    def stream_seeds(self, stage: str, count: int) -> List[np.random.SeedSequence]:
+        """
+        Spawn `count` independent seed sequences for the named stage.
+        Result depends only on the generator seed and the stage name, not on previous calls.
+        """
+        stage_sequence = np.random.SeedSequence(self.seed, spawn_key=(zlib.crc32(stage.encode()),))
+        return stage_sequence.spawn(count)
+
+    def use_stream(self, seed_sequence: np.random.SeedSequence):
+        self.rng = np.random.default_rng(seed_sequence)
 
     def random_keyword(self):
-        letters = string.ascii_letters
-        return "".join(random.sample(letters, 5))
+        letters = list(string.ascii_letters)
+        return "".join(self.rng.choice(letters, 5, replace=False))
 
     def sample_keyword(self):
-        return random.choice(self.vocab)
+        return self.vocab[self.rng.integers(len(self.vocab))]
 
     def random_float(self):
-        return random.random()
+        return float(self.rng.random())
 
     def random_int(self, rng=100):
-        return random.randint(0, rng)
+        return int(self.rng.integers(0, rng, endpoint=True))
 
     def random_geo(self):
         return {
-            "lon": random.uniform(-180.0, 180.0),
-            "lat": random.uniform(-90.0, 90.0)
+            "lon": float(self.rng.uniform(-180.0, 180.0)),
+            "lat": float(self.rng.uniform(-90.0, 90.0))
         }
 
     def random_range_query(self):
-        a, b = random.random(), random.random()
+        a, b = self.rng.random(), self.rng.random()
         return {
             "range": {
-                "gt": min(a, b),
-                "lt": max(a, b)
+                "gt": float(min(a, b)),
+                "lt": float(max(a, b))
             }
         }
 
@@ -61,17 +99,30 @@ class DataGenerator:
         return {
             "geo": {
                 **self.random_geo(),
-                "radius": random.randint(1000, radius)
+                "radius": int(self.rng.integers(1000, radius, endpoint=True))
             }
         }
 
     def random_vectors(self, size, dim):
-        return np.random.rand(size, dim).astype(np.float32)
+        return self.rng.random((size, dim), dtype=np.float32)
+
+    def save_random_vectors(self, path, size, dim, chunk_size=100_000):
+        """
+        Same values as `random_vectors`, but drawn chunk by chunk directly into a memory-mapped `.npy` file.
+        """
+        vectors = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(size, dim))
+        for start in range(0, size, chunk_size):
+            self.rng.random(dtype=np.float32, out=vectors[start:start + chunk_size])
+        vectors.flush()
+        del vectors
 
     def check_range(self, value, condition: dict):
         return condition['gt'] < value < condition['lt']
 
     def check_match(self, value, condition: dict):
+        if 'any' in condition:
+            values = value if isinstance(value, list) else [value]
+            return any(item in condition['any'] for item in values)
         return (
             condition['value'] in value if isinstance(value, list) else value == condition['value']
         )
@@ -91,21 +142,28 @@ class DataGenerator:
         raise ValueError(f"Unknown condition: {condition}")
 
     def check_conditions(self, payload: dict, conditions: dict):
+        """
+        `and`, `or` and `not` (none of the clauses) trees, a clause is a nested tree or `{field: condition}`.
+        Evaluation stops at the first clause deciding the result.
+        """
+        # Called per payload, so the operator lookup is inlined
         if 'and' in conditions:
-            and_res = True
-            for field_condition in conditions['and']:
-                for field, condition in field_condition.items():
-                    and_res = and_res and self.check_condition(value=payload[field], condition=condition)
-            return and_res
-
-        if 'or' in conditions:
-            or_res = False
-            for field_condition in conditions['or']:
-                for field, condition in field_condition.items():
-                    or_res = or_res or self.check_condition(value=payload[field], condition=condition)
-            return or_res
-
-        raise ValueError(f"Unknown conditions: {conditions}")
+            operator, clauses = "and", conditions['and']
+        elif 'or' in conditions:
+            operator, clauses = "or", conditions['or']
+        else:
+            operator, clauses = tree_operator(conditions)
+        # A clause deciding the result is false under `and`, true under `or` and `not`
+        decisive = operator != "and"
+        for clause in clauses:
+            for key, value in clause.items():
+                if isinstance(value, list) and key in OPERATORS:
+                    matched = self.check_conditions(payload, {key: value})
+                else:
+                    matched = self.check_condition(value=payload[key], condition=value)
+                if matched == decisive:
+                    return operator == "or"
+        return operator != "or"
 
     def search(
             self,
@@ -113,26 +171,111 @@ class DataGenerator:
             payloads: List[dict],
             query: np.ndarray,
             conditions: dict = None,
-            top=25):
-
-        mask = np.array([self.check_conditions(payload, conditions) for payload in payloads])
-
-        # Select only matched by payload vectors
-        filtered_vectors = vectors[mask]
-        # List of original ids
-        raw_ids = np.arange(0, len(vectors))
-        # List of ids, filtered by payload
-        filtered_ids = raw_ids[mask]
-        if len(filtered_vectors) == 0:
+            top=25,
+            mask: Union[np.ndarray, Bitset] = None,
+            metric: Union[str, Metric] = "cosine"):
+
+        metric = get_metric(metric)
+        with profiler().stage("filter", rows=len(payloads)):
+            if mask is None:
+                mask = np.array([self.check_conditions(payload, conditions) for payload in payloads])
+
+            # List of ids, filtered by payload
+            filtered_ids = mask.to_indices() if isinstance(mask, Bitset) else np.flatnonzero(mask)
+        if len(filtered_ids) == 0:
             return [], []
+        # Select only matched by payload vectors
+        with profiler().stage("gather", rows=len(filtered_ids)) as stage:
+            filtered_vectors = vectors[filtered_ids]
+            norms = metric.norms(filtered_vectors)
+            stage.bytes = filtered_vectors.nbytes
         # Scores among filtered vectors
-        scores = cosine_similarity([query], filtered_vectors)[0]
-        # Ids in filtered matrix
-        top_scores_ids = np.argsort(scores)[-top:][::-1]
-        top_scores = scores[top_scores_ids]
+        with profiler().stage("score", rows=len(filtered_ids), queries=1):
+            scores = metric.approx_scores(query, filtered_vectors, norms)
+        # Ids in filtered matrix, which may reach the top, ranked by exact scores
+        with profiler().stage("rerank", queries=1) as stage:
+            candidates = candidate_band(scores, metric.error_radius(query, norms), top)
+            top_scores_ids, top_scores = rerank(query, candidates, filtered_vectors, norms, top, metric)
+            stage.rows = len(candidates)
         # Original ids before filtering
         original_ids = filtered_ids[top_scores_ids]
-        return list(map(int, original_ids)), list(map(float, top_scores))
+        return list(map(int, original_ids)), top_scores
+
+
+class RandomPayloads:
+    """
+    Payloads with independent random `fields` of one kind: "keyword" (from the vocabulary), "int", "float" or "geo".
+
+    Called without arguments it draws one payload. `columns(size)` draws `size` payloads at once as
+    `PayloadColumns` columns, consuming the random stream exactly like `size` single calls,
+    so datasets built in chunks are identical to ones built row by row.
+    """
+
+    KINDS = ("keyword", "int", "float", "geo")
+
+    def __init__(self, generator: DataGenerator, kind: str, fields: Tuple[str, ...] = ("a", "b"), int_range=100):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown payload kind: {kind}, expected one of {self.KINDS}")
+        self.generator = generator
+        self.kind = kind
+        self.fields = tuple(fields)
+        self.int_range = int_range
+
+    def __repr__(self) -> str:
+        # Stable description, used in build cache keys
+        return f"RandomPayloads(kind={self.kind!r}, fields={self.fields!r}, int_range={self.int_range!r})"
+
+    def _value(self):
+        if self.kind == "keyword":
+            return self.generator.sample_keyword()
+        if self.kind == "int":
+            return self.generator.random_int(self.int_range)
+        if self.kind == "float":
+            return self.generator.random_float()
+        return self.generator.random_geo()
+
+    def __call__(self) -> dict:
+        return {field: self._value() for field in self.fields}
+
+    def columns(self, size: int) -> Dict[str, Tuple[str, tuple]]:
+        rng = self.generator.rng
+        shape = (size, len(self.fields))
+        if self.kind == "keyword":
+            dictionary, vocab_codes = np.unique(np.array(self.generator.vocab, dtype=object), return_inverse=True)
+            codes = vocab_codes[rng.integers(len(self.generator.vocab), size=shape)].astype(np.int32)
+            return {
+                field: ("keyword", (dictionary, np.ascontiguousarray(codes[:, i])))
+                for i, field in enumerate(self.fields)
+            }
+        if self.kind == "int":
+            values = rng.integers(0, self.int_range, size=shape, endpoint=True)
+        elif self.kind == "float":
+            values = rng.random(shape)
+        else:
+            # Drawn as (lon, lat) like `random_geo`, stored as (lat, lon) like `PayloadColumns`
+            points = rng.uniform([-180.0, -90.0], [180.0, 90.0], size=shape + (2,))
+            return {
+                field: ("geo", (np.ascontiguousarray(points[:, i, ::-1]),))
+                for i, field in enumerate(self.fields)
+            }
+        return {field: ("number", (np.ascontiguousarray(values[:, i]),)) for i, field in enumerate(self.fields)}
+
+    def records(self, columns: Dict[str, Tuple[str, tuple]]) -> Iterator[dict]:
+        """
+        Payloads of `columns`, the same values as single calls would return.
+        """
+        values = []
+        for field in self.fields:
+            kind, column = columns[field]
+            if kind == "keyword":
+                dictionary, codes = column
+                values.append(dictionary[codes].tolist())
+            elif kind == "geo":
+                values.append([{"lon": lon, "lat": lat} for lat, lon in column[0].tolist()])
+            else:
+                values.append(column[0].tolist())
+        for row in zip(*values):
+            yield dict(zip(self.fields, row))
 
 
 def generate_conditions(seed, condition_generator):
@@ -182,30 +325,161 @@ def generate_samples(
         path,
         condition_generator,
         top=25,
+        batch_size=1000,
+        engine: ExactSearch = None,
+        tests_per_vector=1,
+        precision=None,
+        metric="cosine",
+        inputs_digest=None,
+        verbose=True,
 ):
-    with open(path, "w") as out:
-        for i in tqdm.tqdm(range(num_queries)):
-            query = generator.random_vectors(1, dim=dim)[0]
-            conditions = generate_conditions(seed=i, condition_generator=condition_generator)
-
-            closest_ids, best_scores = generator.search(
-                vectors=vectors,
-                payloads=payloads,
-                query=query,
-                conditions=conditions,
-                top=top,
-            )
-
-            out.write(json.dumps(
+    """
+    Generate `num_queries` tests into `path`.
+
+    With `tests_per_vector` > 1 each query vector is paired with that many conditions: the vector is scored
+    against all rows once and the top of every condition is derived from the shared scores.
+
+    Tests are produced in batches of `batch_size`, each batch draws from its own random stream, spawned
+    from the generator seed, and is persisted into `<path>.parts` together with the RNG state after it.
+    If the process is interrupted, the next call with the same inputs continues from the last complete batch
+    and the merged file is identical to an uninterrupted run.
+
+    Encoding and committing of a batch happen in the background while the next batch is computed,
+    `precision` limits the number of decimals of written floats. `metric` is ignored if `engine` is given.
+
+    `payloads` may be a list of payloads or `PayloadColumns`. `inputs_digest` identifies vectors and payloads
+    in the checkpoint manifest, if not given it is fingerprinted from their shapes and a sample of rows.
+    `verbose` - show progress and a summary of query plans.
+    """
+    engine = engine or ExactSearch(vectors, metric)
+    batches = batch_ranges(num_queries, batch_size)
+    checkpoint = BatchCheckpoint(
+        directory=f"{path}.parts",
+        manifest={
+            "num_queries": num_queries,
+            "batch_size": batch_size,
+            "dim": dim,
+            "top": top,
+            "tests_per_vector": tests_per_vector,
+            "precision": precision,
+            "metric": engine.metric.name,
+            "seed": str(generator.seed),
+            "conditions": describe_callable(condition_generator),
+            "inputs": inputs_digest or digest_inputs(vectors, payloads),
+        },
+    )
+    completed = checkpoint.open()
+    if completed > 0:
+        if verbose:
+            print(f"Resuming {path} from batch {completed} of {len(batches)}")
+        # The generator continues from the state left by the last complete batch, as after an uninterrupted run
+        generator.rng = np.random.default_rng()
+        generator.rng.bit_generator.state = checkpoint.load_state(completed - 1)
+
+    batch_seeds = generator.stream_seeds("tests", len(batches))
+    evaluator = FilterEvaluator(payloads)
+    planner = QueryPlanner(engine, evaluator)
+
+    writer = RecordWriter(precision=precision)
+    with writer, tqdm.tqdm(total=num_queries, initial=completed * batch_size, disable=not verbose) as p_bar:
+        for batch_id in range(completed, len(batches)):
+            generator.use_stream(batch_seeds[batch_id])
+            queries = []
+            batch_conditions = []
+            with profiler().stage("queries", queries=len(batches[batch_id])):
+                for position, i in enumerate(batches[batch_id]):
+                    if position % tests_per_vector == 0:
+                        query = generator.random_vectors(1, dim=dim)[0]
+                    queries.append(query)
+                    batch_conditions.append(generate_conditions(seed=i, condition_generator=condition_generator))
+
+            if tests_per_vector == 1:
+                # Queries of the batch sharing a filter are scored together, with the strategy picked by the planner
+                results = planner.search_grouped(
+                    queries=np.stack(queries),
+                    conditions=batch_conditions,
+                    top=top,
+                )
+            else:
+                results = []
+                for start in range(0, len(queries), tests_per_vector):
+                    scored = ScoredQuery(engine, queries[start])
+                    for conditions in batch_conditions[start:start + tests_per_vector]:
+                        results.append(scored.top(conditions, evaluator, top))
+
+            records = [
                 {
-                    "query": query.tolist(),
+                    "query": query,
                     "conditions": conditions,
                     "closest_ids": closest_ids,
                     "closest_scores": best_scores
                 }
-            ))
+                for query, conditions, (closest_ids, best_scores) in zip(queries, batch_conditions, results)
+            ]
+            p_bar.update(len(records))
+
+            writer.submit(records, sink=partial(checkpoint.commit, batch_id, state=generator.rng.bit_generator.state))
+
+    checkpoint.merge(len(batches), path)
+    if verbose and planner.history:
+        print(f"Query plans of {path}: {planner.summary()}")
 
-            out.write("\n")
+
+def build_random_vectors(generator: DataGenerator, size, dim, cache: BuildCache = None) -> Stage:
+    """
+    Random base vectors, shared by every dataset built with the same seed and shape.
+    """
+    cache = cache or BuildCache()
+    vectors_stage = cache.stage(
+        "vectors",
+        size=size,
+        dim=dim,
+        seed=generator.seed,
+        code=source_fingerprint(DataGenerator.stream_seeds, DataGenerator.save_random_vectors),
+    )
+    if not vectors_stage.done:
+        with vectors_stage.build() as work_dir:
+            generator.use_stream(generator.stream_seeds("vectors", 1)[0])
+            with profiler().stage("vectors", rows=size, bytes=size * dim * np.dtype(np.float32).itemsize):
+                generator.save_random_vectors(os.path.join(work_dir, "vectors.npy"), size, dim)
+    return vectors_stage
+
+
+# Methods of `DataGenerator` which payloads are drawn with
+PAYLOAD_METHODS = (
+    DataGenerator.__init__,
+    DataGenerator.stream_seeds,
+    DataGenerator.use_stream,
+    DataGenerator.random_keyword,
+    DataGenerator.sample_keyword,
+    DataGenerator.random_float,
+    DataGenerator.random_int,
+    DataGenerator.random_geo,
+)
+
+
+def write_random_payloads(payload_gen, size, path, chunk_size=PAYLOAD_CHUNK_SIZE):
+    """
+    Stream `size` payloads into `path`/payloads.jsonl, never holding more than a chunk of them.
+    Generators with `columns`, like `RandomPayloads`, draw each chunk at once and also fill a column store
+    in `path`/columns, which test generation maps instead of decoding the JSON lines.
+    """
+    columnar = hasattr(payload_gen, "columns")
+    column_writer = ColumnWriter(os.path.join(path, COLUMNS_DIR), size) if columnar else None
+    # Chunks are encoded and written in the background while the next one is drawn
+    with RecordWriter(os.path.join(path, "payloads.jsonl"), max_pending=2) as writer:
+        for start in range(0, size, chunk_size):
+            count = min(chunk_size, size - start)
+            with profiler().stage("payloads", rows=count):
+                if columnar:
+                    columns = payload_gen.columns(count)
+                    column_writer.write(start, columns)
+                    records = list(payload_gen.records(columns))
+                else:
+                    records = [payload_gen() for _ in range(count)]
+            writer.submit(records)
+    if columnar:
+        column_writer.close()
 
 
 def generate_random_dataset(
@@ -216,25 +490,80 @@ def generate_random_dataset(
         num_queries,
         payload_gen,
         condition_gen,
+        top=25,
+        cache: BuildCache = None,
+        tests_per_vector=1,
+        metric="cosine",
 ):
+    """
+    Build a random dataset into `path`.
+
+    Every stage is stored in the build cache under a fingerprint of its inputs and linked into `path`,
+    so stages whose inputs did not change are not rebuilt, e.g. changing `num_queries` only regenerates tests.
+    Ground truth is computed by `metric`, which is recorded in the dataset metadata.
+    """
+    cache = cache or BuildCache()
     os.makedirs(path, exist_ok=True)
-    vectors = generator.random_vectors(size, dim)
-
-    np.save(os.path.join(path, "vectors.npy"), vectors, allow_pickle=False)
-
-    payloads = [payload_gen() for _ in range(size)]
-
-    with open(os.path.join(path, "payloads.jsonl"), "w") as out:
-        for payload in payloads:
-            out.write(json.dumps(payload))
-            out.write("\n")
-
-    generate_samples(
-        generator=generator,
+    metric = get_metric(metric).name
+
+    # Stages are fully determined by the generator seed, so an interrupted build regenerates exactly
+    # the same inputs and the completed test batches stay valid
+    vectors_stage = build_random_vectors(generator, size, dim, cache)
+
+    payloads_stage = cache.stage(
+        "payloads",
+        size=size,
+        generator=describe_callable(payload_gen),
+        vocab_size=len(generator.vocab),
+        seed=generator.seed,
+        # Only the code drawing payloads, so that changes of conditions or search keep large payload stages
+        code=source_fingerprint(*PAYLOAD_METHODS, RandomPayloads, write_random_payloads, ColumnWriter),
+    )
+    if not payloads_stage.done:
+        with payloads_stage.build() as work_dir:
+            generator.use_stream(generator.stream_seeds("payloads", 1)[0])
+            write_random_payloads(payload_gen, size, work_dir)
+
+    tests_stage = cache.stage(
+        "tests",
+        vectors=vectors_stage.digest,
+        payloads=payloads_stage.digest,
+        conditions=describe_callable(condition_gen),
         num_queries=num_queries,
-        dim=dim,
-        vectors=vectors,
-        payloads=payloads,
-        path=os.path.join(path, "tests.jsonl"),
-        condition_generator=condition_gen,
+        top=top,
+        tests_per_vector=tests_per_vector,
+        metric=metric,
+        seed=generator.seed,
+        code=source_fingerprint(generate_conditions, generate_samples, *SEARCH_MODULES),
     )
+    if not tests_stage.done:
+        vectors = np.load(vectors_stage.file("vectors.npy"), mmap_mode="r", allow_pickle=False)
+        # Payloads are not decoded into records: columns are mapped from the store, or extracted from the lines
+        if os.path.exists(payloads_stage.file(os.path.join(COLUMNS_DIR, COLUMNS_MANIFEST))):
+            payloads = open_columns(payloads_stage.file(COLUMNS_DIR))
+        else:
+            payloads = PayloadColumns(JsonLines(payloads_stage.file("payloads.jsonl")))
+
+        with tests_stage.build() as work_dir:
+            generate_samples(
+                generator=generator,
+                num_queries=num_queries,
+                dim=dim,
+                vectors=vectors,
+                payloads=payloads,
+                path=os.path.join(work_dir, "tests.jsonl"),
+                condition_generator=condition_gen,
+                top=top,
+                tests_per_vector=tests_per_vector,
+                metric=metric,
+                inputs_digest=f"{vectors_stage.digest}-{payloads_stage.digest}",
+            )
+
+    vectors_stage.link("vectors.npy", os.path.join(path, "vectors.npy"))
+    payloads_stage.link("payloads.jsonl", os.path.join(path, "payloads.jsonl"))
+    if os.path.isdir(payloads_stage.file(COLUMNS_DIR)):
+        os.makedirs(os.path.join(path, COLUMNS_DIR), exist_ok=True)
+        for name in sorted(os.listdir(payloads_stage.file(COLUMNS_DIR))):
+            payloads_stage.link(os.path.join(COLUMNS_DIR, name), os.path.join(path, COLUMNS_DIR, name))
+    tests_stage.link("tests.jsonl", os.path.join(path, "tests.jsonl"))
+    write_metadata(path, metric=metric, top=top)
@@ -0,0 +1,257 @@
+import json
+from collections import defaultdict
+from functools import partial
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from generators.filters import OPERATORS, FilterEvaluator
+from generators.metrics import COSINE, Metric, get_metric
+from generators.profiling import profiler
+
+# Upper bound on the number of elements in a single query x vectors score matrix
+MAX_SCORE_ELEMENTS = 64 * 1024 * 1024
+# Share of rows `ScoredQuery` checks in score order before evaluating the filter over all rows instead
+MAX_WALK_FRACTION = 1 / 16
+
+
+def top_k(scores: np.ndarray, top: int) -> np.ndarray:
+    """
+    Positions of the `top` highest scores, best first. Ties are broken by the lower position,
+    so the result does not depend on the partitioning algorithm.
+    """
+    if len(scores) > top:
+        kth = np.partition(scores, len(scores) - top)[len(scores) - top]
+        candidates = np.flatnonzero(scores >= kth)
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:top]
+
+
+def candidate_band(approx_scores: np.ndarray, radius, top: int) -> np.ndarray:
+    """
+    Positions which may belong to the exact top: every row whose score upper bound reaches
+    the `top`-th best lower bound. `radius` bounds |approx - exact| per row or globally.
+    """
+    if len(approx_scores) <= top:
+        return np.arange(len(approx_scores))
+    lower = approx_scores - radius
+    threshold = np.partition(lower, len(lower) - top)[len(lower) - top]
+    return np.flatnonzero(approx_scores + radius >= threshold)
+
+
+def rerank(
+        query: np.ndarray,
+        candidate_ids: np.ndarray,
+        vectors: np.ndarray,
+        norms: np.ndarray,
+        top: int,
+        metric: Metric = COSINE,
+) -> Tuple[List[int], List[float]]:
+    """
+    Final top of the candidates by exact scores of the metric. Candidates must be sorted, so ties resolve
+    to the lower id.
+    """
+    scores = metric.exact_scores(query, vectors[candidate_ids], norms[candidate_ids])
+    positions = top_k(scores, top)
+    return list(map(int, candidate_ids[positions])), list(map(float, metric.reported(scores[positions])))
+
+
+def canonical_conditions(conditions: Optional[dict]) -> str:
+    """
+    Key under which equivalent conditions are grouped: clauses of `and` / `or` / `not` are commutative
+    at any depth, so their order does not matter.
+    """
+    if not conditions:
+        return ""
+    return json.dumps(_canonical_tree(conditions), sort_keys=True)
+
+
+def _canonical_tree(conditions: dict) -> dict:
+    return {
+        operator: sorted(
+            json.dumps({
+                key: _canonical_tree({key: value})[key] if key in OPERATORS and isinstance(value, list) else value
+                for key, value in clause.items()
+            }, sort_keys=True)
+            for clause in clauses
+        )
+        for operator, clauses in conditions.items()
+    }
+
+
+class ExactSearch:
+    """
+    Brute-force ground truth over a fixed set of vectors, by `metric` (see `generators.metrics`).
+    Vector norms are computed once.
+
+    Subclasses may scan the vectors differently, but must return a superset of the exact top
+    to `rerank`, which guarantees results identical to the brute force.
+    """
+
+    def __init__(self, vectors: np.ndarray, metric: Union[str, Metric] = "cosine"):
+        self.vectors = vectors
+        self.metric = get_metric(metric)
+        self.norms = self.metric.norms(vectors)
+
+    def search_many(
+            self,
+            queries: np.ndarray,
+            ids: Optional[np.ndarray] = None,
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """
+        Search a batch of queries among the rows `ids` (sorted, all rows if None).
+        Rows are gathered once and scored for all queries with a single matrix product,
+        rows which may reach the top are then re-scored exactly.
+        """
+        queries = np.asarray(queries)
+        if ids is None:
+            ids = np.arange(len(self.vectors))
+            subset, norms = self.vectors, self.norms
+        else:
+            with profiler().stage("gather", rows=len(ids)) as stage:
+                subset, norms = self.vectors[ids], self.norms[ids]
+                stage.bytes = subset.nbytes
+        if len(ids) == 0:
+            return [([], []) for _ in range(len(queries))]
+
+        results = []
+        queries_per_batch = max(1, MAX_SCORE_ELEMENTS // len(ids))
+        for start in range(0, len(queries), queries_per_batch):
+            batch = queries[start:start + queries_per_batch]
+            with profiler().stage("score", rows=len(ids) * len(batch), queries=len(batch)):
+                scores = self.metric.approx_scores(batch, subset, norms)
+            with profiler().stage("rerank", queries=len(batch)) as stage:
+                for query, query_scores in zip(batch, scores):
+                    candidates = candidate_band(query_scores, self.metric.error_radius(query, norms), top)
+                    results.append(rerank(query, ids[candidates], self.vectors, self.norms, top, self.metric))
+                    stage.rows += len(candidates)
+        return results
+
+    def search_filtered(
+            self,
+            queries: np.ndarray,
+            conditions: Optional[dict],
+            evaluator: FilterEvaluator,
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """
+        Search queries sharing a filter: the filter is evaluated and its rows gathered once.
+        """
+        with profiler().stage("filter", rows=len(evaluator) if conditions else 0):
+            ids = evaluator.bitset(conditions).to_indices() if conditions else None
+        return self.search_many(queries, ids=ids, top=top)
+
+    def search_grouped(
+            self,
+            queries: np.ndarray,
+            conditions: List[Optional[dict]],
+            evaluator: FilterEvaluator,
+            top: int = 25,
+            search_group: Optional[Callable[[np.ndarray, Optional[dict]], List[Tuple[List[int], List[float]]]]] = None,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """
+        Search a whole query set. Queries are grouped by their canonical condition, each group is searched
+        by `search_group(queries, conditions)`, `search_filtered` by default. Results are returned in the original order.
+        """
+        search_group = search_group or partial(self.search_filtered, evaluator=evaluator, top=top)
+        queries = np.asarray(queries)
+        groups = defaultdict(list)
+        for query_id, query_conditions in enumerate(conditions):
+            groups[canonical_conditions(query_conditions)].append(query_id)
+
+        results = [None] * len(queries)
+        for query_ids in groups.values():
+            group_results = search_group(queries[query_ids], conditions[query_ids[0]])
+            for query_id, result in zip(query_ids, group_results):
+                results[query_id] = result
+        return results
+
+
+class ScoredQuery:
+    """
+    Scores of one query against every row, computed once and shared by many filters.
+
+    The top of a filter is found by walking rows in score order and checking the filter on them,
+    until no unchecked row can reach the `top`-th matching one. Results are identical to `ExactSearch`.
+    """
+
+    def __init__(self, search: ExactSearch, query: np.ndarray):
+        self.search = search
+        self.query = query
+        with profiler().stage("score", rows=len(search.vectors), queries=1):
+            self.scores = search.metric.approx_scores(query, search.vectors, search.norms)
+        # Scalar or per row, `max_radius` bounds the error of rows which were not checked yet
+        self.radius = search.metric.error_radius(query, search.norms)
+        self.max_radius = float(np.max(self.radius)) if len(self.scores) else 0.0
+        self.order = np.empty(0, dtype=np.int64)
+        # Rows checked against filters by all walks, for diagnostics
+        self.checked_rows = 0
+
+    def ordered(self, size: int) -> np.ndarray:
+        """
+        Ids of the `size` best rows, best first, ties by the lower id.
+        The prefix is extended on demand, so it is consistent between calls.
+        """
+        size = min(size, len(self.scores))
+        if size > len(self.order):
+            self.order = top_k(self.scores, size)
+        return self.order[:size]
+
+    def top(
+            self,
+            conditions: Optional[dict],
+            evaluator: FilterEvaluator,
+            top: int = 25,
+            selectivity: float = 1.0,
+    ) -> Tuple[List[int], List[float]]:
+        """
+        `selectivity` - expected fraction of matching rows, used to size the first step of the walk.
+        """
+        if not conditions:
+            matched = np.arange(len(self.scores))
+        else:
+            with profiler().stage("walk") as stage:
+                checked_before = self.checked_rows
+                matched = self._walk(conditions, evaluator, top, selectivity)
+                stage.rows = self.checked_rows - checked_before
+            if matched is None:
+                # Selective filter, evaluating it over all rows is cheaper than walking further
+                with profiler().stage("filter", rows=len(evaluator)):
+                    matched = evaluator.bitset(conditions).to_indices()
+
+        if len(matched) == 0:
+            return [], []
+        with profiler().stage("rerank", queries=1) as stage:
+            candidates = np.sort(matched[candidate_band(self.scores[matched], self._radius(matched), top)])
+            stage.rows = len(candidates)
+            return rerank(self.query, candidates, self.search.vectors, self.search.norms, top, self.search.metric)
+
+    def _radius(self, ids: np.ndarray):
+        return self.radius[ids] if np.ndim(self.radius) else self.radius
+
+    def _walk(self, conditions: dict, evaluator: FilterEvaluator, top: int, selectivity: float) -> Optional[np.ndarray]:
+        """
+        Matching rows among the best ones, enough to contain the exact top.
+        None if the walk reaches `MAX_WALK_FRACTION` of rows.
+        """
+        size = len(self.scores)
+        end = min(size, max(4 * top, int(2 * top / max(selectivity, 1e-9))))
+        checked = 0
+        matched = np.empty(0, dtype=np.int64)
+        while end <= max(size * MAX_WALK_FRACTION, 4 * top):
+            rows = self.ordered(end)[checked:]
+            matched = np.concatenate([matched, rows[evaluator.rows_mask(conditions, rows)]])
+            self.checked_rows += len(rows)
+            checked = end
+            if checked >= size:
+                return matched
+            if len(matched) >= top:
+                # Unchecked rows score at most the last checked one
+                lower = self.scores[matched] - self._radius(matched)
+                threshold = np.partition(lower, len(lower) - top)[len(lower) - top]
+                if self.scores[self.order[checked - 1]] + self.max_radius < threshold:
+                    return matched
+            end = min(size, end * 4)
+        return None
@@ -0,0 +1,309 @@
+"""
+Incremental maintenance of the ground truth of a dataset, e.g. to derive nested size tiers or update workloads
+without regenerating every test:
+
+* append - only the new rows are scored against the test queries, their top is merged into the stored one
+* delete - only the tests whose `closest_ids` contain a deleted row are searched again
+
+    python -m generators.incremental append laion/small --vectors extra.npy --payloads extra.jsonl --output laion/200k
+    python -m generators.incremental delete laion/small --keep-first 50000 --output laion/50k
+
+Results are identical to a full recompute over the resulting rows, ids of deleted datasets are compacted.
+Only tops up to the stored one can be maintained, a larger `--top` needs a full recompute.
+"""
+import argparse
+import json
+import os
+import shutil
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from generators.bitset import Bitset
+from generators.dataset import (
+    FILTERS_FILE,
+    PAYLOADS_FILE,
+    SCAN_CHUNK_BYTES,
+    TESTS_FILE,
+    VECTORS_FILE,
+    Dataset,
+    JsonLines,
+    write_metadata,
+)
+from generators.filters import FilterEvaluator
+from generators.ground_truth import ExactSearch, canonical_conditions, rerank
+from generators.metrics import Metric, get_metric
+from generators.output import RecordWriter
+from generators.profiling import profiler
+
+# Rows of vectors copied at once into the output dataset
+COPY_CHUNK_ROWS = 100_000
+
+
+def infer_top(tests: List[dict]) -> int:
+    """
+    Size of the stored top guessed from the tests: the longest `closest_ids`, shorter ones have fewer matching rows.
+    A lower bound, if every filter matches fewer rows than the top, see `stored_top`.
+    """
+    return max((len(test["closest_ids"]) for test in tests), default=0)
+
+
+def stored_top(dataset: Dataset, tests: List[dict]) -> int:
+    """
+    Size of the top the tests of `dataset` were generated with, recorded in its metadata or inferred from `tests`.
+    """
+    return int(dataset.metadata.get("top") or infer_top(tests))
+
+
+def check_top(top: int, stored: int):
+    # Rows beyond the stored top are unknown, merging them would silently lose neighbours
+    if top > stored:
+        raise ValueError(f"Tests hold a top of {stored}, a top of {top} needs a full recompute")
+
+
+def top_of(
+        query: np.ndarray,
+        candidate_ids: np.ndarray,
+        vectors: np.ndarray,
+        top: int,
+        metric: Metric,
+) -> Tuple[List[int], List[float]]:
+    """
+    Exact top among a few sorted candidates, only their rows are read and normed.
+    """
+    if len(candidate_ids) == 0:
+        return [], []
+    rows = np.asarray(vectors[candidate_ids])
+    positions, scores = rerank(query, np.arange(len(candidate_ids)), rows, metric.norms(rows), top, metric)
+    return [int(candidate_ids[position]) for position in positions], scores
+
+
+def append_rows(
+        tests: List[dict],
+        vectors: np.ndarray,
+        start: int,
+        payloads,
+        top: int,
+        metric: Union[str, Metric] = "cosine",
+        stored: Optional[int] = None,
+) -> List[dict]:
+    """
+    Tests of rows `:start` of `vectors` updated with the appended rows `start:`, whose payloads are `payloads`.
+    The exact top over all rows is within the stored top and the top of the new rows, so only the new rows are
+    searched, then both tops are re-scored together.
+    `top` can not exceed the size of the `stored` top, which is inferred from the tests if not given.
+    """
+    check_top(top, infer_top(tests) if stored is None else stored)
+    metric = get_metric(metric)
+    if len(tests) == 0 or start == len(vectors):
+        return list(tests)
+    queries = np.array([test["query"] for test in tests], dtype=np.float32)
+    with profiler().stage("append", rows=len(vectors) - start, queries=len(tests)):
+        new_results = ExactSearch(vectors[start:], metric).search_grouped(
+            queries, [test["conditions"] for test in tests], FilterEvaluator(payloads), top,
+        )
+
+    updated = []
+    with profiler().stage("merge", queries=len(tests)) as stage:
+        for test, query, (new_ids, _) in zip(tests, queries, new_results):
+            candidates = np.concatenate([
+                np.asarray(test["closest_ids"], dtype=np.int64),
+                np.asarray(new_ids, dtype=np.int64) + start,
+            ])
+            candidates.sort()
+            stage.rows += len(candidates)
+            closest_ids, closest_scores = top_of(query, candidates, vectors, top, metric)
+            updated.append({**test, "closest_ids": closest_ids, "closest_scores": closest_scores})
+    return updated
+
+
+def delete_rows(
+        tests: List[dict],
+        vectors: np.ndarray,
+        payloads,
+        deleted: np.ndarray,
+        top: int,
+        metric: Union[str, Metric] = "cosine",
+        stored: Optional[int] = None,
+) -> List[dict]:
+    """
+    Tests after deleting rows `deleted` (ids) of `vectors` with `payloads`, ids are compacted: remaining rows
+    keep their order. Tests whose top keeps all its rows are still exact, the others would drop below `top`,
+    so they are recomputed in full over the remaining rows.
+    `top` can not exceed the size of the `stored` top, which is inferred from the tests if not given.
+    """
+    check_top(top, infer_top(tests) if stored is None else stored)
+    metric = get_metric(metric)
+    deleted_mask = np.zeros(len(vectors), dtype=bool)
+    deleted_mask[np.asarray(deleted, dtype=np.int64)] = True
+    # New id of every remaining row
+    new_ids = np.cumsum(~deleted_mask) - 1
+
+    affected = [
+        test_id for test_id, test in enumerate(tests)
+        if deleted_mask[np.asarray(test["closest_ids"][:top], dtype=np.int64)].any()
+    ]
+    results = {}
+    if affected:
+        with profiler().stage("delete", rows=len(vectors), queries=len(affected)):
+            search = ExactSearch(vectors, metric)
+            evaluator = FilterEvaluator(payloads)
+            remaining = Bitset.from_mask(~deleted_mask)
+            groups = {}
+            for test_id in affected:
+                groups.setdefault(canonical_conditions(tests[test_id]["conditions"]), []).append(test_id)
+            for test_ids in groups.values():
+                conditions = tests[test_ids[0]]["conditions"]
+                ids = (evaluator.bitset(conditions) & remaining if conditions else remaining).to_indices()
+                queries = np.array([tests[test_id]["query"] for test_id in test_ids], dtype=np.float32)
+                for test_id, result in zip(test_ids, search.search_many(queries, ids=ids, top=top)):
+                    results[test_id] = result
+
+    updated = []
+    for test_id, test in enumerate(tests):
+        closest_ids, closest_scores = results.get(test_id, (test["closest_ids"][:top], test["closest_scores"][:top]))
+        closest_ids = new_ids[np.asarray(closest_ids, dtype=np.int64)].tolist()
+        updated.append({**test, "closest_ids": closest_ids, "closest_scores": list(closest_scores)})
+    return updated
+
+
+def _write_tests(tests: List[dict], path: str, precision: Optional[int]):
+    with RecordWriter(os.path.join(path, TESTS_FILE), precision=precision) as writer:
+        writer.submit(tests)
+
+
+def _copy_metadata(dataset: Dataset, path: str, top: int):
+    # Statistics and column stores describe the old rows, they are not copied
+    if os.path.exists(dataset.file(FILTERS_FILE)):
+        shutil.copyfile(dataset.file(FILTERS_FILE), os.path.join(path, FILTERS_FILE))
+    write_metadata(path, **{**dataset.metadata, "metric": dataset.metric, "top": top})
+
+
+def append_to_dataset(
+        dataset: Dataset,
+        vectors: np.ndarray,
+        payloads: List[dict],
+        path: str,
+        top: Optional[int] = None,
+        precision: Optional[int] = None,
+) -> Dataset:
+    """
+    Write the dataset extended with `vectors` and `payloads` into `path`, with incrementally updated tests.
+    `top` defaults to the size of the stored top, and can not exceed it.
+    """
+    if len(vectors) != len(payloads):
+        raise ValueError(f"Got {len(vectors)} vectors and {len(payloads)} payloads")
+    if path == dataset.path:
+        raise ValueError("Output directory must differ from the dataset directory")
+    tests = list(dataset.tests)
+    stored = stored_top(dataset, tests)
+    top = top or stored
+    check_top(top, stored)
+    os.makedirs(path, exist_ok=True)
+    start = len(dataset)
+
+    output = np.lib.format.open_memmap(
+        os.path.join(path, VECTORS_FILE), mode="w+", dtype=dataset.vectors.dtype,
+        shape=(start + len(vectors), dataset.dim),
+    )
+    for chunk_start in range(0, start, COPY_CHUNK_ROWS):
+        chunk_stop = min(chunk_start + COPY_CHUNK_ROWS, start)
+        output[chunk_start:chunk_stop] = dataset.vectors[chunk_start:chunk_stop]
+    output[start:] = vectors
+    output.flush()
+
+    with open(os.path.join(path, PAYLOADS_FILE), "wb") as out:
+        with open(dataset.file(PAYLOADS_FILE), "rb") as source:
+            shutil.copyfileobj(source, out, SCAN_CHUNK_BYTES)
+            # The last line may miss its newline
+            if out.tell() > 0:
+                source.seek(-1, os.SEEK_END)
+                if source.read(1) != b"\n":
+                    out.write(b"\n")
+        for payload in payloads:
+            out.write(json.dumps(payload).encode() + b"\n")
+
+    tests = append_rows(tests, output, start, payloads, top, dataset.metric, stored)
+    _write_tests(tests, path, precision)
+    _copy_metadata(dataset, path, top)
+    return Dataset(path)
+
+
+def delete_from_dataset(
+        dataset: Dataset,
+        deleted: np.ndarray,
+        path: str,
+        top: Optional[int] = None,
+        precision: Optional[int] = None,
+) -> Dataset:
+    """
+    Write the dataset without rows `deleted` into `path`, with incrementally updated tests and compacted ids.
+    `top` defaults to the size of the stored top, and can not exceed it.
+    """
+    if path == dataset.path:
+        raise ValueError("Output directory must differ from the dataset directory")
+    tests = list(dataset.tests)
+    stored = stored_top(dataset, tests)
+    top = top or stored
+    check_top(top, stored)
+    os.makedirs(path, exist_ok=True)
+    keep = np.ones(len(dataset), dtype=bool)
+    keep[np.asarray(deleted, dtype=np.int64)] = False
+
+    output = np.lib.format.open_memmap(
+        os.path.join(path, VECTORS_FILE), mode="w+", dtype=dataset.vectors.dtype,
+        shape=(int(keep.sum()), dataset.dim),
+    )
+    written = 0
+    for chunk_start in range(0, len(dataset), COPY_CHUNK_ROWS):
+        chunk = np.asarray(dataset.vectors[chunk_start:chunk_start + COPY_CHUNK_ROWS])
+        chunk = chunk[keep[chunk_start:chunk_start + COPY_CHUNK_ROWS]]
+        output[written:written + len(chunk)] = chunk
+        written += len(chunk)
+    output.flush()
+
+    payloads = JsonLines(dataset.file(PAYLOADS_FILE))
+    with open(os.path.join(path, PAYLOADS_FILE), "wb") as out:
+        for row in np.flatnonzero(keep):
+            out.write(payloads.raw(row) + b"\n")
+
+    tests = delete_rows(tests, dataset.vectors, dataset.columns, np.flatnonzero(~keep), top, dataset.metric, stored)
+    _write_tests(tests, path, precision)
+    _copy_metadata(dataset, path, top)
+    return Dataset(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append rows to or delete rows from a dataset, updating its tests")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    append_parser = subparsers.add_parser("append", help="append vectors and payloads")
+    append_parser.add_argument("dataset", help="dataset path or name relative to DATA_DIR")
+    append_parser.add_argument("--vectors", required=True, help="npy matrix of the new vectors")
+    append_parser.add_argument("--payloads", required=True, help="jsonl payloads of the new vectors")
+
+    delete_parser = subparsers.add_parser("delete", help="delete rows")
+    delete_parser.add_argument("dataset", help="dataset path or name relative to DATA_DIR")
+    deleted_group = delete_parser.add_mutually_exclusive_group(required=True)
+    deleted_group.add_argument("--ids", help="npy array of deleted row ids")
+    deleted_group.add_argument("--keep-first", type=int, help="delete every row after the first N")
+
+    for command_parser in (append_parser, delete_parser):
+        command_parser.add_argument("--output", required=True, help="output dataset directory")
+        command_parser.add_argument("--top", type=int, default=None, help="size of the top, at most the stored one (default)")
+        command_parser.add_argument("--precision", type=int, default=None)
+    args = parser.parse_args()
+
+    source = Dataset.open(args.dataset)
+    if args.command == "append":
+        append_to_dataset(
+            source,
+            np.load(args.vectors, mmap_mode="r"),
+            list(JsonLines(args.payloads)),
+            args.output,
+            top=args.top,
+            precision=args.precision,
+        )
+    else:
+        deleted_ids = np.load(args.ids) if args.ids else np.arange(args.keep_first, len(source))
+        delete_from_dataset(source, deleted_ids, args.output, top=args.top, precision=args.precision)
@@ -1,6 +1,4 @@
-import json
 import os
-import random
 from typing import Iterable, Tuple
 
 import pandas as pd
@@ -8,9 +6,13 @@ import numpy as np
 import tqdm
 
 from generators.config import DATA_DIR
+from generators.dataset import write_metadata
+from generators.ground_truth import ExactSearch
+from generators.output import RecordWriter
 from generators.search_generator.qdrant_generator import index_qdrant, search_qdrant
 
 SAMPLE_SIZE = 100_000
+SEED = 42
 
 
 def get_img_url(part: int) -> str:
@@ -42,20 +44,19 @@ def generate_queries(
         embeddings: np.ndarray,
         other_embeddings: np.ndarray,
         metadata: pd.DataFrame,
-        n: int = 10
+        n: int = 10,
+        seed: int = None,
 ) -> Iterable[dict]:
-    other_embeddings_len = other_embeddings.shape[0]
+    rng = np.random.default_rng(seed)
+    random_embeddings = other_embeddings[rng.integers(other_embeddings.shape[0], size=n)]
 
-    for _ in tqdm.tqdm(range(n)):
-        # get random embedding
-        random_idx = np.random.randint(other_embeddings_len)
-        random_embedding = other_embeddings[random_idx]
+    # Nearest embedding by L2 distance, scored with norms and a matrix product instead of a copy of
+    # `embeddings` per query
+    search = ExactSearch(embeddings, metric="l2")
+    results = search.search_many(random_embeddings, top=1)
 
-        # get distance
-        distances = np.linalg.norm(embeddings - random_embedding, axis=1)
-
-        # get closest
-        closest_idx = np.argmin(distances)
+    for random_embedding, (closest_ids, _) in zip(random_embeddings, tqdm.tqdm(results)):
+        closest_idx = closest_ids[0]
         closest_embedding = embeddings[closest_idx]
 
         # get metadata
@@ -68,7 +69,7 @@ def generate_queries(
         }
 
 
-def filter_generator() -> Tuple[dict, dict]:
+def filter_generator(rng: np.random.Generator) -> Tuple[dict, dict]:
     return {}, {}
 
 def main():
@@ -97,17 +98,20 @@ def main():
 
     tests_path = os.path.join(path, "tests.jsonl")
 
-    with open(tests_path, "w") as f:
+    # Results are encoded and written in the background while the next searches run
+    with RecordWriter(tests_path) as writer:
         for query in tqdm.tqdm(search_qdrant(
                 sample_embeddings=other_embeddings,
                 filter_generator=filter_generator,
                 n=5000,
-                top=10
+                top=10,
+                seed=SEED,
         )):
-            f.write(f"{json.dumps(query)}\n")
+            writer.write(query)
 
     # save embeddings
     np.save(os.path.join(path, "vectors.npy"), embeddings_sample)
+    write_metadata(path, metric="cosine", top=10)
 
     # save metadata
     payload_path = os.path.join(path, "payloads.jsonl")
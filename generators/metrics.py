@@ -0,0 +1,176 @@
+from typing import Union
+
+import numpy as np
+
+EPS32 = float(np.finfo(np.float32).eps)
+
+
+def row_norms(vectors: np.ndarray, chunk_size: int = 100_000, replace_zeros: bool = True) -> np.ndarray:
+    """
+    L2 norms of rows in float64, computed in chunks so memory-mapped vectors are streamed.
+    Zero norms are replaced by 1 unless `replace_zeros` is False, so zero vectors get zero cosine similarity
+    instead of NaN.
+    """
+    norms = np.empty(len(vectors), dtype=np.float64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float64)
+        norms[start:start + chunk_size] = np.sqrt(np.einsum("ij,ij->i", chunk, chunk))
+    if replace_zeros:
+        norms[norms == 0] = 1
+    return norms
+
+
+def normalize_queries(queries: np.ndarray) -> np.ndarray:
+    queries = np.asarray(queries, dtype=np.float32)
+    query_norms = np.linalg.norm(queries, axis=-1, keepdims=True)
+    return queries / np.where(query_norms == 0, 1, query_norms)
+
+
+def cosine_scores(queries: np.ndarray, vectors: np.ndarray, norms: np.ndarray = None) -> np.ndarray:
+    """
+    Fast float32 cosine similarity of a query (1-d) or a batch of queries (2-d) to every row of `vectors`.
+
+    BLAS results depend on the shape of the operands, so these scores are only accurate
+    up to `score_error_bound` and are used to select candidates for `exact_scores`.
+    """
+    if norms is None:
+        norms = row_norms(vectors)
+    return (normalize_queries(queries) @ np.asarray(vectors, dtype=np.float32).T) / norms.astype(np.float32)
+
+
+def score_error_bound(dim: int) -> float:
+    """
+    Bound on the difference between `cosine_scores` and `exact_scores` of the same row.
+    """
+    return 2 * (dim + 4) * float(np.finfo(np.float32).eps)
+
+
+def exact_scores(query: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+    """
+    Reference cosine similarity, reported in `closest_scores`. Each row is reduced on its own
+    in float64, so the score of a row does not depend on which other rows are scored with it.
+    """
+    query = np.asarray(query, dtype=np.float64)
+    query_norm = np.sqrt(np.einsum("i,i->", query, query)) or 1.0
+    dots = np.einsum("ij,j->i", np.asarray(rows, dtype=np.float64), query)
+    return (dots / (norms * query_norm)).astype(np.float32)
+
+
+class Metric:
+    """
+    Scoring rule of a dataset. Scores are oriented so that higher is better, the exact top is selected as
+    in `ExactSearch`: fast float32 scores of every row, a per-query error radius around them, and exact
+    float64 re-scoring of the rows which may reach the top.
+
+    `norms` are per-row statistics computed once for the whole base and passed back to the kernels,
+    sliced to the scored rows.
+    """
+
+    name: str
+
+    def norms(self, vectors: np.ndarray) -> np.ndarray:
+        return row_norms(vectors, replace_zeros=False)
+
+    def approx_scores(self, queries: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        """
+        float32 scores of a query (1-d) or a batch of queries (2-d) to every row, a single matrix product.
+        """
+        raise NotImplementedError()
+
+    def error_radius(self, query: np.ndarray, norms: np.ndarray) -> Union[float, np.ndarray]:
+        """
+        Bound on |approx_scores - exact_scores| of rows with `norms` for `query`, scalar or per row.
+        """
+        raise NotImplementedError()
+
+    def exact_scores(self, query: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        """
+        Reference scores, each row reduced on its own in float64 and rounded to float32.
+        """
+        raise NotImplementedError()
+
+    def reported(self, scores: np.ndarray) -> np.ndarray:
+        """
+        Values written to `closest_scores` for exact scores of the top.
+        """
+        return scores
+
+
+class Cosine(Metric):
+    name = "cosine"
+
+    def norms(self, vectors: np.ndarray) -> np.ndarray:
+        return row_norms(vectors)
+
+    def approx_scores(self, queries: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        return cosine_scores(queries, rows, norms)
+
+    def error_radius(self, query: np.ndarray, norms: np.ndarray) -> float:
+        return score_error_bound(len(query))
+
+    def exact_scores(self, query: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        return exact_scores(query, rows, norms)
+
+
+class Dot(Metric):
+    name = "dot"
+
+    def approx_scores(self, queries: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        return np.asarray(queries, dtype=np.float32) @ np.asarray(rows, dtype=np.float32).T
+
+    def error_radius(self, query: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        # |q . x| <= |q| |x|, float32 accumulation error grows with the dimension
+        query_norm = float(np.linalg.norm(np.asarray(query, dtype=np.float64)))
+        return 2 * (len(query) + 4) * EPS32 * query_norm * norms + np.finfo(np.float32).tiny
+
+    def exact_scores(self, query: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        return np.einsum("ij,j->i", np.asarray(rows, dtype=np.float64), np.asarray(query, dtype=np.float64)) \
+            .astype(np.float32)
+
+
+class L2(Metric):
+    """
+    Euclidean distance, scored as the negative squared distance `2 q.x - |x|^2 - |q|^2`, so it is a matrix
+    product plus precomputed norms without a per-query N x D difference. Reported scores are distances.
+    """
+
+    name = "l2"
+
+    def approx_scores(self, queries: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32)
+        squared_norms = (norms ** 2).astype(np.float32)
+        query_squared_norms = np.einsum("...i,...i->...", queries, queries)[..., None]
+        scores = queries @ np.asarray(rows, dtype=np.float32).T
+        scores *= 2
+        scores -= squared_norms
+        scores -= query_squared_norms
+        return scores
+
+    def error_radius(self, query: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        # Every term is bounded by (|q| + |x|)^2
+        query_norm = float(np.linalg.norm(np.asarray(query, dtype=np.float64)))
+        return 2 * (len(query) + 4) * EPS32 * (query_norm + norms) ** 2 + np.finfo(np.float32).tiny
+
+    def exact_scores(self, query: np.ndarray, rows: np.ndarray, norms: np.ndarray) -> np.ndarray:
+        # Only the candidate rows are re-scored, so the difference is small
+        differences = np.asarray(rows, dtype=np.float64) - np.asarray(query, dtype=np.float64)
+        return (-np.einsum("ij,ij->i", differences, differences)).astype(np.float32)
+
+    def reported(self, scores: np.ndarray) -> np.ndarray:
+        return np.sqrt(-scores)
+
+
+COSINE = Cosine()
+
+METRICS = {
+    metric.name: metric
+    for metric in (COSINE, Dot(), L2())
+}
+
+
+def get_metric(metric: Union[str, Metric]) -> Metric:
+    if isinstance(metric, Metric):
+        return metric
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}, expected one of {list(METRICS)}")
+    return METRICS[metric]
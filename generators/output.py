@@ -0,0 +1,168 @@
+import bz2
+import gzip
+import json
+import lzma
+import queue
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional
+
+import numpy as np
+
+from generators.profiling import profiler
+
+COMPRESSIONS = {
+    "gzip": gzip.open,
+    "bz2": bz2.open,
+    "xz": lzma.open,
+}
+
+
+def _encodable(value, precision: Optional[int]):
+    if isinstance(value, np.ndarray):
+        if precision is not None and value.dtype.kind == "f":
+            return np.round(value.astype(np.float64), precision).tolist()
+        return value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if precision is not None:
+        if isinstance(value, float):
+            return round(value, precision)
+        if isinstance(value, list) and all(isinstance(item, float) for item in value):
+            return [round(item, precision) for item in value]
+    return value
+
+
+def _json_default(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_records(records: List[dict], precision: Optional[int] = None) -> List[str]:
+    """
+    JSON lines of `records`. Numpy values are converted to plain ones. With `precision`, top-level floats,
+    float arrays and lists of floats are rounded to that many decimals, conditions are kept as is.
+    """
+    return [
+        json.dumps({key: _encodable(value, precision) for key, value in record.items()}, default=_json_default) + "\n"
+        for record in records
+    ]
+
+
+def _encode_chunk(records: List[dict], precision: Optional[int]) -> List[str]:
+    with profiler().stage("encode", rows=len(records)):
+        return encode_records(records, precision)
+
+
+class RecordWriter:
+    """
+    Background output stage: compute threads submit records, a pool encodes them into JSON lines
+    and a writer thread outputs the chunks in submission order.
+
+    The queue of pending chunks is bounded, so a slow disk throttles the producer instead of buffering
+    the whole output in memory. Errors of encoding or writing are raised on the next `submit` or on `close`.
+
+    `path` - output file, compressed if `compression` is one of `COMPRESSIONS`.
+        May be None if every chunk is submitted with its own `sink`.
+    `precision` - number of decimals of float values, full precision if None.
+    `workers` - number of encoding workers, `processes` uses a process pool instead of threads.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            precision: Optional[int] = None,
+            compression: Optional[str] = None,
+            workers: int = 2,
+            processes: bool = False,
+            max_pending: int = 8,
+            chunk_size: int = 1000,
+    ):
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {compression}, expected one of {list(COMPRESSIONS)}")
+
+        self.precision = precision
+        self.chunk_size = chunk_size
+        self.file = None
+        if path is not None:
+            self.file = COMPRESSIONS[compression](path, "wt") if compression else open(path, "w")
+
+        self.executor: Executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+        self.pending: "queue.Queue[Optional[tuple]]" = queue.Queue(maxsize=max_pending)
+        self.buffer: List[dict] = []
+        self.error: Optional[BaseException] = None
+        self.written = 0
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def __enter__(self) -> "RecordWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # An exception of the `with` body is not replaced by an error of the background stage
+        self.close(raise_error=exc_type is None)
+
+    def write(self, record: dict):
+        """
+        Buffer a single record, buffered records are submitted in chunks of `chunk_size`.
+        """
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            records, self.buffer = self.buffer, []
+            self.submit(records)
+
+    def submit(self, records: List[dict], sink: Callable[[List[str]], None] = None):
+        """
+        Encode `records` in the background. Encoded lines are passed to `sink` if given,
+        otherwise written to the output file. Blocks while `max_pending` chunks are waiting.
+        """
+        self._raise_error()
+        if sink is not None:
+            # Records of an explicit chunk must be ordered after the buffered ones
+            self.flush()
+        future = self.executor.submit(partial(_encode_chunk, precision=self.precision), records)
+        self.pending.put((future, sink))
+
+    def close(self, raise_error: bool = True):
+        """
+        Write the pending chunks and stop the background stage, then raise its error unless `raise_error` is False.
+        """
+        if self.error is None:
+            self.flush()
+        self.pending.put(None)
+        self.writer.join()
+        self.executor.shutdown()
+        if self.file is not None:
+            self.file.close()
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Drain the queue, so the producer is not blocked after a failure
+                continue
+            future, sink = item
+            try:
+                lines = future.result()
+                with profiler().stage("write", rows=len(lines), bytes=sum(map(len, lines))):
+                    if sink is not None:
+                        sink(lines)
+                    else:
+                        self.file.writelines(lines)
+                self.written += len(lines)
+            except BaseException as error:
+                self.error = error
@@ -0,0 +1,196 @@
+from collections import Counter
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from generators.filters import (
+    RANDOM_ACCESS_PENALTY,
+    FilterEvaluator,
+    clause_nodes,
+    dictionary_positions,
+    match_values,
+    predicates,
+    tree_operator,
+)
+from generators.ground_truth import ExactSearch, ScoredQuery
+from generators.profiling import profiler
+
+# Gathering a row costs about as much as scoring it twice
+GATHER_COST = 2
+
+
+@dataclass
+class Plan:
+    """
+    Strategy chosen for a filter:
+
+    * `index` - every predicate is a cached bitset, matching rows are gathered directly
+    * `prefilter` - evaluate the filter over all rows, then gather and score the matching ones
+    * `postfilter` - score all rows, check the filter only for the best candidates
+    """
+    strategy: str
+    selectivity: float
+    estimated_cost: float
+
+
+class SelectivityEstimator:
+    """
+    Fraction of rows matching a condition, estimated from column statistics:
+    value frequencies of keyword and multi-valued keyword columns, sorted copies of numeric columns
+    and a row sample for the rest.
+    Clauses of `and` / `or` / `not` trees are assumed to be independent.
+    """
+
+    def __init__(self, evaluator: FilterEvaluator, sample_size: int = 10_000, seed: int = 0):
+        self.evaluator = evaluator
+        rng = np.random.default_rng(seed)
+        size = len(evaluator)
+        self.sample = np.sort(rng.choice(size, size=min(sample_size, size), replace=False))
+        self.statistics: Dict[str, tuple] = {}
+
+    def _statistics(self, field: str) -> tuple:
+        if field not in self.statistics:
+            kind, column = self.evaluator.columns.column(field)
+            if kind == "keyword":
+                dictionary, codes = column
+                self.statistics[field] = (dictionary, np.bincount(codes, minlength=len(dictionary)) / len(codes))
+            elif kind == "multi_keyword":
+                # Values are unique within a row, so value counts are row counts
+                dictionary, offsets, codes = column
+                frequencies = np.bincount(codes, minlength=len(dictionary)) / max(len(offsets) - 1, 1)
+                self.statistics[field] = (dictionary, frequencies)
+            elif kind == "number":
+                self.statistics[field] = (np.sort(column[0]),)
+            else:
+                self.statistics[field] = ()
+        return self.statistics[field]
+
+    def estimate(self, conditions: Optional[dict]) -> float:
+        if not conditions:
+            return 1.0
+        operator, clauses = tree_operator(conditions)
+        selectivities = [
+            self.estimate(node) if isinstance(node, dict) else self.clause(*node)
+            for node in clause_nodes(clauses)
+        ]
+        if operator == "and":
+            return float(np.prod(selectivities))
+        none_match = float(np.prod([1 - selectivity for selectivity in selectivities]))
+        return 1 - none_match if operator == "or" else none_match
+
+    def clause(self, field: str, condition: dict) -> float:
+        kind, _ = self.evaluator.columns.column(field)
+        statistics = self._statistics(field)
+
+        if kind == "keyword" and 'match' in condition:
+            dictionary, frequencies = statistics
+            return float(frequencies[dictionary_positions(dictionary, match_values(condition['match']))].sum())
+
+        if kind == "multi_keyword" and 'match' in condition:
+            dictionary, frequencies = statistics
+            # Rows of different values overlap, assume they are independent
+            positions = dictionary_positions(dictionary, match_values(condition['match']))
+            return 1 - float(np.prod(1 - frequencies[positions]))
+
+        if kind == "number" and 'match' in condition:
+            values, = statistics
+            count = sum(
+                np.searchsorted(values, value, side="right") - np.searchsorted(values, value, side="left")
+                for value in set(match_values(condition['match']))
+            )
+            return count / len(values)
+
+        if kind == "number" and 'range' in condition:
+            values, = statistics
+            bounds = condition['range']
+            low = np.searchsorted(values, bounds['gt'], side="right") if 'gt' in bounds else 0
+            low = max(low, np.searchsorted(values, bounds['gte'], side="left")) if 'gte' in bounds else low
+            high = np.searchsorted(values, bounds['lt'], side="left") if 'lt' in bounds else len(values)
+            high = min(high, np.searchsorted(values, bounds['lte'], side="right")) if 'lte' in bounds else high
+            return max(0, high - low) / len(values)
+
+        return float(self.evaluator.condition_rows(field, condition, self.sample).mean())
+
+
+class QueryPlanner:
+    """
+    Picks the cheapest exact strategy for each filter and records the choice for diagnostics.
+    All strategies return results identical to `ExactSearch`.
+    """
+
+    def __init__(self, engine: ExactSearch, evaluator: FilterEvaluator):
+        self.engine = engine
+        self.evaluator = evaluator
+        self.estimator = SelectivityEstimator(evaluator)
+        if evaluator.estimator is None:
+            # Clauses of filters are ordered by these estimates too
+            evaluator.estimator = self.estimator
+        self.history: List[Plan] = []
+
+    def plan(self, conditions: Optional[dict], num_queries: int = 1, top: int = 25) -> Plan:
+        size, dim = self.engine.vectors.shape
+        selectivity = self.estimator.estimate(conditions)
+        if not conditions:
+            return Plan("index", selectivity, size * dim)
+
+        clauses = predicates(conditions)
+        all_cached = all(self.evaluator.is_cached(field, condition) for field, condition in clauses)
+        predicates_cost = self.evaluator.node_cost(conditions)
+
+        # Filter and gather are shared by all queries with this filter, scoring is per query
+        prefilter_cost = size * predicates_cost + selectivity * size * dim * (GATHER_COST + num_queries)
+        # Post-filter checks about `2 * top / selectivity` best rows per query
+        candidates = min(size, 2 * top / max(selectivity, 1 / size))
+        postfilter_cost = num_queries * (size * dim + candidates * predicates_cost * RANDOM_ACCESS_PENALTY)
+
+        if postfilter_cost < prefilter_cost:
+            return Plan("postfilter", selectivity, postfilter_cost)
+        return Plan("index" if all_cached else "prefilter", selectivity, prefilter_cost)
+
+    def summary(self) -> dict:
+        return dict(Counter(plan.strategy for plan in self.history))
+
+    def search_grouped(
+            self,
+            queries: np.ndarray,
+            conditions: List[Optional[dict]],
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        """
+        Same as `ExactSearch.search_grouped`, but each group of queries sharing a filter is executed
+        with the strategy chosen by `plan`.
+        """
+        return self.engine.search_grouped(
+            queries, conditions, self.evaluator, top=top, search_group=partial(self.search_group, top=top),
+        )
+
+    def search_group(
+            self,
+            queries: np.ndarray,
+            conditions: Optional[dict],
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        with profiler().stage("plan"):
+            plan = self.plan(conditions, num_queries=len(queries), top=top)
+        self.history.extend([plan] * len(queries))
+
+        if plan.strategy == "postfilter":
+            return [self.post_filter(query, conditions, top, plan.selectivity) for query in queries]
+        return self.engine.search_filtered(queries, conditions, self.evaluator, top=top)
+
+    def search(self, query: np.ndarray, conditions: Optional[dict], top: int = 25) -> Tuple[List[int], List[float]]:
+        return self.search_grouped(np.asarray(query)[None], [conditions], top=top)[0]
+
+    def post_filter(
+            self,
+            query: np.ndarray,
+            conditions: dict,
+            top: int,
+            selectivity: float,
+    ) -> Tuple[List[int], List[float]]:
+        """
+        Score all rows, check the filter for the best candidates only, see `ScoredQuery`.
+        """
+        return ScoredQuery(self.engine, query).top(conditions, self.evaluator, top, selectivity)
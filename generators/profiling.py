@@ -0,0 +1,204 @@
+import atexit
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+# Set to a report path to profile any generator run, e.g. `GENERATORS_PROFILE=profile.json python -m ...`
+PROFILE_ENV = "GENERATORS_PROFILE"
+# Set to `pyinstrument` to also run a sampling profiler, its HTML report is saved next to the JSON one
+SAMPLER_ENV = "GENERATORS_PROFILE_SAMPLER"
+
+COUNTERS = ("seconds", "calls", "rows", "bytes", "queries")
+
+
+class StageSample:
+    """
+    Counters of a single `Profiler.stage` call, may be updated inside the block once they are known.
+    """
+    __slots__ = ("rows", "bytes", "queries")
+
+    def __init__(self, rows: int = 0, bytes: int = 0, queries: int = 0):
+        self.rows = rows
+        self.bytes = bytes
+        self.queries = queries
+
+
+class Profiler:
+    """
+    Accumulates wall time, rows scanned, bytes gathered and queries per named stage.
+    Stages may be entered from several threads, nested stages are counted in both.
+    """
+
+    enabled = True
+
+    def __init__(self, sampler=None):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # Optional sampling profiler, any object with `start` and `stop`
+        self.sampler = sampler
+        if sampler is not None:
+            sampler.start()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0, bytes: int = 0, queries: int = 0):
+        sample = StageSample(rows, bytes, queries)
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.add(name, time.perf_counter() - start, rows=sample.rows, bytes=sample.bytes, queries=sample.queries)
+
+    def add(self, name: str, seconds: float = 0.0, calls: int = 1, rows: int = 0, bytes: int = 0, queries: int = 0):
+        with self.lock:
+            stats = self.stages.setdefault(name, dict.fromkeys(COUNTERS, 0))
+            stats["seconds"] += seconds
+            stats["calls"] += calls
+            stats["rows"] += int(rows)
+            stats["bytes"] += int(bytes)
+            stats["queries"] += int(queries)
+
+    def drain(self) -> Dict[str, Dict[str, float]]:
+        """
+        Stages collected so far, counters are reset. Used to ship stats of worker processes to the parent.
+        """
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages: Dict[str, Dict[str, float]]):
+        for name, stats in stages.items():
+            self.add(name, **stats)
+
+    def report(self) -> dict:
+        wall_seconds = time.perf_counter() - self.started
+        stages = {}
+        with self.lock:
+            for name, stats in sorted(self.stages.items()):
+                seconds = stats["seconds"]
+                stages[name] = {
+                    **stats,
+                    "rows_per_second": stats["rows"] / seconds if seconds else None,
+                    "bytes_per_second": stats["bytes"] / seconds if seconds else None,
+                    "queries_per_second": stats["queries"] / seconds if seconds else None,
+                }
+        return {
+            "wall_seconds": wall_seconds,
+            "cpu_count": os.cpu_count(),
+            "stages": stages,
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as out:
+            json.dump(self.report(), out, indent=2)
+        if self.sampler is not None:
+            self.sampler.stop()
+            if hasattr(self.sampler, "output_html"):
+                with open(f"{os.path.splitext(path)[0]}.html", "w") as out:
+                    out.write(self.sampler.output_html())
+
+
+class NullProfiler:
+    """
+    Profiler used when profiling is off, every hook is a no-op.
+    """
+
+    enabled = False
+    _sample = StageSample()
+
+    @contextmanager
+    def stage(self, name: str, rows: int = 0, bytes: int = 0, queries: int = 0):
+        yield self._sample
+
+    def add(self, name: str, seconds: float = 0.0, calls: int = 1, rows: int = 0, bytes: int = 0, queries: int = 0):
+        pass
+
+    def drain(self) -> Dict[str, Dict[str, float]]:
+        return {}
+
+    def merge(self, stages: Dict[str, Dict[str, float]]):
+        pass
+
+
+_active = NullProfiler()
+
+
+def profiler():
+    """
+    Currently active profiler, a no-op one unless profiling is enabled.
+    """
+    return _active
+
+
+def make_sampler(name: Optional[str]):
+    if not name:
+        return None
+    if name == "pyinstrument":
+        try:
+            from pyinstrument import Profiler as SamplingProfiler
+        except ImportError:
+            raise ImportError("Sampling profiler requires pyinstrument: pip install pyinstrument")
+        return SamplingProfiler()
+    raise ValueError(f"Unknown sampling profiler: {name}")
+
+
+def enable_profiling(sampler: Optional[str] = None) -> Profiler:
+    global _active
+    _active = Profiler(make_sampler(sampler))
+    return _active
+
+
+def disable_profiling():
+    global _active
+    _active = NullProfiler()
+
+
+@contextmanager
+def profiled(report_path: Optional[str], sampler: Optional[str] = None):
+    """
+    Profile the block and write the JSON report to `report_path`. Does nothing if `report_path` is None.
+    """
+    if report_path is None:
+        yield profiler()
+        return
+    active = enable_profiling(sampler)
+    try:
+        yield active
+    finally:
+        active.save(report_path)
+        disable_profiling()
+
+
+def collect_stages(function: Callable, *args):
+    """
+    Run `function` in a worker process and return its result together with the stages it profiled,
+    the parent merges them with `profiler().merge`.
+    """
+    return function(*args), profiler().drain()
+
+
+def _reset_after_fork():
+    # Forked workers start with empty stages, otherwise the parent's stages would be shipped back twice
+    if _active.enabled:
+        _active.stages = {}
+        _active.lock = threading.Lock()
+        _active.sampler = None
+
+
+def _enable_from_environment():
+    report_path = os.environ.get(PROFILE_ENV)
+    if not report_path:
+        return
+    # Workers are profiled too, but only the main process samples and writes the report
+    if mp.parent_process() is None:
+        atexit.register(enable_profiling(os.environ.get(SAMPLER_ENV)).save, report_path)
+    else:
+        enable_profiling()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+_enable_from_environment()
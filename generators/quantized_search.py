@@ -0,0 +1,147 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from generators.ground_truth import (
+    MAX_SCORE_ELEMENTS,
+    ExactSearch,
+    candidate_band,
+    rerank,
+)
+from generators.metrics import normalize_queries
+from generators.profiling import profiler
+
+QUANTIZED_DTYPES = ("int8", "float16")
+
+
+class QuantizedVectors:
+    """
+    Compact copy of unit-normalized vectors, used to scan the base with fewer bytes per row.
+
+    * int8 - per-row scale, `row / |row| ~= scale * codes`
+    * float16 - `row / |row| ~= codes`, scale is 1
+
+    `errors` holds the exact L2 distance between each normalized row and its reconstruction,
+    which bounds the error of the approximate cosine of that row for any unit query.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray, errors: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+        self.errors = errors
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, dtype: str = "int8", chunk_size: int = 100_000) -> "QuantizedVectors":
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError(f"Unsupported quantization: {dtype}, expected one of {QUANTIZED_DTYPES}")
+
+        codes = np.empty(vectors.shape, dtype=dtype)
+        scales = np.ones(len(vectors), dtype=np.float32)
+        errors = np.empty(len(vectors), dtype=np.float64)
+
+        for start in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[start:start + chunk_size], dtype=np.float64)
+            norms = np.linalg.norm(chunk, axis=1, keepdims=True)
+            unit = chunk / np.where(norms == 0, 1, norms)
+
+            if dtype == "int8":
+                max_abs = np.abs(unit).max(axis=1)
+                chunk_scales = (np.where(max_abs == 0, 1, max_abs) / 127).astype(np.float32)
+                chunk_codes = np.clip(np.rint(unit / chunk_scales[:, None]), -127, 127).astype(np.int8)
+                scales[start:start + chunk_size] = chunk_scales
+                reconstructed = chunk_codes.astype(np.float64) * chunk_scales[:, None].astype(np.float64)
+            else:
+                chunk_codes = unit.astype(np.float16)
+                reconstructed = chunk_codes.astype(np.float64)
+
+            codes[start:start + chunk_size] = chunk_codes
+            errors[start:start + chunk_size] = np.linalg.norm(unit - reconstructed, axis=1)
+
+        return cls(codes, scales, errors)
+
+    @staticmethod
+    def _paths(prefix: str) -> Tuple[str, str]:
+        return f"{prefix}.codes.npy", f"{prefix}.meta.npz"
+
+    def save(self, prefix: str):
+        codes_path, meta_path = self._paths(prefix)
+        np.save(codes_path, self.codes, allow_pickle=False)
+        np.savez(meta_path, scales=self.scales, errors=self.errors)
+
+    @classmethod
+    def load(cls, prefix: str) -> "QuantizedVectors":
+        codes_path, meta_path = cls._paths(prefix)
+        meta = np.load(meta_path)
+        return cls(np.load(codes_path, mmap_mode="r"), meta["scales"], meta["errors"])
+
+    @classmethod
+    def open(cls, vectors_path: str, dtype: str = "int8") -> "QuantizedVectors":
+        """
+        Quantized sidecar of a `vectors.npy` file, built on first use and memory-mapped afterwards.
+        """
+        prefix = f"{os.path.splitext(vectors_path)[0]}.{dtype}"
+        if not os.path.exists(cls._paths(prefix)[1]):
+            cls.build(np.load(vectors_path, mmap_mode="r"), dtype=dtype).save(prefix)
+        return cls.load(prefix)
+
+    def error_radius(self, dim: int) -> np.ndarray:
+        """
+        Per-row bound on |approximate - exact| cosine: quantization error, float32 rounding
+        of the approximate dot product and rounding of the reported float32 score.
+        """
+        eps = float(np.finfo(np.float32).eps)
+        # Norm of the reconstructed row is at most 1 + error
+        return self.errors * (1 + 4 * eps) + 2 * (dim + 4) * eps * (2 + self.errors) + 2 * eps
+
+
+class QuantizedSearch(ExactSearch):
+    """
+    Two-phase exact search: scan the quantized copy to collect every row which may reach the top
+    within the error bound, then re-score only those rows from the float32 vectors.
+    Results are identical to `ExactSearch`, while the scan reads 2x (float16) or 4x (int8) fewer bytes.
+    """
+
+    def __init__(self, vectors: np.ndarray, quantized: QuantizedVectors = None, dtype: str = "int8"):
+        super().__init__(vectors)
+        self.quantized = quantized if quantized is not None else QuantizedVectors.build(vectors, dtype=dtype)
+        self.radius = self.quantized.error_radius(vectors.shape[1])
+
+    def approx_scores(self, queries: np.ndarray, ids: Optional[np.ndarray]) -> np.ndarray:
+        codes = self.quantized.codes if ids is None else self.quantized.codes[ids]
+        scales = self.quantized.scales if ids is None else self.quantized.scales[ids]
+        scores = np.empty((len(queries), len(codes)), dtype=np.float32)
+        rows_per_chunk = max(1, MAX_SCORE_ELEMENTS // codes.shape[1])
+        for start in range(0, len(codes), rows_per_chunk):
+            chunk = np.asarray(codes[start:start + rows_per_chunk], dtype=np.float32)
+            scores[:, start:start + rows_per_chunk] = (queries @ chunk.T) * scales[start:start + rows_per_chunk]
+        return scores
+
+    def search_many(
+            self,
+            queries: np.ndarray,
+            ids: Optional[np.ndarray] = None,
+            top: int = 25,
+    ) -> List[Tuple[List[int], List[float]]]:
+        queries = np.asarray(queries)
+        if ids is None:
+            ids = np.arange(len(self.vectors))
+            radius = self.radius
+        else:
+            radius = self.radius[ids]
+        if len(ids) == 0:
+            return [([], []) for _ in range(len(queries))]
+
+        results = []
+        queries_per_batch = max(1, MAX_SCORE_ELEMENTS // len(ids))
+        for start in range(0, len(queries), queries_per_batch):
+            batch = queries[start:start + queries_per_batch]
+            with profiler().stage("score", rows=len(ids) * len(batch), queries=len(batch)) as stage:
+                scores = self.approx_scores(normalize_queries(batch), None if len(ids) == len(self.vectors) else ids)
+                stage.bytes = len(ids) * self.quantized.codes.itemsize * self.vectors.shape[1]
+            with profiler().stage("rerank", queries=len(batch)) as stage:
+                for query, query_scores in zip(batch, scores):
+                    candidates = candidate_band(query_scores, radius, top)
+                    results.append(rerank(query, ids[candidates], self.vectors, self.norms, top))
+                    stage.rows += len(candidates)
+        return results
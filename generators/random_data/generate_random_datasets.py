@@ -0,0 +1,136 @@
+import argparse
+import multiprocessing as mp
+import os
+from functools import partial
+
+from generators.config import DATA_DIR
+from generators.generate import DataGenerator, RandomPayloads, build_random_vectors, generate_random_dataset
+from generators.metrics import METRICS
+from generators.profiling import collect_stages, profiled, profiler
+
+SEED = 42
+VOCAB_SIZE = 1000
+NUM_QUERIES = 10_000
+
+# Base vector shapes, every variant of a scale shares the same vectors
+SCALES = {
+    "1m": (1_000_000, 100),
+    "100k": (100_000, 2048),
+    # Vectors and payloads are streamed in chunks, so these fit a commodity box given enough disk
+    "10m": (10_000_000, 100),
+    "100m": (100_000_000, 100),
+}
+DEFAULT_SCALES = ("1m", "100k")
+
+
+def keywords_variant(generator: DataGenerator):
+    return (
+        RandomPayloads(generator, "keyword"),
+        generator.random_match_keyword,
+    )
+
+
+def ints_variant(generator: DataGenerator):
+    return (
+        RandomPayloads(generator, "int"),
+        partial(generator.random_match_int, rng=100),
+    )
+
+
+def float_variant(generator: DataGenerator):
+    return (
+        RandomPayloads(generator, "float"),
+        generator.random_range_query,
+    )
+
+
+def geo_variant(generator: DataGenerator):
+    return (
+        RandomPayloads(generator, "geo"),
+        partial(generator.random_geo_query, radius=2_000_000),
+    )
+
+
+# Payload and condition generators of each variant
+VARIANTS = {
+    "keywords": keywords_variant,
+    "ints": ints_variant,
+    "float": float_variant,
+    "geo": geo_variant,
+}
+
+
+def build_variant(
+        variant: str,
+        scale: str,
+        num_queries: int = NUM_QUERIES,
+        tests_per_vector: int = 1,
+        metric: str = "cosine",
+):
+    generator = DataGenerator(vocab_size=VOCAB_SIZE, seed=SEED)
+    size, dim = SCALES[scale]
+    payload_gen, condition_gen = VARIANTS[variant](generator)
+    # Datasets of other metrics share the base vectors and payloads, only tests differ
+    name = f"random_{variant}_{scale}" if metric == "cosine" else f"random_{variant}_{scale}_{metric}"
+
+    generate_random_dataset(
+        generator=generator,
+        size=size,
+        dim=dim,
+        path=os.path.join(DATA_DIR, name),
+        num_queries=num_queries,
+        payload_gen=payload_gen,
+        condition_gen=condition_gen,
+        tests_per_vector=tests_per_vector,
+        metric=metric,
+    )
+
+
+def build_all(
+        variants,
+        scales,
+        num_queries: int = NUM_QUERIES,
+        parallel: int = 1,
+        tests_per_vector: int = 1,
+        metric: str = "cosine",
+):
+    """
+    Build every variant of every scale.
+    Base vectors of a scale are generated once, then variants are built concurrently and link to them.
+    """
+    for scale in scales:
+        size, dim = SCALES[scale]
+        build_random_vectors(DataGenerator(vocab_size=VOCAB_SIZE, seed=SEED), size, dim)
+
+        tasks = [(variant, scale, num_queries, tests_per_vector, metric) for variant in variants]
+        if parallel == 1:
+            for task in tasks:
+                build_variant(*task)
+        else:
+            with mp.Pool(processes=parallel) as pool:
+                for _, stages in pool.starmap(partial(collect_stages, build_variant), tasks):
+                    profiler().merge(stages)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build random datasets sharing base vectors between variants")
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=list(VARIANTS))
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=list(DEFAULT_SCALES))
+    parser.add_argument("--num-queries", type=int, default=NUM_QUERIES)
+    parser.add_argument("--parallel", type=int, default=len(VARIANTS))
+    parser.add_argument("--tests-per-vector", type=int, default=1,
+                        help="conditions per query vector, the vector is scored once for all of them")
+    parser.add_argument("--metric", choices=list(METRICS), default="cosine",
+                        help="metric of the ground truth, datasets of other metrics get a `_<metric>` suffix")
+    parser.add_argument("--profile", help="write a JSON report of time, rows and bytes per stage to this path")
+    args = parser.parse_args()
+
+    with profiled(args.profile):
+        build_all(
+            args.variants,
+            args.scales,
+            num_queries=args.num_queries,
+            parallel=args.parallel,
+            tests_per_vector=args.tests_per_vector,
+            metric=args.metric,
+        )
@@ -0,0 +1,323 @@
+"""
+Open-loop replay of a tests file or an arrival trace (see `generators.workload`) against a search backend,
+reporting latency percentiles, throughput and recall together:
+
+    python -m generators.replay laion/small --trace traces/laion --concurrency 8
+    python -m generators.replay laion/small --qps 200 --duration 60 --output report.json
+    python -m generators.replay laion/small --backend my_package.backends:QdrantBackend
+
+Requests are sent at their arrival times regardless of how many are still in flight, and latency is measured from
+the arrival time, so a saturated backend shows up as a growing latency instead of a silently lower request rate.
+Without a trace and `--qps`, tests are sent back to back by `--concurrency` workers (closed loop).
+"""
+import argparse
+import importlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from generators.bitset import Bitset
+from generators.dataset import Dataset
+from generators.ground_truth import ExactSearch
+from generators.incremental import infer_top
+from generators.workload import DELETE, OPS, SEARCH, UPSERT, Trace, poisson_arrivals
+
+# Latencies are recorded in microseconds, with 2^(SUB_BUCKET_BITS - 1) linear sub-buckets per power of two:
+# a relative error below 0.1%, like an HDR histogram of 3 significant digits
+SUB_BUCKET_BITS = 11
+# Latencies above an hour are recorded as an hour
+MAX_LATENCY_US = 3600 * 1_000_000
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies with a fixed relative precision, as in HdrHistogram.
+    Values below 2^SUB_BUCKET_BITS microseconds are exact, larger ones share buckets of width 2^e,
+    where e is their number of bits above SUB_BUCKET_BITS.
+    """
+
+    def __init__(self):
+        half = 1 << (SUB_BUCKET_BITS - 1)
+        max_exponent = max(0, int(MAX_LATENCY_US).bit_length() - SUB_BUCKET_BITS)
+        self.counts = np.zeros((max_exponent + 2) * half, dtype=np.int64)
+        self.total_us = 0
+        self.max_us = 0
+
+    @staticmethod
+    def bucket(values_us: np.ndarray) -> np.ndarray:
+        values_us = np.asarray(values_us, dtype=np.int64)
+        exponents = np.maximum(0, np.floor(np.log2(np.maximum(values_us, 1))).astype(np.int64) + 1 - SUB_BUCKET_BITS)
+        # Index e * 2^(S - 1) + (v >> e): exact below 2^S, every later power of two takes another half of 2^S buckets
+        return exponents * (1 << (SUB_BUCKET_BITS - 1)) + (values_us >> exponents)
+
+    def highest_values(self) -> np.ndarray:
+        """
+        Highest microsecond value of every bucket, reported for percentiles.
+        """
+        half = 1 << (SUB_BUCKET_BITS - 1)
+        indexes = np.arange(len(self.counts))
+        exponents = np.maximum(0, indexes // half - 1)
+        mantissas = indexes - exponents * half
+        return ((mantissas + 1) << exponents) - 1
+
+    def record(self, seconds: float):
+        self.record_many(np.array([seconds]))
+
+    def record_many(self, seconds: np.ndarray):
+        values_us = np.minimum(np.round(np.asarray(seconds) * 1e6), MAX_LATENCY_US).astype(np.int64)
+        np.add.at(self.counts, self.bucket(values_us), 1)
+        self.total_us += int(values_us.sum())
+        self.max_us = max(self.max_us, int(values_us.max(initial=0)))
+
+    def merge(self, other: "LatencyHistogram") -> "LatencyHistogram":
+        self.counts += other.counts
+        self.total_us += other.total_us
+        self.max_us = max(self.max_us, other.max_us)
+        return self
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def percentile(self, q: float) -> float:
+        """
+        Latency in seconds below which `q` percent of requests completed.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(np.ceil(q / 100 * self.count)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(int(self.highest_values()[index]), self.max_us) / 1e6
+
+    def report(self) -> dict:
+        """
+        Count, mean, max and `PERCENTILES` in milliseconds.
+        """
+        report = {
+            "count": self.count,
+            "mean_ms": round(self.total_us / self.count / 1000, 3) if self.count else 0.0,
+            "max_ms": self.max_us / 1000,
+        }
+        for q in PERCENTILES:
+            report[f"p{q:g}_ms".replace(".", "")] = round(self.percentile(q) * 1000, 3)
+        return report
+
+
+class Backend:
+    """
+    Search engine under test. Methods are called concurrently from worker threads.
+    Upserts and deletes refer to rows of the replayed dataset, an upsert writes the row's vector and payload.
+    """
+
+    def search(self, query: np.ndarray, conditions: Optional[dict], top: int) -> List[int]:
+        raise NotImplementedError()
+
+    def upsert(self, row: int):
+        raise NotImplementedError()
+
+    def delete(self, row: int):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class ExactBackend(Backend):
+    """
+    In-process brute force over the dataset, the reference for offline runs: recall is 1 unless rows are deleted
+    concurrently with searches.
+    """
+
+    def __init__(self, dataset: Dataset):
+        self.search_engine = ExactSearch(dataset.vectors, dataset.metric)
+        self.evaluator = dataset.evaluator()
+        self.present = np.ones(len(dataset), dtype=bool)
+        self.num_deleted = 0
+        # The mask cache and the present rows are shared by workers
+        self.lock = threading.Lock()
+
+    def search(self, query: np.ndarray, conditions: Optional[dict], top: int) -> List[int]:
+        with self.lock:
+            rows = self.evaluator.bitset(conditions) if conditions else None
+            if self.num_deleted:
+                present = Bitset.from_mask(self.present)
+                rows = present if rows is None else rows & present
+        ids = None if rows is None else rows.to_indices()
+        return self.search_engine.search_many(query[None], ids=ids, top=top)[0][0]
+
+    def upsert(self, row: int):
+        with self.lock:
+            self.num_deleted -= not self.present[row]
+            self.present[row] = True
+
+    def delete(self, row: int):
+        with self.lock:
+            self.num_deleted += bool(self.present[row])
+            self.present[row] = False
+
+
+BACKENDS = {"exact": ExactBackend}
+
+
+def load_backend(name: str, dataset: Dataset) -> Backend:
+    """
+    Backend by name in `BACKENDS`, or a `module:attribute` factory called with the dataset.
+    """
+    if name in BACKENDS:
+        return BACKENDS[name](dataset)
+    module_name, _, attribute = name.partition(":")
+    if not attribute:
+        raise ValueError(f"Unknown backend: {name}, expected one of {list(BACKENDS)} or module:attribute")
+    return getattr(importlib.import_module(module_name), attribute)(dataset)
+
+
+def recall(found: List[int], expected: List[int], deleted: np.ndarray) -> Optional[float]:
+    """
+    Share of the expected ids found. Rows deleted from the top leave the remaining expected ids the exact top
+    of the remaining rows, so they are dropped and only as many found ids are checked. None if nothing is expected.
+    """
+    expected = [row for row in expected if not deleted[row]]
+    if not expected:
+        return None
+    return len(set(found[:len(expected)]) & set(expected)) / len(expected)
+
+
+class Replay:
+    """
+    Replay of `events` (arrays of timestamps, ops and index as in `generators.workload.Trace`) over `backend`.
+    Timestamps are seconds from the start, None replays back to back with at most `concurrency` requests in flight.
+    """
+
+    def __init__(
+            self,
+            backend: Backend,
+            tests: List[dict],
+            num_rows: int,
+            concurrency: int = 8,
+            top: Optional[int] = None,
+    ):
+        self.backend = backend
+        self.tests = tests
+        self.queries = np.array([test["query"] for test in tests], dtype=np.float32)
+        self.concurrency = concurrency
+        self.top = top or infer_top(tests)
+        self.deleted = np.zeros(num_rows, dtype=bool)
+        self.latencies = {op: LatencyHistogram() for op in OPS}
+        self.recall_sum = 0.0
+        self.recall_count = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def _run_event(self, op: int, index: int, intended: float):
+        try:
+            if op == SEARCH:
+                found = self.backend.search(self.queries[index], self.tests[index]["conditions"], self.top)
+            elif op == UPSERT:
+                self.backend.upsert(index)
+            else:
+                self.backend.delete(index)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        latency = time.perf_counter() - intended
+        # Recall is checked against rows deleted when the search completed
+        search_recall = recall(found, self.tests[index]["closest_ids"], self.deleted) if op == SEARCH else None
+        with self.lock:
+            self.latencies[OPS[op]].record(latency)
+            if search_recall is not None:
+                self.recall_sum += search_recall
+                self.recall_count += 1
+
+    def run(self, ops: np.ndarray, index: np.ndarray, timestamps: Optional[np.ndarray] = None) -> dict:
+        slots = threading.Semaphore(self.concurrency) if timestamps is None else None
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for position in range(len(ops)):
+                op, row = int(ops[position]), int(index[position])
+                if slots is not None:
+                    slots.acquire()
+                    intended = time.perf_counter()
+                else:
+                    intended = start + float(timestamps[position])
+                    delay = intended - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                # Deletes are visible to recall from dispatch, upserts restore rows
+                if op != SEARCH:
+                    self.deleted[row] = op == DELETE
+                future = executor.submit(self._run_event, op, row, intended)
+                if slots is not None:
+                    future.add_done_callback(lambda _: slots.release())
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        completed = sum(histogram.count for histogram in self.latencies.values())
+        return {
+            "elapsed_s": elapsed,
+            "completed": completed,
+            "errors": self.errors,
+            "throughput_qps": completed / elapsed if elapsed else 0.0,
+            "recall": self.recall_sum / self.recall_count if self.recall_count else None,
+            "latency": {op: histogram.report() for op, histogram in self.latencies.items() if histogram.count},
+        }
+
+
+def test_events(
+        num_tests: int,
+        qps: Optional[float],
+        duration: Optional[float] = None,
+        seed: Optional[int] = None,
+) -> Dict[str, Optional[np.ndarray]]:
+    """
+    Searches of the tests in order, repeated to fill `duration` seconds at `qps`, at Poisson arrival times.
+    Without `qps` every test is searched once, back to back.
+    """
+    count = num_tests if qps is None or duration is None else max(1, int(qps * duration))
+    return {
+        "ops": np.zeros(count, dtype=np.uint8),
+        "index": np.arange(count) % num_tests,
+        "timestamps": None if qps is None else poisson_arrivals(np.random.default_rng(seed), qps, count),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay tests or an arrival trace against a search backend")
+    parser.add_argument("dataset", help="dataset path or name relative to DATA_DIR")
+    parser.add_argument("--trace", default=None, help="trace directory written by generators.workload")
+    parser.add_argument("--backend", default="exact", help=f"one of {list(BACKENDS)} or module:attribute")
+    parser.add_argument("--concurrency", type=int, default=8, help="worker threads")
+    parser.add_argument("--qps", type=float, default=None,
+                        help="target requests per second, rescales the trace; tests are replayed back to back if not set")
+    parser.add_argument("--duration", type=float, default=None, help="seconds of tests replay at --qps")
+    parser.add_argument("--top", type=int, default=None, help="results per search, the size of stored tops by default")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="JSON report path")
+    args = parser.parse_args()
+
+    dataset = Dataset.open(args.dataset)
+    if args.trace:
+        trace = Trace.open(args.trace)
+        timestamps = np.asarray(trace.timestamps)
+        if args.qps and len(trace):
+            timestamps = timestamps * (len(trace) / trace.duration / args.qps)
+        events = {"ops": trace.ops, "index": trace.index, "timestamps": timestamps}
+    else:
+        events = test_events(len(dataset.tests), args.qps, args.duration, args.seed)
+
+    backend = load_backend(args.backend, dataset)
+    try:
+        replay = Replay(backend, list(dataset.tests), len(dataset), args.concurrency, args.top)
+        report = replay.run(**events)
+    finally:
+        backend.close()
+    report = {"dataset": dataset.path, "backend": args.backend, "concurrency": args.concurrency, **report}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2)
@@ -4,6 +4,8 @@ from typing import Callable, Iterable, Tuple
 import numpy as np
 from qdrant_client import QdrantClient, models
 
+from generators.profiling import profiler
+
 
 # Generates reference search result by applying exact search
 def index_qdrant(embeddings: np.ndarray, payload: list):
@@ -28,39 +30,47 @@ def index_qdrant(embeddings: np.ndarray, payload: list):
 
     ids = list(range(len(embeddings)))
 
-    client.upload_collection(
-        collection_name="tmp",
-        vectors=embeddings,
-        payload=payload,
-        ids=ids,
-        batch_size=100,
-    )
+    with profiler().stage("qdrant_upload", rows=len(embeddings), bytes=embeddings.nbytes):
+        client.upload_collection(
+            collection_name="tmp",
+            vectors=embeddings,
+            payload=payload,
+            ids=ids,
+            batch_size=100,
+        )
 
     sleep(1)
 
 
 def search_qdrant(
         sample_embeddings: np.ndarray,
-        filter_generator: Callable[[], Tuple[dict, dict]],
+        filter_generator: Callable[[np.random.Generator], Tuple[dict, dict]],
         n: int,
-        top: int
+        top: int,
+        seed=None,
 ) -> Iterable[dict]:
+    """
+    Query vectors and filters are drawn from a single stream seeded by `seed`, which is passed to `filter_generator`,
+    so the same seed gives the same tests.
+    """
     client = QdrantClient(prefer_grpc=True)
+    rng = np.random.default_rng(seed)
 
     for _ in range(n):
-        query_vector = sample_embeddings[np.random.randint(sample_embeddings.shape[0])]
-        dataset_query, qdrant_query = filter_generator()
-        hits = client.search(
-            collection_name="tmp",
-            query_vector=query_vector,
-            query_filter=models.Filter(**qdrant_query),
-            limit=top,
-            search_params=models.SearchParams(
-                exact=True,
+        query_vector = sample_embeddings[rng.integers(sample_embeddings.shape[0])]
+        dataset_query, qdrant_query = filter_generator(rng)
+        with profiler().stage("qdrant_search", queries=1):
+            hits = client.search(
+                collection_name="tmp",
+                query_vector=query_vector,
+                query_filter=models.Filter(**qdrant_query),
+                limit=top,
+                search_params=models.SearchParams(
+                    exact=True,
+                )
             )
-        )
         yield {
-            "query": query_vector.tolist(),
+            "query": query_vector,
             "conditions": dataset_query,
             "closest_ids": [hit.id for hit in hits],
             "closest_scores": [hit.score for hit in hits]
@@ -0,0 +1,447 @@
+"""
+Single-pass statistics of payload files, computed in parallel over byte ranges of the file:
+
+    python -m generators.stats data/arxiv/payloads.jsonl --output data/arxiv/stats.json --parallel 8
+
+Every field gets the number of rows having it and value types. Numbers get approximate quantiles,
+and scalar values and list items get an approximate distinct count. Top value frequencies are tracked
+for all fields, or only for the `--frequency-fields` given, free text fields would only fill the sketches.
+Frequencies of `--exact-fields` are counted exactly, their memory grows with the number of distinct values.
+All sketches have bounded size and are mergeable, so the memory does not grow with the number of rows.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+from collections import Counter
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from generators.profiling import collect_stages, profiler
+
+QUANTILES = (0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99)
+CHUNK_SIZE = 10_000
+# Ranges per worker, smaller ranges balance the load better
+RANGES_PER_WORKER = 4
+
+SCALAR_TYPES = (str, int, float, bool)
+# Values with tracked frequencies per field and worker
+MAX_VALUES = 4096
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch in the style of KLL: values are kept in levels of at most `capacity` items,
+    an item of level `l` stands for `2 ** l` values. A full level is sorted and every other item,
+    from a random offset, is promoted to the next level. The rank error is about `log2(n / capacity) / capacity`.
+    """
+
+    def __init__(self, capacity: int = 4096, seed: int = 0):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.levels: List[np.ndarray] = [np.empty(0, dtype=np.float64)]
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compact()
+
+    def merge(self, other: "QuantileSketch"):
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0, dtype=np.float64))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compact()
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity:
+                items = np.sort(items)
+                # An odd item stays at its level
+                even = len(items) - len(items) % 2
+                promoted = items[int(self.rng.integers(2)):even:2]
+                self.levels[level] = items[even:]
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def quantiles(self, qs=QUANTILES) -> List[Optional[float]]:
+        if self.count == 0:
+            return [None] * len(qs)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** i) for i, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        items, cumulative = items[order], np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, np.asarray(qs) * cumulative[-1], side="left")
+        return [float(value) for value in items[np.minimum(positions, len(items) - 1)]]
+
+
+class FrequencySketch:
+    """
+    Mergeable Misra-Gries summary of value counts, keeps at most `capacity` values.
+    Counts are exact while there are fewer distinct values, otherwise every count is underestimated
+    by at most `error`, and any value more frequent than `error` is kept.
+    With `capacity` None all values are kept and counts are exact.
+    """
+
+    def __init__(self, capacity: Optional[int] = MAX_VALUES):
+        self.capacity = capacity
+        self.counts: Dict = {}
+        self.error = 0
+
+    def update(self, counts: Dict):
+        for value, count in counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self._prune()
+
+    def merge(self, other: "FrequencySketch"):
+        self.error += other.error
+        self.update(other.counts)
+
+    def _prune(self):
+        if self.capacity is None or len(self.counts) <= self.capacity:
+            return
+        counts = np.fromiter(self.counts.values(), dtype=np.int64, count=len(self.counts))
+        # Subtracting the (capacity + 1)-th largest count leaves at most `capacity` positive counts
+        threshold = int(np.partition(counts, len(counts) - self.capacity - 1)[len(counts) - self.capacity - 1])
+        self.counts = {value: count - threshold for value, count in self.counts.items() if count > threshold}
+        self.error += threshold
+
+    def top(self, limit: int = None) -> List[Tuple[object, int]]:
+        ordered = sorted(self.counts.items(), key=lambda item: (-item[1], str(item[0])))
+        return ordered[:limit]
+
+
+class DistinctSketch:
+    """
+    HyperLogLog distinct counter with `2 ** precision` registers, mergeable by a register-wise maximum.
+    Relative error is about `1.04 / sqrt(2 ** precision)`.
+    """
+
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @staticmethod
+    def hash_values(values) -> np.ndarray:
+        # Stable across processes and runs, unlike the builtin `hash` of strings
+        return np.fromiter(
+            (
+                int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), "little")
+                for value in values
+            ),
+            dtype=np.uint64,
+        )
+
+    def update(self, values):
+        hashes = self.hash_values(values)
+        if len(hashes) == 0:
+            return
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # Position of the leftmost 1 bit of the remaining bits, frexp gives their bit length
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (bits - bit_length + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: "DistinctSketch"):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self) -> int:
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = size * np.log(size / zeros)
+        return int(round(estimate))
+
+
+class FieldStats:
+    """
+    Sketches of one payload field. List values contribute their items to frequencies and distinct counts.
+    Without `frequencies` only the distinct count of values is kept, with `max_values` None frequencies are exact.
+    """
+
+    def __init__(self, max_values: Optional[int] = MAX_VALUES, seed: int = 0, frequencies: bool = True):
+        self.count = 0
+        self.types = Counter()
+        self.numbers = QuantileSketch(seed=seed)
+        self.lengths = QuantileSketch(seed=seed)
+        self.frequencies = FrequencySketch(max_values) if frequencies else None
+        self.distinct = DistinctSketch()
+
+    def update(self, values: list):
+        numbers = []
+        lengths = []
+        scalars = Counter()
+        for value in values:
+            value_type = type(value)
+            if value_type is int or value_type is float:
+                self.types["number"] += 1
+                numbers.append(value)
+                scalars[value] += 1
+            elif value_type is str or value_type is bool:
+                self.types["bool" if value_type is bool else "keyword"] += 1
+                scalars[value] += 1
+            elif value_type is list:
+                self.types["list"] += 1
+                lengths.append(len(value))
+                scalars.update(item for item in value if isinstance(item, SCALAR_TYPES))
+            elif value is None:
+                self.types["null"] += 1
+            else:
+                self.types["object"] += 1
+        self.count += len(values)
+        self.numbers.update(np.array(numbers, dtype=np.float64))
+        self.lengths.update(np.array(lengths, dtype=np.float64))
+        if self.frequencies is not None:
+            self.frequencies.update(scalars)
+        self.distinct.update(scalars.keys())
+
+    def merge(self, other: "FieldStats"):
+        self.count += other.count
+        self.types.update(other.types)
+        self.numbers.merge(other.numbers)
+        self.lengths.merge(other.lengths)
+        if self.frequencies is not None and other.frequencies is not None:
+            self.frequencies.merge(other.frequencies)
+        self.distinct.merge(other.distinct)
+
+    def report(self, top: int = None) -> dict:
+        report = {
+            "count": self.count,
+            "types": dict(sorted(self.types.items())),
+            "distinct": self.distinct.estimate(),
+        }
+        if self.frequencies is not None:
+            if not self.frequencies.error:
+                # All values were kept, so their number is exact
+                report["distinct"] = len(self.frequencies.counts)
+            report["frequencies"] = [[value, count] for value, count in self.frequencies.top(top)]
+            report["frequencies_error"] = self.frequencies.error
+        if self.numbers.count:
+            report["min"] = self.numbers.min
+            report["max"] = self.numbers.max
+            report["quantiles"] = dict(zip(map(str, QUANTILES), self.numbers.quantiles()))
+        if self.lengths.count:
+            report["list_length"] = {
+                "min": self.lengths.min,
+                "max": self.lengths.max,
+                "quantiles": dict(zip(map(str, QUANTILES), self.lengths.quantiles())),
+            }
+        return report
+
+
+class PayloadStats:
+    """
+    Statistics of every field of a payload file, updated chunk by chunk and mergeable across workers.
+    `frequency_fields` - fields whose value frequencies are tracked, all if None.
+    `exact_fields` - fields whose value frequencies are counted exactly instead of sketched.
+    """
+
+    def __init__(
+            self,
+            max_values: int = MAX_VALUES,
+            seed: int = 0,
+            frequency_fields: Optional[List[str]] = None,
+            exact_fields: Optional[List[str]] = None,
+    ):
+        self.max_values = max_values
+        self.seed = seed
+        self.frequency_fields = None if frequency_fields is None else set(frequency_fields)
+        self.exact_fields = set(exact_fields or ())
+        self.rows = 0
+        self.fields: Dict[str, FieldStats] = {}
+
+    def update(self, records: List[dict]):
+        self.rows += len(records)
+        values: Dict[str, list] = {}
+        for record in records:
+            for field, value in record.items():
+                values.setdefault(field, []).append(value)
+        for field, field_values in values.items():
+            if field not in self.fields:
+                exact = field in self.exact_fields
+                frequencies = exact or self.frequency_fields is None or field in self.frequency_fields
+                self.fields[field] = FieldStats(None if exact else self.max_values, self.seed, frequencies)
+            self.fields[field].update(field_values)
+
+    def merge(self, other: "PayloadStats"):
+        self.rows += other.rows
+        for field, field_stats in other.fields.items():
+            if field in self.fields:
+                self.fields[field].merge(field_stats)
+            else:
+                self.fields[field] = field_stats
+
+    def report(self, top: int = None) -> dict:
+        """
+        JSON-serializable statistics, `top` limits the number of reported value frequencies per field.
+        """
+        return {
+            "rows": self.rows,
+            "fields": {field: field_stats.report(top) for field, field_stats in sorted(self.fields.items())},
+        }
+
+
+def file_ranges(path: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    Split a file into `parts` byte ranges. A line belongs to the range where it starts.
+    """
+    size = os.path.getsize(path)
+    bounds = [size * part // parts for part in range(parts + 1)]
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_range(path: str, start: int, end: int, chunk_size: int = CHUNK_SIZE) -> Iterator[List[dict]]:
+    """
+    Records of lines starting within `start:end`, in chunks of `chunk_size`.
+    """
+    with open(path, "rb") as fd:
+        if start > 0:
+            # Skip the line started in the previous range
+            fd.seek(start - 1)
+            fd.readline()
+        chunk = []
+        while fd.tell() < end:
+            line = fd.readline()
+            if not line:
+                break
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _range_stats(
+        path: str,
+        task: Tuple[int, int, int],
+        chunk_size: int,
+        max_values: int,
+        frequency_fields: Optional[List[str]],
+        exact_fields: Optional[List[str]],
+        transform: Optional[Callable[[List[dict]], List[dict]]],
+        output: Optional[str],
+) -> PayloadStats:
+    part, start, end = task
+    stats = PayloadStats(max_values, seed=part, frequency_fields=frequency_fields, exact_fields=exact_fields)
+    out = open(f"{output}.part{part}", "w") if output else None
+    try:
+        for records in read_range(path, start, end, chunk_size):
+            with profiler().stage("stats", rows=len(records)):
+                if transform is not None:
+                    records = transform(records)
+                stats.update(records)
+            if out is not None:
+                for record in records:
+                    out.write(json.dumps(record))
+                    out.write("\n")
+    finally:
+        if out is not None:
+            out.close()
+    return stats
+
+
+def build_stats(
+        path: str,
+        parallel: int = 1,
+        chunk_size: int = CHUNK_SIZE,
+        max_values: int = MAX_VALUES,
+        transform: Callable[[List[dict]], List[dict]] = None,
+        output: str = None,
+        frequency_fields: List[str] = None,
+        exact_fields: List[str] = None,
+) -> PayloadStats:
+    """
+    Statistics of the payload file `path`, read once by `parallel` processes.
+
+    Value frequencies are tracked for `frequency_fields` only, or for every field if None,
+    and counted exactly for `exact_fields`.
+    `transform` is applied to every chunk of records before statistics, e.g. to derive fields.
+    With `output`, transformed records are also written there in the original order, in the same pass.
+    `transform` must be picklable when `parallel` > 1.
+    """
+    if output is not None and os.path.abspath(output) == os.path.abspath(path):
+        raise ValueError(f"Output must differ from the input file: {path}")
+    ranges = file_ranges(path, max(1, parallel * RANGES_PER_WORKER if parallel > 1 else 1))
+    tasks = [(part, start, end) for part, (start, end) in enumerate(ranges)]
+    worker = partial(
+        _range_stats,
+        path,
+        chunk_size=chunk_size,
+        max_values=max_values,
+        frequency_fields=frequency_fields,
+        exact_fields=exact_fields,
+        transform=transform,
+        output=output,
+    )
+
+    stats = PayloadStats(max_values, frequency_fields=frequency_fields, exact_fields=exact_fields)
+    if parallel == 1:
+        for task in tasks:
+            stats.merge(worker(task))
+    else:
+        with mp.Pool(processes=parallel) as pool:
+            for range_stats, stages in pool.imap(partial(collect_stages, worker), tasks):
+                profiler().merge(stages)
+                stats.merge(range_stats)
+
+    if output is not None:
+        with open(output, "wb") as out:
+            for part, _, _ in tasks:
+                with open(f"{output}.part{part}", "rb") as part_file:
+                    shutil.copyfileobj(part_file, out)
+                os.remove(f"{output}.part{part}")
+    return stats
+
+
+def save_stats(stats: PayloadStats, path: str, top: int = None):
+    with open(path, "w") as out:
+        json.dump(stats.report(top), out, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Streaming statistics of a payloads.jsonl file")
+    parser.add_argument("payloads")
+    parser.add_argument("--output", required=True, help="stats JSON path")
+    parser.add_argument("--parallel", type=int, default=os.cpu_count())
+    parser.add_argument("--max-values", type=int, default=MAX_VALUES, help="values with tracked frequencies per field")
+    parser.add_argument("--frequency-fields", nargs="+", default=None,
+                        help="fields with tracked value frequencies, all by default")
+    parser.add_argument("--exact-fields", nargs="+", default=None, help="fields with exactly counted value frequencies")
+    parser.add_argument("--top", type=int, default=1000, help="reported value frequencies per field")
+    args = parser.parse_args()
+
+    stats = build_stats(
+        args.payloads,
+        parallel=args.parallel,
+        max_values=args.max_values,
+        frequency_fields=args.frequency_fields,
+        exact_fields=args.exact_fields,
+    )
+    save_stats(stats, args.output, args.top)
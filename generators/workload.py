@@ -0,0 +1,314 @@
+"""
+Query-arrival traces for load testing. A trace is an open-loop sequence of timestamped operations over a dataset:
+searches of its tests, optionally interleaved with upserts and deletes of its rows.
+
+    python -m generators.workload laion/small --output traces/laion_bursty --events 1000000 --rate 500 \
+        --process bursty --mix match=0.6 range=0.3 none=0.1 --upserts 0.05 --deletes 0.01
+
+A trace references the tests file instead of copying queries, it is a directory of memory-mapped arrays:
+`timestamps.npy` (float64 seconds from the start), `ops.npy` (uint8, see `OPS`) and `index.npy`
+(test number of searches, row id of upserts and deletes), described by `trace.json`.
+"""
+import argparse
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from generators.dataset import TESTS_FILE, Dataset, Tests
+from generators.filters import FilterEvaluator, clause_nodes, tree_operator
+from generators.ground_truth import canonical_conditions
+
+SEARCH, UPSERT, DELETE = range(3)
+OPS = ("search", "upsert", "delete")
+PROCESSES = ("poisson", "bursty")
+
+TRACE_FILE = "trace.json"
+TRACE_ARRAYS = ("timestamps", "ops", "index")
+
+
+def condition_type(conditions: Optional[dict]) -> str:
+    """
+    Type of a test by its condition: `none`, the kind of a single clause (`match`, `range`, `geo`),
+    or the operator with sorted types of its clauses, e.g. `and(match,range)` or `and(match,not(geo))`.
+    """
+    if not conditions:
+        return "none"
+    operator, clauses = tree_operator(conditions)
+    kinds = sorted(
+        condition_type(node) if isinstance(node, dict) else next(iter(node[1]))
+        for node in clause_nodes(clauses)
+    )
+    if len(kinds) == 1 and operator != "not":
+        return kinds[0]
+    return f"{operator}({','.join(kinds)})"
+
+
+def selectivity_label(selectivity: float, bins: Sequence[float]) -> str:
+    """
+    Bucket of a selectivity by increasing bin edges, e.g. `<0.01`, `0.01-0.1` or `>=0.1`.
+    """
+    position = int(np.searchsorted(bins, selectivity, side="right"))
+    if position == 0:
+        return f"<{bins[0]:g}"
+    if position == len(bins):
+        return f">={bins[-1]:g}"
+    return f"{bins[position - 1]:g}-{bins[position]:g}"
+
+
+def test_classes(
+        conditions: List[Optional[dict]],
+        evaluator: Optional[FilterEvaluator] = None,
+        bins: Sequence[float] = (),
+) -> List[str]:
+    """
+    Class of every test: its condition type, followed by `@` and its selectivity bucket if `bins` are given.
+    Selectivity is the fraction of rows matching the condition, evaluated once per distinct condition.
+    """
+    types = [condition_type(test_conditions) for test_conditions in conditions]
+    if not bins:
+        return types
+    if evaluator is None:
+        raise ValueError("Selectivity bins need payloads to evaluate conditions on")
+    labels = {}
+    classes = []
+    for test_type, test_conditions in zip(types, conditions):
+        key = canonical_conditions(test_conditions)
+        if key not in labels:
+            selectivity = evaluator.bitset(test_conditions).count() / len(evaluator) if test_conditions else 1.0
+            labels[key] = selectivity_label(selectivity, bins)
+        classes.append(f"{test_type}@{labels[key]}")
+    return classes
+
+
+def test_weights(classes: List[str], mix: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Sampling probability of every test. A key of `mix` is a condition type or a full class, its weight is split
+    evenly between the matching tests, tests matching no key are never sampled. Uniform over tests without a mix.
+    """
+    if not mix:
+        return np.full(len(classes), 1 / len(classes))
+    weights = np.zeros(len(classes))
+    types = np.array([name.split("@")[0] for name in classes])
+    classes = np.array(classes)
+    for key, weight in mix.items():
+        matching = (types == key) | (classes == key)
+        if not matching.any():
+            raise ValueError(f"No tests of class {key}, known classes: {sorted(set(classes.tolist()))}")
+        weights[matching] += weight / matching.sum()
+    return weights / weights.sum()
+
+
+def poisson_arrivals(rng: np.random.Generator, rate: float, count: int) -> np.ndarray:
+    """
+    Open-loop arrival times of a Poisson process of `rate` events per second.
+    """
+    return np.cumsum(rng.exponential(1 / rate, count))
+
+
+def bursty_arrivals(
+        rng: np.random.Generator,
+        rate: float,
+        count: int,
+        burst_factor: float = 10.0,
+        burst_duration: float = 1.0,
+        burst_interval: float = 30.0,
+) -> np.ndarray:
+    """
+    Arrival times of a two-state Markov-modulated Poisson process: `rate` events per second between bursts and
+    `rate * burst_factor` during bursts. Durations of bursts and of quiet periods between them are exponential
+    with means `burst_duration` and `burst_interval` seconds.
+    """
+    times = []
+    generated = 0
+    start = 0.0
+    while generated < count:
+        # Enough quiet and burst periods for the expected remaining events, drawn at once
+        expected_per_cycle = rate * (burst_interval + burst_factor * burst_duration)
+        cycles = int(np.ceil((count - generated) / expected_per_cycle)) + 1
+        durations = np.empty(2 * cycles)
+        durations[0::2] = rng.exponential(burst_interval, cycles)
+        durations[1::2] = rng.exponential(burst_duration, cycles)
+        rates = np.tile([rate, rate * burst_factor], cycles)
+        starts = start + np.concatenate([[0.0], np.cumsum(durations)[:-1]])
+        # Events of a period are uniform within it, periods do not overlap, so one sort orders them all
+        counts = rng.poisson(rates * durations)
+        period_times = np.repeat(starts, counts) + rng.random(counts.sum()) * np.repeat(durations, counts)
+        period_times.sort()
+        times.append(period_times)
+        generated += len(period_times)
+        start = starts[-1] + durations[-1]
+    return np.concatenate(times)[:count]
+
+
+class Trace:
+    """
+    Arrays of a trace, see the module docstring, with its parameters in `meta`.
+    """
+
+    def __init__(self, timestamps: np.ndarray, ops: np.ndarray, index: np.ndarray, meta: dict):
+        self.timestamps = timestamps
+        self.ops = ops
+        self.index = index
+        self.meta = meta
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def duration(self) -> float:
+        return float(self.timestamps[-1]) if len(self) else 0.0
+
+    def counts(self) -> Dict[str, int]:
+        return dict(zip(OPS, np.bincount(self.ops, minlength=len(OPS)).tolist()))
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in TRACE_ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, TRACE_FILE), "w") as out:
+            json.dump({**self.meta, "events": len(self), "counts": self.counts()}, out, indent=2)
+
+    @classmethod
+    def open(cls, path: str) -> "Trace":
+        """
+        Trace saved by `save`, arrays are memory-mapped.
+        """
+        with open(os.path.join(path, TRACE_FILE)) as fd:
+            meta = json.load(fd)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in TRACE_ARRAYS]
+        return cls(*arrays, meta=meta)
+
+
+def generate_trace(
+        classes: List[str],
+        num_rows: int,
+        events: int,
+        rate: float,
+        process: str = "poisson",
+        mix: Optional[Dict[str, float]] = None,
+        upserts: float = 0.0,
+        deletes: float = 0.0,
+        seed: Optional[int] = None,
+        **process_params,
+) -> Trace:
+    """
+    Trace of `events` operations arriving at `rate` per second on average (outside of bursts).
+    Each operation is an upsert or a delete of a random row with probabilities `upserts` and `deletes`,
+    otherwise a search of a test drawn by `mix` (see `test_weights`). A deleted row is not deleted again
+    before being upserted back; upserts are drawn from all rows.
+    """
+    if process not in PROCESSES:
+        raise ValueError(f"Unknown arrival process: {process}, expected one of {PROCESSES}")
+    if upserts + deletes > 1:
+        raise ValueError("Fractions of upserts and deletes exceed 1")
+    rng = np.random.default_rng(seed)
+    if process == "poisson":
+        timestamps = poisson_arrivals(rng, rate, events)
+    else:
+        timestamps = bursty_arrivals(rng, rate, events, **process_params)
+
+    ops = rng.choice(len(OPS), size=events, p=[1 - upserts - deletes, upserts, deletes]).astype(np.uint8)
+    index_dtype = np.int32 if max(num_rows, len(classes)) < np.iinfo(np.int32).max else np.int64
+    index = np.empty(events, dtype=index_dtype)
+    searches = ops == SEARCH
+    index[searches] = rng.choice(len(classes), size=int(searches.sum()), p=test_weights(classes, mix))
+    index[ops == UPSERT] = rng.integers(num_rows, size=int((ops == UPSERT).sum()))
+    index[ops == DELETE] = _delete_rows(rng, ops, index, num_rows)
+
+    meta = {
+        "process": process,
+        "rate": rate,
+        "mix": mix,
+        "upserts": upserts,
+        "deletes": deletes,
+        "seed": seed,
+        "rows": num_rows,
+        "tests": len(classes),
+        **process_params,
+    }
+    return Trace(timestamps, ops, index, meta)
+
+
+def _delete_rows(rng: np.random.Generator, ops: np.ndarray, index: np.ndarray, num_rows: int) -> np.ndarray:
+    # Sequential over updates only, a row must be present to be deleted
+    present = np.ones(num_rows, dtype=bool)
+    remaining = num_rows
+    deleted = []
+    for position in np.flatnonzero(ops != SEARCH):
+        if ops[position] == UPSERT:
+            remaining += not present[index[position]]
+            present[index[position]] = True
+            continue
+        if remaining == 0:
+            raise ValueError("Every row is deleted, lower the fraction of deletes")
+        row = int(rng.integers(num_rows))
+        while not present[row]:
+            row = int(rng.integers(num_rows))
+        present[row] = False
+        remaining -= 1
+        deleted.append(row)
+    return np.array(deleted, dtype=index.dtype)
+
+
+def _parse_mix(items: Optional[List[str]]) -> Optional[Dict[str, float]]:
+    if not items:
+        return None
+    mix = {}
+    for item in items:
+        key, _, weight = item.rpartition("=")
+        mix[key] = float(weight)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a query-arrival trace over the tests of a dataset")
+    parser.add_argument("dataset", help="dataset path or name relative to DATA_DIR")
+    parser.add_argument("--tests", default=None, help="tests file, the tests of the dataset by default")
+    parser.add_argument("--output", required=True, help="trace directory")
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--rate", type=float, default=100.0, help="mean events per second outside of bursts")
+    parser.add_argument("--process", choices=PROCESSES, default="poisson")
+    parser.add_argument("--burst-factor", type=float, default=10.0, help="rate multiplier during bursts")
+    parser.add_argument("--burst-duration", type=float, default=1.0, help="mean burst duration, seconds")
+    parser.add_argument("--burst-interval", type=float, default=30.0, help="mean time between bursts, seconds")
+    parser.add_argument("--mix", nargs="*", help="class weights, e.g. match=0.7 range=0.2 none=0.1")
+    parser.add_argument("--selectivity-bins", type=float, nargs="*", default=(),
+                        help="selectivity bucket edges, classes become e.g. match@0.01-0.1")
+    parser.add_argument("--upserts", type=float, default=0.0, help="fraction of upserts")
+    parser.add_argument("--deletes", type=float, default=0.0, help="fraction of deletes")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    dataset = Dataset.open(args.dataset)
+    tests_path = args.tests or dataset.file(TESTS_FILE)
+    conditions = Tests(tests_path).conditions()
+    bins = sorted(args.selectivity_bins)
+    test_class_names = test_classes(conditions, dataset.evaluator() if bins else None, bins)
+    process_params = {}
+    if args.process == "bursty":
+        process_params = {
+            "burst_factor": args.burst_factor,
+            "burst_duration": args.burst_duration,
+            "burst_interval": args.burst_interval,
+        }
+    trace = generate_trace(
+        test_class_names,
+        num_rows=len(dataset),
+        events=args.events,
+        rate=args.rate,
+        process=args.process,
+        mix=_parse_mix(args.mix),
+        upserts=args.upserts,
+        deletes=args.deletes,
+        seed=args.seed,
+        **process_params,
+    )
+    trace.meta.update({
+        "dataset": os.path.abspath(dataset.path),
+        "tests_file": os.path.abspath(tests_path),
+        "selectivity_bins": bins,
+    })
+    trace.save(args.output)
+    print(json.dumps({"events": len(trace), "duration": trace.duration, "counts": trace.counts()}))
@@ -0,0 +1,76 @@
+"""
+Reference results for engine tests: a brute-force float64 scan of seeded data. Scores of each row are
+computed in float64 and rounded to float32, best first, ties by the lower id.
+Scores of l2 are negative squared distances, reported as distances.
+"""
+import numpy as np
+
+from generators.metrics import get_metric
+
+SIZE = 3000
+DIM = 24
+TOP = 10
+METRICS = ["cosine", "dot", "l2"]
+CONDITIONS = [
+    None,
+    {"and": [{"a": {"match": {"value": "k1"}}}]},
+    {"and": [{"a": {"match": {"value": "k2"}}}, {"b": {"range": {"gt": 0.2, "lt": 0.6}}}]},
+    {"or": [{"a": {"match": {"value": "k0"}}}, {"b": {"range": {"gt": 0.9, "lt": 1.0}}}]},
+    # Fewer matching rows than the top
+    {"and": [{"a": {"match": {"value": "k3"}}}, {"b": {"range": {"gt": 0.0, "lt": 0.01}}}]},
+]
+
+
+def make_data(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    # Clusters of different scales, so cluster bounds prune and dot / l2 differ from cosine
+    centers = rng.normal(size=(8, DIM))
+    vectors = centers[rng.integers(len(centers), size=SIZE)] + rng.normal(scale=0.3, size=(SIZE, DIM))
+    vectors *= rng.uniform(0.5, 2.0, size=(SIZE, 1))
+    vectors = vectors.astype(np.float32)
+    # Duplicate rows tie, the lower id must win
+    vectors[SIZE // 2:SIZE // 2 + 20] = vectors[:20]
+    payloads = [{"a": f"k{rng.integers(4)}", "b": float(rng.random())} for _ in range(SIZE)]
+    queries = np.concatenate([
+        rng.normal(size=(6, DIM)).astype(np.float32),
+        vectors[rng.choice(SIZE, size=6, replace=False)],
+    ])
+    return vectors, payloads, queries
+
+
+def query_conditions(queries):
+    return [CONDITIONS[i % len(CONDITIONS)] for i in range(len(queries))]
+
+
+def matches(payload: dict, conditions: dict) -> bool:
+    def clause(field, condition):
+        if "match" in condition:
+            return payload[field] == condition["match"]["value"]
+        return condition["range"]["gt"] < payload[field] < condition["range"]["lt"]
+
+    operator, clauses = next(iter(conditions.items()))
+    results = [clause(field, condition) for item in clauses for field, condition in item.items()]
+    return all(results) if operator == "and" else any(results)
+
+
+def brute_force(query, vectors, payloads, conditions, metric="cosine", top=TOP):
+    ids = np.array([i for i, payload in enumerate(payloads) if not conditions or matches(payload, conditions)],
+                   dtype=np.int64)
+    rows = np.asarray(vectors, dtype=np.float64)[ids]
+    query = np.asarray(query, dtype=np.float64)
+    if metric == "cosine":
+        scores = rows @ query / (np.linalg.norm(rows, axis=1) * np.linalg.norm(query))
+    elif metric == "dot":
+        scores = rows @ query
+    else:
+        scores = -((rows - query) ** 2).sum(axis=1)
+    scores = scores.astype(np.float32)
+    order = np.lexsort((ids, -scores))[:top]
+    return ids[order].tolist(), get_metric(metric).reported(scores[order])
+
+
+def assert_same(results, queries, vectors, payloads, conditions, metric="cosine"):
+    for query, expected_conditions, (closest_ids, closest_scores) in zip(queries, conditions, results):
+        expected_ids, expected_scores = brute_force(query, vectors, payloads, expected_conditions, metric)
+        assert list(closest_ids) == expected_ids
+        np.testing.assert_allclose(closest_scores, expected_scores, rtol=1e-6, atol=1e-6)
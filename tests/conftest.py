@@ -0,0 +1,8 @@
+import pytest
+
+from brute_force import make_data
+
+
+@pytest.fixture(scope="module")
+def data():
+    return make_data()
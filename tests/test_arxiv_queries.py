@@ -0,0 +1,68 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from generators.arxiv.generate_arxiv_queries import ArxivGenerator, prepare_columns
+from generators.dataset import ColumnWriter
+from generators.filters import csr_encode
+
+LABELS = ["cs.AI", "cs.CL", "cs.LG", "math.PR", "stat.ML"]
+SIZE = 400
+
+
+@pytest.fixture(scope="module")
+def arxiv_dir(tmp_path_factory):
+    path = tmp_path_factory.mktemp("arxiv")
+    rng = np.random.default_rng(0)
+    np.save(path / "vectors.npy", rng.standard_normal((SIZE, 16), dtype=np.float32))
+    with open(path / "payloads.jsonl", "w") as fd:
+        for i in range(SIZE):
+            labels = [str(label) for label in rng.choice(LABELS, size=rng.integers(1, 4), replace=False)]
+            fd.write(json.dumps({"update_date_ts": 1000 * i, "labels": labels, "submitter": f"s{i % 13}"}) + "\n")
+    with open(path / "filters.json", "w") as fd:
+        json.dump({"labels": LABELS, "timestamp_range": {"q25": 50_000, "q75": 350_000}}, fd)
+    return path
+
+
+def generate(arxiv_dir, payload_path, parallel, seed=3, **kwargs) -> bytes:
+    output_path = str(arxiv_dir / f"tests_{parallel}_{seed}.jsonl")
+    ArxivGenerator.generate(
+        str(arxiv_dir / "vectors.npy"),
+        payload_path,
+        str(arxiv_dir / "filters.json"),
+        num_queries=24,
+        top=5,
+        parallel=parallel,
+        output_path=output_path,
+        seed=seed,
+        **kwargs,
+    )
+    with open(output_path, "rb") as fd:
+        return fd.read()
+
+
+@pytest.mark.parametrize("tests_per_vector", [1, 3])
+def test_parallel_output_identical(arxiv_dir, tests_per_vector):
+    payload_path = str(arxiv_dir / "payloads.jsonl")
+    single = generate(arxiv_dir, payload_path, parallel=1, tests_per_vector=tests_per_vector)
+    assert len(single.splitlines()) == 24
+    assert generate(arxiv_dir, payload_path, parallel=3, tests_per_vector=tests_per_vector) == single
+    assert generate(arxiv_dir, payload_path, parallel=1, seed=4, tests_per_vector=tests_per_vector) != single
+
+
+def test_columns_output_identical(arxiv_dir):
+    with open(arxiv_dir / "payloads.jsonl") as fd:
+        payloads = [json.loads(line) for line in fd]
+    # The arrays `read_arxiv_payloads` reads with pyarrow
+    dictionary, offsets, codes = csr_encode([payload["labels"] for payload in payloads])
+    timestamps = np.array([payload["update_date_ts"] for payload in payloads])
+    columns = prepare_columns(timestamps, offsets, dictionary, codes, seed=0)
+    columns_path = os.path.join(str(arxiv_dir), "columns")
+    with ColumnWriter(columns_path, SIZE) as writer:
+        writer.write(0, columns)
+    # Memory-mapped columns give the same tests as parsed payloads, with any number of workers
+    expected = generate(arxiv_dir, str(arxiv_dir / "payloads.jsonl"), parallel=1)
+    assert generate(arxiv_dir, columns_path, parallel=1) == expected
+    assert generate(arxiv_dir, columns_path, parallel=2) == expected
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from generators.bitset import WORD_BITS, Bitset
+
+# Sizes with and without a partial last word
+SIZES = [1, 63, 64, 65, 1000, 4096, 10_007]
+
+
+def random_mask(size: int, density: float, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).random(size) < density
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("density", [0.0, 0.001, 0.05, 0.5, 1.0])
+def test_from_indices(size, density):
+    mask = random_mask(size, density)
+    indices = np.flatnonzero(mask)
+    # Sparse sets are scattered into words, dense ones are packed from a mask
+    assert Bitset.from_indices(indices, size) == Bitset.from_mask(mask)
+    np.testing.assert_array_equal(Bitset.from_indices(indices, size).to_mask(), mask)
+
+
+def test_from_indices_paths():
+    size = 100 * WORD_BITS
+    sparse = np.array([0, 63, 64, 5000, size - 1])
+    dense = np.arange(0, size, 3)
+    assert len(sparse) * WORD_BITS <= size < len(dense) * WORD_BITS
+    for indices in (sparse, dense):
+        np.testing.assert_array_equal(Bitset.from_indices(indices, size).to_indices(), indices)
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("density", [0.0, 0.001, 0.05, 0.5, 1.0])
+def test_to_indices(size, density):
+    mask = random_mask(size, density, seed=1)
+    indices = Bitset.from_mask(mask).to_indices()
+    np.testing.assert_array_equal(indices, np.flatnonzero(mask))
+    assert list(Bitset.from_mask(mask)) == np.flatnonzero(mask).tolist()
+
+
+def test_to_indices_paths():
+    size = 64 * WORD_BITS
+    # One non-empty word in 64 unpacks words one by one, every word set scans a mask
+    sparse = np.zeros(size, dtype=bool)
+    sparse[[5, 130]] = True
+    dense = random_mask(size, 0.3, seed=2)
+    for mask in (sparse, dense):
+        np.testing.assert_array_equal(Bitset.from_mask(mask).to_indices(), np.flatnonzero(mask))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_invert_clears_tail(size):
+    mask = random_mask(size, 0.3, seed=3)
+    inverted = ~Bitset.from_mask(mask)
+    np.testing.assert_array_equal(inverted.to_mask(), ~mask)
+    assert inverted.count() == size - mask.sum()
+    tail = size % WORD_BITS
+    if tail:
+        assert int(inverted.words[-1]) >> tail == 0
+    assert ~Bitset.zeros(size) == Bitset.ones(size)
+    assert Bitset.ones(size).count() == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_contains_and_count(size):
+    mask = random_mask(size, 0.2, seed=4)
+    bitset = Bitset.from_mask(mask)
+    ids = np.random.default_rng(5).integers(size, size=50)
+    np.testing.assert_array_equal(bitset.contains(ids), mask[ids])
+    np.testing.assert_array_equal(bitset.contains(np.arange(size)), mask)
+    assert bitset.count() == mask.sum()
+    assert bitset.any() == mask.any()
+
+
+def test_operators():
+    size = 1000
+    a, b = random_mask(size, 0.3, seed=6), random_mask(size, 0.6, seed=7)
+    x, y = Bitset.from_mask(a), Bitset.from_mask(b)
+    np.testing.assert_array_equal((x & y).to_mask(), a & b)
+    np.testing.assert_array_equal((x | y).to_mask(), a | b)
+    np.testing.assert_array_equal((x ^ y).to_mask(), a ^ b)
+    np.testing.assert_array_equal((x - y).to_mask(), a & ~b)
+    x &= y
+    np.testing.assert_array_equal(x.to_mask(), a & b)
+    with pytest.raises(ValueError):
+        x | Bitset.zeros(size + 1)
@@ -0,0 +1,17 @@
+import pytest
+
+from brute_force import TOP, assert_same, query_conditions
+from generators.cluster_search import ClusterIndex, ClusterSearch
+from generators.filters import FilterEvaluator
+
+
+@pytest.mark.parametrize("num_clusters", [1, 16, 64])
+def test_cluster_search(data, num_clusters):
+    vectors, payloads, queries = data
+    conditions = query_conditions(queries)
+    search = ClusterSearch(vectors, ClusterIndex.build(vectors, num_clusters=num_clusters))
+    results = search.search_grouped(queries, conditions, FilterEvaluator(payloads), TOP)
+    assert_same(results, queries, vectors, payloads, conditions)
+    if num_clusters > 1:
+        # Bounds must prune, otherwise the index is only overhead
+        assert search.visited_rows < len(queries) * len(vectors)
@@ -0,0 +1,102 @@
+import json
+
+import numpy as np
+import pytest
+
+from generators import dataset as dataset_module
+from generators.dataset import Dataset, JsonLines, write_metadata
+
+RECORDS = [{"id": i, "name": "x" * (i % 7)} for i in range(50)]
+
+
+def write_lines(path, lines, trailing_newline=True):
+    text = "\n".join(lines) + ("\n" if trailing_newline else "")
+    path.write_text(text)
+    return str(path)
+
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_offsets(tmp_path, trailing_newline):
+    lines = [json.dumps(record) for record in RECORDS]
+    path = write_lines(tmp_path / "records.jsonl", lines, trailing_newline)
+    records = JsonLines(path)
+    assert len(records) == len(RECORDS)
+    assert records.raw(0) == lines[0].encode()
+    assert records.raw(-1) == lines[-1].encode()
+    assert list(records) == RECORDS
+
+
+def test_empty_lines_skipped(tmp_path):
+    lines = ["", json.dumps(RECORDS[0]), "", "", json.dumps(RECORDS[1]), ""]
+    records = JsonLines(write_lines(tmp_path / "records.jsonl", lines))
+    assert list(records) == RECORDS[:2]
+    assert len(JsonLines(write_lines(tmp_path / "empty.jsonl", [], trailing_newline=False))) == 0
+
+
+def test_scan_chunks(tmp_path, monkeypatch):
+    # Lines crossing the boundaries of scanned chunks
+    monkeypatch.setattr(dataset_module, "SCAN_CHUNK_BYTES", 5)
+    path = write_lines(tmp_path / "records.jsonl", [json.dumps(record) for record in RECORDS], False)
+    assert list(JsonLines(path)) == RECORDS
+
+
+def test_indexing(tmp_path):
+    records = JsonLines(write_lines(tmp_path / "records.jsonl", [json.dumps(record) for record in RECORDS]))
+    assert records[3] == RECORDS[3]
+    assert records[np.int64(-2)] == RECORDS[-2]
+    with pytest.raises(IndexError):
+        records[len(RECORDS)]
+
+    view = records[10:40:3]
+    assert isinstance(view, JsonLines)
+    assert len(view) == len(RECORDS[10:40:3])
+    assert list(view) == RECORDS[10:40:3]
+    # Views of views index the original file
+    assert list(view[1:4]) == RECORDS[10:40:3][1:4]
+    assert view[-1] == RECORDS[10:40:3][-1]
+
+    ids = np.array([7, 0, 49, 7])
+    assert list(records[ids]) == [RECORDS[i] for i in ids]
+    assert list(records[np.arange(len(RECORDS)) % 5 == 0]) == RECORDS[::5]
+
+
+def test_batches(tmp_path):
+    records = JsonLines(write_lines(tmp_path / "records.jsonl", [json.dumps(record) for record in RECORDS]))
+    batches = list(records.batches(16))
+    assert [len(batch) for batch in batches] == [16, 16, 16, 2]
+    assert [record for batch in batches for record in batch] == RECORDS
+    assert list(records[5:20].batches(10)) == [RECORDS[5:15], RECORDS[15:20]]
+
+
+def test_tests_arrays(tmp_path):
+    tests = [
+        {"query": [0.5, 1.0], "conditions": None, "closest_ids": [3, 1, 2], "closest_scores": [0.9, 0.8, 0.7]},
+        {"query": [0.0, 1.5], "conditions": {"and": []}, "closest_ids": [4], "closest_scores": [0.5]},
+    ]
+    # `Tests` is not imported by name, pytest would collect it
+    arrays = dataset_module.Tests(write_lines(tmp_path / "tests.jsonl", [json.dumps(test) for test in tests])).arrays()
+    np.testing.assert_array_equal(arrays["query"], np.array([[0.5, 1.0], [0.0, 1.5]], dtype=np.float32))
+    np.testing.assert_array_equal(arrays["closest_ids"], [[3, 1, 2], [4, -1, -1]])
+    np.testing.assert_array_equal(arrays["closest_scores"][1], np.array([0.5, np.nan, np.nan], dtype=np.float32))
+
+
+def test_dataset(tmp_path):
+    vectors = np.random.default_rng(0).random((len(RECORDS), 4), dtype=np.float32)
+    np.save(tmp_path / "vectors.npy", vectors)
+    write_lines(tmp_path / "payloads.jsonl", [json.dumps(record) for record in RECORDS])
+    (tmp_path / "filters.json").write_text(json.dumps([{"name": "id", "values": [1, 2]}]))
+    write_metadata(str(tmp_path), metric="l2", top=5)
+
+    dataset = Dataset.open(str(tmp_path))
+    assert len(dataset) == len(RECORDS) and dataset.dim == 4
+    assert isinstance(dataset.vectors, np.memmap)
+    assert dataset.filters == {"id": [1, 2]}
+    assert dataset.metric == "l2"
+    assert dataset.stats is None
+    assert dataset.column("id")[0] == "number"
+    batches = list(dataset.batches(20, start=5, stop=45))
+    assert [len(payloads) for _, payloads in batches] == [20, 20]
+    np.testing.assert_array_equal(np.concatenate([batch for batch, _ in batches]), vectors[5:45])
+    assert [record for _, payloads in batches for record in payloads] == RECORDS[5:45]
+    with pytest.raises(FileNotFoundError):
+        Dataset(str(tmp_path / "missing"))
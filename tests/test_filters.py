@@ -0,0 +1,157 @@
+import numpy as np
+import pytest
+
+from generators.arxiv.generate_arxiv_queries import ArxivGenerator, prepare_columns
+from generators.filters import FilterEvaluator, PayloadColumns
+from generators.generate import DataGenerator
+from generators.planner import SelectivityEstimator
+
+LABELS = ["cs.AI", "cs.LG", "math.CO", "physics", "q-bio"]
+
+
+def labelled_payloads(size: int = 500, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    payloads = [
+        {"labels": [str(label) for label in rng.choice(LABELS, size=rng.integers(0, 4))], "n": int(rng.integers(10))}
+        for _ in range(size)
+    ]
+    # Empty lists first, last and in a run, the row of a value is looked up through the offsets
+    for row in (0, 1, 2, 250, 251, size - 1):
+        payloads[row]["labels"] = []
+    return payloads
+
+
+def expected_mask(payloads, conditions):
+    generator = DataGenerator(seed=0)
+    return np.array([generator.check_conditions(payload, conditions) for payload in payloads])
+
+
+def assert_evaluates(payloads, conditions, evaluator: FilterEvaluator = None):
+    expected = expected_mask(payloads, conditions)
+    evaluator = evaluator or FilterEvaluator(payloads)
+    np.testing.assert_array_equal(evaluator.bitset(conditions).to_mask(), expected)
+    ids = np.arange(0, len(payloads), 3)
+    np.testing.assert_array_equal(evaluator.rows_mask(conditions, ids), expected[ids])
+
+
+MULTI_KEYWORD_CONDITIONS = [
+    {"and": [{"labels": {"match": {"value": "cs.AI"}}}]},
+    {"and": [{"labels": {"match": {"value": "q-bio"}}}]},
+    {"and": [{"labels": {"match": {"any": ["cs.LG", "physics"]}}}]},
+    {"and": [{"labels": {"match": {"any": ["math.CO", "unknown"]}}}]},
+    # Values which no row holds
+    {"and": [{"labels": {"match": {"value": "unknown"}}}]},
+    {"and": [{"labels": {"match": {"any": []}}}]},
+    {"or": [{"labels": {"match": {"value": "cs.AI"}}}, {"n": {"match": {"value": 3}}}]},
+    {"and": [{"labels": {"match": {"value": "cs.LG"}}}, {"labels": {"match": {"value": "physics"}}}]},
+]
+
+
+@pytest.mark.parametrize("conditions", MULTI_KEYWORD_CONDITIONS)
+def test_multi_keyword_match(conditions):
+    payloads = labelled_payloads()
+    assert PayloadColumns(payloads).column("labels")[0] == "multi_keyword"
+    assert_evaluates(payloads, conditions)
+
+
+def test_multi_keyword_duplicates():
+    payloads = [{"labels": ["a", "a", "b"]}, {"labels": []}, {"labels": ["b", "b"]}]
+    kind, (dictionary, offsets, codes) = PayloadColumns(payloads).column("labels")
+    assert dictionary.tolist() == ["a", "b"]
+    assert offsets.tolist() == [0, 2, 2, 3]
+    assert codes.tolist() == [0, 1, 1]
+    assert_evaluates(payloads, {"and": [{"labels": {"match": {"value": "b"}}}]})
+
+
+def test_arxiv_labels_conditions():
+    payloads = [payload for payload in labelled_payloads(seed=1) if payload["labels"]]
+    labels = [payload["labels"] for payload in payloads]
+    # Raw columns as read from the payload file: insertion ordered dictionary, unsorted codes
+    dictionary = np.array(list(dict.fromkeys(label for row in labels for label in row)), dtype=object)
+    index = {label: code for code, label in enumerate(dictionary)}
+    offsets = np.concatenate([[0], np.cumsum([len(row) for row in labels])])
+    codes = np.array([index[label] for row in labels for label in row], dtype=np.int64)
+    timestamps = np.arange(len(payloads)) * 1000
+    columns = PayloadColumns.from_columns(prepare_columns(timestamps, offsets, dictionary, codes, seed=0),
+                                          len(payloads))
+    evaluator = FilterEvaluator(columns)
+    # `label` is one of the labels of each paper
+    label_dictionary, label_codes = columns.column("label")[1]
+    assert all(label_dictionary[code] in payload["labels"] for payload, code in zip(payloads, label_codes))
+
+    filters = {"labels": LABELS, "timestamp_range": {"q25": 10_000, "q75": 300_000}}
+    rng = np.random.default_rng(0)
+    records = [{**payload, "update_date_ts": int(ts)} for payload, ts in zip(payloads, timestamps)]
+    for _ in range(30):
+        conditions = ArxivGenerator.generate_condition(filters, rng)
+        np.testing.assert_array_equal(evaluator.bitset(conditions).to_mask(), expected_mask(records, conditions))
+
+
+def test_arxiv_papers_without_labels():
+    offsets = np.array([0, 1, 1, 2])
+    with pytest.raises(ValueError):
+        prepare_columns(np.arange(3), offsets, np.array(["a", "b"], dtype=object), np.array([0, 1]))
+
+
+def tree_payloads(size: int = 2000, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [
+        {
+            "k": f"k{rng.integers(6)}",
+            "x": float(rng.random()),
+            "labels": [str(label) for label in rng.choice(LABELS, size=rng.integers(0, 3), replace=False)],
+            "loc": {"lat": float(rng.uniform(-1, 1)), "lon": float(rng.uniform(-1, 1))},
+        }
+        for _ in range(size)
+    ]
+
+
+def random_predicate(rng: np.random.Generator) -> dict:
+    case = rng.integers(5)
+    if case == 0:
+        return {"k": {"match": {"value": f"k{rng.integers(6)}"}}}
+    if case == 1:
+        start = float(rng.random())
+        return {"x": {"range": {"gt": start, "lt": start + float(rng.random())}}}
+    if case == 2:
+        return {"labels": {"match": {"any": [str(label) for label in rng.choice(LABELS, size=2, replace=False)]}}}
+    if case == 3:
+        # Several fields in one clause
+        return {"k": {"match": {"any": ["k0", "k1", "k2"]}}, "x": {"range": {"gt": 0.1, "lt": 0.9}}}
+    return {"loc": {"geo": {"lat": 0.0, "lon": 0.0, "radius": float(rng.uniform(20_000, 120_000))}}}
+
+
+def random_tree(rng: np.random.Generator, depth: int) -> dict:
+    operator = str(rng.choice(["and", "or", "not"]))
+    clauses = [
+        random_tree(rng, depth - 1) if depth > 0 and rng.random() < 0.5 else random_predicate(rng)
+        for _ in range(rng.integers(1, 4))
+    ]
+    return {operator: clauses}
+
+
+@pytest.mark.parametrize("estimate", [False, True])
+def test_nested_trees(estimate):
+    payloads = tree_payloads()
+    evaluator = FilterEvaluator(payloads)
+    if estimate:
+        evaluator.estimator = SelectivityEstimator(evaluator, sample_size=500)
+    rng = np.random.default_rng(1)
+    for _ in range(60):
+        assert_evaluates(payloads, random_tree(rng, depth=3), evaluator)
+
+
+def test_not_and_empty_trees():
+    payloads = tree_payloads(size=300)
+    conditions = [
+        {"not": [{"k": {"match": {"value": "k0"}}}, {"labels": {"match": {"value": "cs.AI"}}}]},
+        {"not": [{"not": [{"k": {"match": {"value": "k1"}}}]}]},
+        {"and": [{"or": [{"k": {"match": {"value": "k2"}}}]}, {"not": [{"x": {"range": {"gt": 0.5, "lt": 2}}}]}]},
+        # An empty `and` matches every row, an empty `or` none of them
+        {"and": []},
+        {"or": []},
+        {"not": []},
+        {"and": [{"k": {"match": {"value": "missing"}}}, {"x": {"range": {"gt": 0, "lt": 1}}}]},
+    ]
+    for condition in conditions:
+        assert_evaluates(payloads, condition)
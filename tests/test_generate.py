@@ -0,0 +1,53 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from generators.dataset import COLUMNS_DIR, open_columns
+from generators.generate import DataGenerator, RandomPayloads, write_random_payloads
+
+
+def generator_pair(seed: int = 7):
+    # Vocabularies are drawn from their own stream, both generators start from the same state
+    return DataGenerator(vocab_size=50, seed=seed), DataGenerator(vocab_size=50, seed=seed)
+
+
+@pytest.mark.parametrize("kind", RandomPayloads.KINDS)
+def test_columns_match_single_calls(kind):
+    chunked, single = generator_pair()
+    chunked_payloads = RandomPayloads(chunked, kind, fields=("a", "b", "c"))
+    single_payloads = RandomPayloads(single, kind, fields=("a", "b", "c"))
+
+    records = []
+    for size in (1, 17, 0, 250):
+        records.extend(chunked_payloads.records(chunked_payloads.columns(size)))
+    expected = [single_payloads() for _ in range(268)]
+    assert records == expected
+    # Both consumed the random stream up to the same point
+    assert chunked.rng.bit_generator.state == single.rng.bit_generator.state
+    assert chunked.random_float() == single.random_float()
+
+
+def test_save_random_vectors(tmp_path):
+    chunked, single = generator_pair()
+    path = str(tmp_path / "vectors.npy")
+    chunked.save_random_vectors(path, 1000, 8, chunk_size=300)
+    vectors = np.load(path)
+    assert vectors.dtype == np.float32
+    np.testing.assert_array_equal(vectors, single.random_vectors(1000, 8))
+    assert chunked.rng.bit_generator.state == single.rng.bit_generator.state
+
+
+@pytest.mark.parametrize("kind", ["keyword", "geo"])
+def test_write_random_payloads(tmp_path, kind):
+    chunked, single = generator_pair()
+    write_random_payloads(RandomPayloads(chunked, kind), 230, str(tmp_path), chunk_size=100)
+    expected = [RandomPayloads(single, kind)() for _ in range(230)]
+
+    with open(tmp_path / "payloads.jsonl") as fd:
+        assert [json.loads(line) for line in fd] == expected
+    columns = open_columns(os.path.join(str(tmp_path), COLUMNS_DIR))
+    assert len(columns) == 230
+    records = list(RandomPayloads(single, kind).records({field: columns.column(field) for field in ("a", "b")}))
+    assert records == expected
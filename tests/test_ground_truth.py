@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from brute_force import CONDITIONS, METRICS, TOP, assert_same, query_conditions
+from generators.filters import FilterEvaluator
+from generators.ground_truth import ExactSearch, ScoredQuery
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_search_grouped(data, metric):
+    vectors, payloads, queries = data
+    conditions = query_conditions(queries)
+    results = ExactSearch(vectors, metric).search_grouped(queries, conditions, FilterEvaluator(payloads), TOP)
+    assert_same(results, queries, vectors, payloads, conditions, metric)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_search_many_ids(data, metric):
+    vectors, payloads, queries = data
+    # Rows restricted by ids give the same top as the filter they come from
+    conditions = query_conditions(queries)[1]
+    ids = FilterEvaluator(payloads).bitset(conditions).to_indices()
+    results = ExactSearch(vectors, metric).search_many(queries, ids=ids, top=TOP)
+    assert_same(results, queries, vectors, payloads, [conditions] * len(queries), metric)
+    assert all(np.isin(closest_ids, ids).all() for closest_ids, _ in results)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_scored_query(data, metric):
+    vectors, payloads, queries = data
+    search = ExactSearch(vectors, metric)
+    evaluator = FilterEvaluator(payloads)
+    for query in queries[:4]:
+        # One scoring of the query serves every filter
+        scored = ScoredQuery(search, query)
+        results = [scored.top(conditions, evaluator, TOP) for conditions in CONDITIONS]
+        assert_same(results, [query] * len(CONDITIONS), vectors, payloads, CONDITIONS, metric)
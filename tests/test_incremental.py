@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from brute_force import METRICS, SIZE, TOP, assert_same, brute_force, query_conditions
+from generators.incremental import append_rows, delete_rows
+
+
+def make_tests(queries, vectors, payloads, metric):
+    tests = []
+    for query, conditions in zip(queries, query_conditions(queries)):
+        closest_ids, closest_scores = brute_force(query, vectors, payloads, conditions, metric)
+        tests.append({
+            "query": query.tolist(),
+            "conditions": conditions,
+            "closest_ids": closest_ids,
+            "closest_scores": np.asarray(closest_scores).tolist(),
+        })
+    return tests
+
+
+def results_of(tests):
+    return [(test["closest_ids"], test["closest_scores"]) for test in tests]
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_append(data, metric):
+    vectors, payloads, queries = data
+    start = SIZE * 2 // 3
+    tests = make_tests(queries, vectors[:start], payloads[:start], metric)
+    updated = append_rows(tests, vectors, start, payloads[start:], TOP, metric)
+    assert_same(results_of(updated), queries, vectors, payloads, query_conditions(queries), metric)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_delete(data, metric):
+    vectors, payloads, queries = data
+    tests = make_tests(queries, vectors, payloads, metric)
+    rng = np.random.default_rng(1)
+    # Random rows and the best rows of a few tests, so some tops lose rows
+    deleted = np.unique(np.concatenate([
+        rng.choice(SIZE, size=SIZE // 10, replace=False),
+        [test["closest_ids"][0] for test in tests[::3] if test["closest_ids"]],
+    ]))
+    keep = np.ones(SIZE, dtype=bool)
+    keep[deleted] = False
+
+    updated = delete_rows(tests, vectors, payloads, deleted, TOP, metric)
+    remaining_payloads = [payload for payload, kept in zip(payloads, keep) if kept]
+    assert_same(results_of(updated), queries, vectors[keep], remaining_payloads, query_conditions(queries), metric)
+
+
+def test_delete_smaller_top(data):
+    vectors, payloads, queries = data
+    tests = make_tests(queries, vectors, payloads, "cosine")
+    # Rows beyond the requested top are deleted, tops are still exact
+    deleted = np.unique([test["closest_ids"][-1] for test in tests if test["closest_ids"]])
+    keep = np.ones(SIZE, dtype=bool)
+    keep[deleted] = False
+    updated = delete_rows(tests, vectors, payloads, deleted, TOP // 2)
+    remaining_payloads = [payload for payload, kept in zip(payloads, keep) if kept]
+    for query, conditions, (closest_ids, _) in zip(queries, query_conditions(queries), results_of(updated)):
+        expected_ids, _ = brute_force(query, vectors[keep], remaining_payloads, conditions, top=TOP // 2)
+        assert closest_ids == expected_ids
+
+
+def test_rejects_larger_top(data):
+    vectors, payloads, queries = data
+    tests = make_tests(queries, vectors, payloads, "cosine")
+    with pytest.raises(ValueError):
+        append_rows(tests, vectors, SIZE - 10, payloads[SIZE - 10:], TOP + 1)
+    with pytest.raises(ValueError):
+        delete_rows(tests, vectors, payloads, np.array([0]), TOP + 1)
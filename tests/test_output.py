@@ -0,0 +1,80 @@
+import gzip
+import json
+import time
+
+import numpy as np
+import pytest
+
+from generators.output import RecordWriter, encode_records
+
+
+def read_lines(path, opener=open):
+    with opener(path, "rt") as fd:
+        return [json.loads(line) for line in fd]
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_order(tmp_path, processes):
+    path = str(tmp_path / "out.jsonl")
+    with RecordWriter(path, workers=4, processes=processes, max_pending=2, chunk_size=7) as writer:
+        for i in range(500):
+            writer.write({"id": i, "vector": np.full(3, i, dtype=np.float32)})
+    assert read_lines(path) == [{"id": i, "vector": [float(i)] * 3} for i in range(500)]
+    assert writer.written == 500
+
+
+def test_sinks_keep_order(tmp_path):
+    path = str(tmp_path / "out.jsonl")
+    sunk = []
+    with RecordWriter(path, workers=3, chunk_size=4) as writer:
+        for chunk in range(20):
+            for i in range(chunk * 10, chunk * 10 + 5):
+                writer.write({"id": i})
+            # An explicit chunk is written after the records buffered before it
+            writer.submit([{"id": i} for i in range(chunk * 10 + 5, chunk * 10 + 10)],
+                          sink=lambda lines: sunk.append([json.loads(line)["id"] for line in lines]))
+            sunk.append(None)
+    ids = [record["id"] for record in read_lines(path)]
+    assert ids == [i for chunk in range(20) for i in range(chunk * 10, chunk * 10 + 5)]
+    # Sinks are called by the writer thread in submission order
+    assert [ids for ids in sunk if ids is not None] == [list(range(c * 10 + 5, c * 10 + 10)) for c in range(20)]
+
+
+def test_precision_and_compression(tmp_path):
+    path = str(tmp_path / "out.jsonl.gz")
+    records = [{"query": np.array([0.123456, 1.0]), "score": 0.987654, "conditions": {"x": {"gt": 0.123456}}}]
+    with RecordWriter(path, precision=3, compression="gzip") as writer:
+        writer.submit(records)
+    assert read_lines(path, gzip.open) == [{"query": [0.123, 1.0], "score": 0.988, "conditions": {"x": {"gt": 0.123456}}}]
+    assert encode_records(records, 3) == [json.dumps(read_lines(path, gzip.open)[0]) + "\n"]
+    with pytest.raises(ValueError):
+        RecordWriter(path, compression="zip")
+
+
+def test_encoding_error_raised(tmp_path):
+    writer = RecordWriter(str(tmp_path / "out.jsonl"))
+    writer.submit([{"id": object()}])
+    with pytest.raises(TypeError):
+        # Raised by a later `submit` once the writer thread failed, at the latest by `close`
+        for _ in range(100):
+            writer.submit([{"id": 1}])
+        writer.close()
+
+
+def test_sink_error_raised_on_close(tmp_path):
+    def failing_sink(lines):
+        raise OSError("disk full")
+
+    with pytest.raises(OSError, match="disk full"):
+        with RecordWriter(str(tmp_path / "out.jsonl")) as writer:
+            writer.submit([{"id": 1}], sink=failing_sink)
+
+
+def test_body_error_not_masked(tmp_path):
+    with pytest.raises(KeyError):
+        with RecordWriter(str(tmp_path / "out.jsonl")) as writer:
+            writer.submit([{"id": object()}])
+            while writer.error is None:
+                time.sleep(0.001)
+            # The encoding error of the background stage does not replace the one of the body
+            raise KeyError("body")
@@ -0,0 +1,36 @@
+import pytest
+
+from brute_force import CONDITIONS, METRICS, TOP, assert_same, query_conditions
+from generators.filters import FilterEvaluator
+from generators.ground_truth import ExactSearch
+from generators.planner import QueryPlanner
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_query_planner(data, metric):
+    vectors, payloads, queries = data
+    conditions = query_conditions(queries)
+    planner = QueryPlanner(ExactSearch(vectors, metric), FilterEvaluator(payloads))
+    assert_same(planner.search_grouped(queries, conditions, TOP), queries, vectors, payloads, conditions, metric)
+    assert sum(planner.summary().values()) == len(queries)
+
+
+@pytest.mark.parametrize("metric", METRICS)
+def test_strategies(data, metric):
+    vectors, payloads, queries = data
+    planner = QueryPlanner(ExactSearch(vectors, metric), FilterEvaluator(payloads))
+    # Every strategy must be exact, whichever the planner picks
+    for conditions in CONDITIONS[1:]:
+        plan = planner.plan(conditions)
+        post_filtered = [planner.post_filter(query, conditions, TOP, plan.selectivity) for query in queries]
+        assert_same(post_filtered, queries, vectors, payloads, [conditions] * len(queries), metric)
+        pre_filtered = planner.engine.search_filtered(queries, conditions, planner.evaluator, TOP)
+        assert_same(pre_filtered, queries, vectors, payloads, [conditions] * len(queries), metric)
+
+
+def test_selectivity_estimate(data):
+    vectors, payloads, _ = data
+    planner = QueryPlanner(ExactSearch(vectors), FilterEvaluator(payloads))
+    for conditions in CONDITIONS[1:]:
+        actual = planner.evaluator.bitset(conditions).count() / len(payloads)
+        assert abs(planner.estimator.estimate(conditions) - actual) < 0.05
@@ -0,0 +1,13 @@
+import pytest
+
+from brute_force import TOP, assert_same, query_conditions
+from generators.filters import FilterEvaluator
+from generators.quantized_search import QuantizedSearch
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_quantized_search(data, dtype):
+    vectors, payloads, queries = data
+    conditions = query_conditions(queries)
+    results = QuantizedSearch(vectors, dtype=dtype).search_grouped(queries, conditions, FilterEvaluator(payloads), TOP)
+    assert_same(results, queries, vectors, payloads, conditions)